@@ -0,0 +1,335 @@
+# ydm/app/async_crud.py
+# Асинхронные аналоги функций crud для AsyncSession
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from . import models, schemas
+from .cache import reference_cache, rendered_config_cache, summary_cache
+from .crud import (
+    command_jobs_query, config_key_configs_query, config_key_devices_query, config_key_rows, config_key_values_query,
+    config_upsert_rows, device_list_relations, devices_page_query, devices_selector_query, insert_blobs_query,
+    insert_config_keys_query, record_versions_query, set_config_content, status_history_query, upsert_configs_query,
+    upsert_devices_query
+)
+
+# Связи устройства загружаются сразу: ленивая загрузка в AsyncSession невозможна
+_device_relations = (
+    selectinload(models.Device.model), selectinload(models.Device.config).selectinload(models.Config.blob)
+)
+
+# По работе с моделями устройств
+async def create_device_model(db: AsyncSession, model: schemas.DeviceModelCreate):
+    db_model = models.DeviceModel(**model.model_dump())
+    db.add(db_model)
+    await db.commit()
+    reference_cache.invalidate("device_models")
+    summary_cache.invalidate()
+    await db.refresh(db_model)
+    return db_model
+
+async def get_device_model(db: AsyncSession, model_id: int):
+    return await db.get(models.DeviceModel, model_id)
+
+async def get_device_models(db: AsyncSession, skip: int = 0, limit: int = 100):
+    result = await db.scalars(select(models.DeviceModel).offset(skip).limit(limit))
+    return result.all()
+
+async def update_device_model(db: AsyncSession, model_id: int, model_data: schemas.DeviceModelBase):
+    db_model = await db.get(models.DeviceModel, model_id)
+    if not db_model:
+        return None
+
+    update_data = model_data.model_dump(exclude_unset=True)
+    for key, value in update_data.items():
+        setattr(db_model, key, value)
+
+    await db.commit()
+    reference_cache.invalidate("device_models")
+    summary_cache.invalidate()
+    await db.refresh(db_model)
+    return db_model
+
+async def delete_device_model(db: AsyncSession, model_id: int):
+    db_model = await db.get(models.DeviceModel, model_id)
+    if db_model:
+        await db.delete(db_model)
+        await db.commit()
+        reference_cache.invalidate("device_models")
+        summary_cache.invalidate()
+        return True
+    return False
+
+# По работе с устройствами
+async def create_device(db: AsyncSession, device: schemas.DeviceCreate):
+    device_data = device.model_dump(exclude_unset=True)
+
+    # Удаляем config_id и model_id, если они None
+    for field in ["config_id", "model_id"]:
+        if field in device_data and device_data[field] is None:
+            del device_data[field]
+
+    db_device = models.Device(**device_data)
+
+    db.add(db_device)
+    await db.commit()
+    summary_cache.invalidate()
+    return await get_device(db, db_device.id)
+
+async def upsert_devices(db: AsyncSession, rows: list, update_fields: tuple):
+    if not rows:
+        return
+    await db.execute(upsert_devices_query(db.bind.dialect.name, update_fields), rows)
+    await db.commit()
+    summary_cache.invalidate()
+
+async def get_device(db: AsyncSession, device_id: int):
+    result = await db.scalars(
+        select(models.Device).options(*_device_relations).where(models.Device.id == device_id)
+    )
+    return result.first()
+
+async def get_device_by_mac(db: AsyncSession, mac_address: str):
+    result = await db.scalars(
+        select(models.Device).options(*_device_relations).where(models.Device.mac_address == models.normalize_mac(mac_address))
+    )
+    return result.first()
+
+async def get_devices(db: AsyncSession, skip: int = 0, limit: int = 100):
+    result = await db.scalars(
+        select(models.Device).options(*device_list_relations()).offset(skip).limit(limit)
+    )
+    return result.all()
+
+async def get_devices_by_selector(db: AsyncSession, selector: schemas.DeviceSelector):
+    # Модель нужна для переменных шаблона конфигурации
+    query = devices_selector_query(selector).options(selectinload(models.Device.model))
+    return (await db.scalars(query)).all()
+
+async def get_devices_page(
+    db: AsyncSession, filters: schemas.DeviceFilter, cursor: int = None, limit: int = 100,
+    with_config_content: bool = False
+):
+    query = devices_page_query(filters, cursor, limit).options(*device_list_relations(with_config_content))
+    result = await db.scalars(query)
+    return result.all()
+
+async def get_status_history(db: AsyncSession, device_id: int, registered: bool = None, limit: int = 100):
+    """История статусов устройства, новые записи первыми"""
+    return (await db.scalars(status_history_query(device_id, registered, limit))).all()
+
+# По работе с заданиями команд
+async def create_command_job(db: AsyncSession, device_id: int, job: schemas.CommandJobCreate, max_attempts: int):
+    db_job = models.CommandJob(
+        device_id=device_id,
+        command=job.command,
+        config_id=job.config_id,
+        force=job.force,
+        status="queued",
+        attempts=0,
+        max_attempts=max_attempts,
+        next_attempt_at=models.utcnow(),
+    )
+    db.add(db_job)
+    await db.commit()
+    await db.refresh(db_job)
+    return db_job
+
+async def create_command_jobs(db: AsyncSession, device_ids: list, job: schemas.CommandJobCreate, max_attempts: int):
+    """Пакетная постановка одной команды для многих устройств; номера заданий в порядке device_ids"""
+    now = models.utcnow()
+    rows = [
+        {"device_id": device_id, "command": job.command, "config_id": job.config_id, "force": job.force,
+         "status": "queued", "attempts": 0, "max_attempts": max_attempts, "next_attempt_at": now}
+        for device_id in device_ids
+    ]
+    if not rows:
+        return []
+    job_ids = (await db.scalars(
+        insert(models.CommandJob).returning(models.CommandJob.id, sort_by_parameter_order=True), rows
+    )).all()
+    await db.commit()
+    return job_ids
+
+async def get_command_job(db: AsyncSession, job_id: int):
+    return await db.get(models.CommandJob, job_id)
+
+async def get_command_jobs(db: AsyncSession, device_id: int = None, status: str = None, limit: int = 100):
+    return (await db.scalars(command_jobs_query(device_id, status, limit))).all()
+
+async def update_device(db: AsyncSession, device_id: int, device_data: schemas.DeviceBase):
+    db_device = await db.get(models.Device, device_id)
+    if not db_device:
+        return None
+
+    update_data = device_data.model_dump(exclude_unset=True)
+    for key, value in update_data.items():
+        setattr(db_device, key, value)
+
+    await db.commit()
+    summary_cache.invalidate()
+    return await get_device(db, device_id)
+
+async def delete_device(db: AsyncSession, device_id: int):
+    db_device = await db.get(models.Device, device_id)
+    if db_device:
+        # История и задания удаляются явно: SQLite не соблюдает ON DELETE CASCADE без PRAGMA foreign_keys
+        await db.execute(delete(models.DeviceStatusHistory).where(models.DeviceStatusHistory.device_id == device_id))
+        await db.execute(delete(models.CommandJob).where(models.CommandJob.device_id == device_id))
+        await db.delete(db_device)
+        await db.commit()
+        summary_cache.invalidate()
+        return True
+    return False
+
+# По работе с конфигами
+async def _store_content(db: AsyncSession, content: str) -> str:
+    dialect_name = db.bind.dialect.name
+    blob = models.ConfigBlob.pack(content)
+    await db.execute(insert_blobs_query(dialect_name), [blob])
+    keys = config_key_rows(blob["hash"], content)
+    if keys:
+        await db.execute(insert_config_keys_query(dialect_name), keys)
+    return blob["hash"]
+
+async def _record_version(db: AsyncSession, config_id: int):
+    await db.execute(record_versions_query(db.bind.dialect.name, models.Config.id == config_id))
+
+async def create_config(db: AsyncSession, config: schemas.ConfigCreate):
+    config_data = config.model_dump()
+    content_hash = await _store_content(db, config_data.pop("content"))
+    db_config = models.Config(**config_data, content_hash=content_hash, version=1)
+    db.add(db_config)
+    await db.flush()
+    await _record_version(db, db_config.id)
+    await db.commit()
+    reference_cache.invalidate("configs")
+    summary_cache.invalidate()
+    return await get_config(db, db_config.id)
+
+async def upsert_configs(db: AsyncSession, rows: list):
+    if not rows:
+        return
+    dialect_name = db.bind.dialect.name
+    blobs, keys, configs = config_upsert_rows(rows)
+    await db.execute(insert_blobs_query(dialect_name), blobs)
+    if keys:
+        await db.execute(insert_config_keys_query(dialect_name), keys)
+    await db.execute(upsert_configs_query(dialect_name), configs)
+    await db.execute(record_versions_query(dialect_name, models.Config.name.in_([row["name"] for row in configs])))
+    await db.commit()
+    reference_cache.invalidate("configs")
+    summary_cache.invalidate()
+    rendered_config_cache.invalidate()
+
+async def find_configs_by_key(db: AsyncSession, key: str, value: str = None):
+    return (await db.execute(config_key_configs_query(key, value))).mappings().all()
+
+async def find_devices_by_key(db: AsyncSession, key: str, value: str = None, cursor: int = None, limit: int = 100):
+    return (await db.execute(config_key_devices_query(key, value, cursor, limit))).mappings().all()
+
+async def get_config_key_values(db: AsyncSession, key: str):
+    return (await db.execute(config_key_values_query(key))).mappings().all()
+
+async def get_configs(db: AsyncSession, skip: int = 0, limit: int = 100):
+    result = await db.scalars(select(models.Config).offset(skip).limit(limit))
+    return result.all()
+
+async def get_config(db: AsyncSession, config_id: int, with_content: bool = True):
+    """Конфигурация; содержимое (распаковка из config_blobs) — только если with_content"""
+    query = select(models.Config).where(models.Config.id == config_id)
+    if with_content:
+        query = query.options(selectinload(models.Config.blob)).execution_options(populate_existing=True)
+    return await db.scalar(query)
+
+async def get_config_content(db: AsyncSession, config_id: int):
+    data = await db.scalar(
+        select(models.ConfigBlob.data)
+        .join(models.Config, models.Config.content_hash == models.ConfigBlob.hash)
+        .where(models.Config.id == config_id)
+    )
+    return models.ConfigBlob.unpack(data) if data is not None else None
+
+async def update_config(db: AsyncSession, config_id: int, config_data: schemas.ConfigUpdate):
+    db_config = await get_config(db, config_id, with_content=False)
+    if not db_config:
+        return None
+
+    update_data = config_data.model_dump(exclude_unset=True)
+    content = update_data.pop("content", None)
+    for key, value in update_data.items():
+        setattr(db_config, key, value)
+    if content is not None and set_config_content(db_config, await _store_content(db, content)):
+        await db.flush()
+        await _record_version(db, config_id)
+
+    await db.commit()
+    reference_cache.invalidate("configs")
+    summary_cache.invalidate()
+    rendered_config_cache.invalidate(config_id)
+    return await get_config(db, config_id)
+
+async def get_config_versions(db: AsyncSession, config_id: int, version: int = None, with_content: bool = False):
+    """История конфигурации от новых версий к старым; содержимое — только если with_content"""
+    columns = [
+        models.ConfigVersion.version, models.ConfigVersion.content_hash,
+        models.ConfigBlob.size, models.ConfigVersion.created_at,
+    ]
+    if with_content:
+        columns.append(models.ConfigBlob.data)
+    query = (
+        select(*columns)
+        .join(models.ConfigBlob, models.ConfigVersion.content_hash == models.ConfigBlob.hash)
+        .where(models.ConfigVersion.config_id == config_id)
+        .order_by(models.ConfigVersion.version.desc())
+    )
+    if version is not None:
+        query = query.where(models.ConfigVersion.version == version)
+    versions = []
+    for row in (await db.execute(query)).mappings():
+        item = dict(row)
+        if with_content:
+            item["content"] = models.ConfigBlob.unpack(item.pop("data"))
+        versions.append(item)
+    return versions
+
+async def get_config_version(db: AsyncSession, config_id: int, version: int):
+    versions = await get_config_versions(db, config_id, version=version, with_content=True)
+    return versions[0] if versions else None
+
+async def rollback_config(db: AsyncSession, config_id: int, version: int):
+    """Возврат к содержимому прежней версии; откат записывается в историю новой версией"""
+    db_config = await get_config(db, config_id, with_content=False)
+    if not db_config:
+        return None
+    content_hash = await db.scalar(
+        select(models.ConfigVersion.content_hash)
+        .where(models.ConfigVersion.config_id == config_id, models.ConfigVersion.version == version)
+    )
+    if content_hash is None:
+        return None
+    if set_config_content(db_config, content_hash):
+        await db.flush()
+        await _record_version(db, config_id)
+        await db.commit()
+        reference_cache.invalidate("configs")
+        summary_cache.invalidate()
+        rendered_config_cache.invalidate(config_id)
+    return await get_config(db, config_id)
+
+async def delete_config(db: AsyncSession, config_id: int):
+    db_config = await db.get(models.Config, config_id)
+    if db_config:
+        # Сначала отвязываем устройства от конфигурации
+        await db.execute(
+            update(models.Device).where(models.Device.config_id == config_id).values(config_id=None)
+        )
+        # История удаляется явно: SQLite не соблюдает ON DELETE CASCADE без PRAGMA foreign_keys.
+        # Содержимое в config_blobs остаётся — оно может быть общим с другими конфигурациями
+        await db.execute(delete(models.ConfigVersion).where(models.ConfigVersion.config_id == config_id))
+        await db.delete(db_config)
+        await db.commit()
+        reference_cache.invalidate("configs")
+        summary_cache.invalidate()
+        rendered_config_cache.invalidate(config_id)
+        return True
+    return False
@@ -0,0 +1,289 @@
+# ydm/app/cache.py
+import asyncio
+import gzip
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy import case, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models, settings
+from .events import event_bus
+
+
+class ModelOption(NamedTuple):
+    """Модель устройства для выпадающих списков"""
+    id: int
+    name: str
+    firmware: Optional[str]
+
+
+class ConfigOption(NamedTuple):
+    """Конфигурация для выпадающих списков, без XML-содержимого"""
+    id: int
+    name: str
+
+
+class ReferenceCache:
+    """Кэш справочников (модели и конфигурации) для форм.
+
+    Сбрасывается функциями crud при изменении моделей и конфигураций;
+    TTL страхует от изменений, сделанных другими процессами.
+    """
+
+    def __init__(self, ttl: float = None):
+        self.ttl = ttl if ttl is not None else settings.REFERENCE_CACHE_TTL
+        self._entries = {}  # имя справочника -> (время загрузки, список)
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, name: str):
+        entry = self._entries.get(name)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def _put(self, name: str, items: list) -> list:
+        self._entries[name] = (time.monotonic(), items)
+        return items
+
+    async def device_models(self, db: AsyncSession) -> List[ModelOption]:
+        items = self._get("device_models")
+        if items is None:
+            rows = await db.execute(
+                select(models.DeviceModel.id, models.DeviceModel.name, models.DeviceModel.firmware)
+                .order_by(models.DeviceModel.name)
+            )
+            items = self._put("device_models", [ModelOption(*row) for row in rows])
+        return items
+
+    async def configs(self, db: AsyncSession) -> List[ConfigOption]:
+        items = self._get("configs")
+        if items is None:
+            rows = await db.execute(
+                select(models.Config.id, models.Config.name).order_by(models.Config.name)
+            )
+            items = self._put("configs", [ConfigOption(*row) for row in rows])
+        return items
+
+    def invalidate(self, name: str = None):
+        """Сброс одного справочника или всех сразу"""
+        if name is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(name, None)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "cached": sorted(self._entries)}
+
+
+reference_cache = ReferenceCache()
+
+
+@dataclass
+class RenderedConfig:
+    """Готовый к отдаче файл конфигурации"""
+    version: object  # Config.content_hash (для шаблонов — вместе с отпечатком переменных устройства)
+    etag: str
+    body: bytes
+    gzip_body: bytes
+
+
+class RenderedConfigCache:
+    """LRU-кэш отрендеренных конфигураций для автопровижининга.
+
+    Обычная конфигурация хранится одна на все устройства, шаблон — по
+    записи на устройство.
+    """
+
+    def __init__(self, max_size: int = None):
+        self.max_size = max_size or settings.PROVISION_CACHE_SIZE
+        self._items: "OrderedDict[int, RenderedConfig]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, count_miss: bool = True) -> Optional[RenderedConfig]:
+        """key — id конфигурации, для шаблонов (id конфигурации, id устройства).
+        count_miss=False — промах не учитывается: за ним последует ещё один поиск"""
+        item = self._items.get(key)
+        if item is None or item.version != version:
+            self.misses += count_miss
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item
+
+    def put(self, key, version, content: str) -> RenderedConfig:
+        body = (content or "").encode("utf-8")
+        item = RenderedConfig(
+            version=version,
+            etag=f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+            body=body,
+            gzip_body=gzip.compress(body),
+        )
+        self._items[key] = item
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return item
+
+    def invalidate(self, config_id: int = None):
+        if config_id is None:
+            self._items.clear()
+            return
+        self._items.pop(config_id, None)
+        for key in [key for key in self._items if isinstance(key, tuple) and key[0] == config_id]:
+            del self._items[key]
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._items)}
+
+
+rendered_config_cache = RenderedConfigCache()
+
+
+class SummaryCache:
+    """Сводка для главной страницы, посчитанная агрегатами SQL.
+
+    Сбрасывается при записи устройств, моделей и конфигураций (crud), при
+    новых статусах и результатах команд (on_event), в том числе пришедших
+    из других процессов через event_relay; TTL страхует от изменений в
+    обход приложения. Одновременные запросы после сброса дожидаются
+    одного пересчёта.
+    """
+
+    def __init__(self, ttl: float = None):
+        self.ttl = ttl if ttl is not None else settings.DASHBOARD_CACHE_TTL
+        self._entry = None  # (время расчёта, сводка)
+        self._generation = 0  # Растёт при каждом сбросе
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _fresh(self) -> Optional[dict]:
+        if self._entry is not None and time.monotonic() - self._entry[0] < self.ttl:
+            return self._entry[1]
+        return None
+
+    async def summary(self, db: AsyncSession) -> dict:
+        summary = self._fresh()
+        if summary is not None:
+            self.hits += 1
+            return summary
+        async with self._lock:
+            summary = self._fresh()
+            if summary is None:
+                self.misses += 1
+                generation, started = self._generation, time.monotonic()
+                summary = await self._compute(db)
+                # Сброс во время расчёта не должен потеряться: такую сводку не сохраняем
+                if generation == self._generation:
+                    self._entry = (started, summary)
+            else:
+                self.hits += 1
+        return summary
+
+    async def _compute(self, db: AsyncSession) -> dict:
+        now = models.utcnow()
+        stale_before = now - timedelta(seconds=settings.DASHBOARD_STALE_SECONDS)
+        failures_since = now - timedelta(hours=settings.DASHBOARD_FAILURES_HOURS)
+        device = models.Device
+
+        status = (await db.execute(select(
+            func.count(),
+            func.count(case((device.registered.is_(True), 1))),
+            func.count(case((device.registered.is_(False), 1))),
+            func.count(case((device.status_at.is_(None), 1))),
+            func.count(case((device.status_at < stale_before, 1))),
+            func.count(case((device.config_id.is_(None), 1))),
+        ))).one()
+
+        by_model = await db.execute(
+            select(device.model_id, models.DeviceModel.name, func.count().label("devices"))
+            .select_from(device)
+            .outerjoin(models.DeviceModel, device.model_id == models.DeviceModel.id)
+            .group_by(device.model_id, models.DeviceModel.name)
+            .order_by(func.count().desc())
+            .limit(settings.DASHBOARD_TOP)
+        )
+        by_config = await db.execute(
+            select(device.config_id, models.Config.name, func.count().label("devices"))
+            .select_from(device)
+            .join(models.Config, device.config_id == models.Config.id)
+            .group_by(device.config_id, models.Config.name)
+            .order_by(func.count().desc())
+            .limit(settings.DASHBOARD_TOP)
+        )
+
+        job = models.CommandJob
+        jobs = dict((await db.execute(
+            select(job.status, func.count()).where(job.status.in_(("queued", "running"))).group_by(job.status)
+        )).all())
+        failed_jobs = await db.scalar(
+            select(func.count()).select_from(job).where(job.status == "failed", job.finished_at >= failures_since)
+        )
+        recent_failures = await db.execute(
+            select(job.id, job.device_id, device.mac_address, job.command, job.result, job.finished_at)
+            .join(device, job.device_id == device.id)
+            .where(job.status == "failed", job.finished_at >= failures_since)
+            .order_by(job.finished_at.desc())
+            .limit(settings.DASHBOARD_RECENT_FAILURES)
+        )
+
+        return {
+            "generated_at": now,
+            "devices": status[0],
+            "device_models": await db.scalar(select(func.count()).select_from(models.DeviceModel)),
+            "configs": await db.scalar(select(func.count()).select_from(models.Config)),
+            "registered": status[1],
+            "unregistered": status[2],
+            "never_polled": status[3],
+            "stale": status[4],
+            "without_config": status[5],
+            "by_model": [
+                {"id": row.model_id, "name": row.name, "devices": row.devices} for row in by_model
+            ],
+            "by_config": [
+                {"id": row.config_id, "name": row.name, "devices": row.devices} for row in by_config
+            ],
+            "jobs_queued": jobs.get("queued", 0),
+            "jobs_running": jobs.get("running", 0),
+            "jobs_failed": failed_jobs,
+            "recent_failures": [
+                {
+                    "job_id": row.id,
+                    "device_id": row.device_id,
+                    "mac_address": row.mac_address,
+                    "command": row.command,
+                    "result": (row.result or "")[:200],
+                    "finished_at": row.finished_at,
+                }
+                for row in recent_failures
+            ],
+        }
+
+    def _reset(self):
+        self._entry = None
+        self._generation += 1
+
+    def invalidate(self):
+        """Сброс после записи в БД; через шину событий сводка сбрасывается и в других процессах"""
+        self._reset()
+        event_bus.publish("summary_invalidated", {})
+
+    def on_event(self, kind: str, data: dict):
+        """Подписчик шины событий: новые статусы, завершённые команды и сбросы в других процессах"""
+        if kind in ("device_status", "summary_invalidated") or (kind == "command_job" and data.get("status") != "running"):
+            self._reset()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "cached": self._entry is not None}
+
+
+summary_cache = SummaryCache()
@@ -0,0 +1,133 @@
+# ydm/app/config_push.py
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app import metrics, models, settings, utils
+from app.config_xml import changed_keys, config_hash, parse_config_keys, render_delta
+from app.database import AsyncSessionLocal
+
+
+@dataclass
+class PushResult:
+    """Итог отправки конфигурации на телефон"""
+    mode: str  # full, delta или unchanged (ничего не отправлено)
+    content_hash: str  # Хэш конфигурации, которая теперь применена на телефоне
+    keys: Optional[int]  # Отправлено ключей (для дельты)
+    sent_bytes: int
+    response: str
+
+
+class ConfigPusher:
+    """Отправка конфигураций с учётом того, что уже применено на телефоне.
+
+    Содержимое каждой отправленной версии сохраняется (сжатым) в config_blobs
+    по хэшу. Если на телефоне уже эта версия, запрос не делается; если другая,
+    известная версия — отправляются только добавленные и изменённые ключи.
+    Версии и дельты кэшируются: при рассылке одной правки на тысячи
+    телефонов дельта считается один раз.
+    """
+
+    def __init__(self, cache_size: int = None):
+        self.cache_size = cache_size or settings.CONFIG_PUSH_CACHE_SIZE
+        self._contents: "OrderedDict[str, str]" = OrderedDict()  # Хэш -> содержимое, уже записанное в БД
+        self._deltas: "OrderedDict[Tuple[str, str], Optional[Tuple[str, int]]]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Task] = {}
+
+    def _remember(self, cache: OrderedDict, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    async def _once(self, key: str, factory: Callable[[], Awaitable]):
+        """Одно обращение к БД на хэш, сколько бы отправок его ни ждали"""
+        task = self._pending.get(key)
+        if task is None:
+            task = self._pending[key] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def content(self, content_hash: str) -> Optional[str]:
+        if content_hash in self._contents:
+            self._contents.move_to_end(content_hash)
+            return self._contents[content_hash]
+
+        async def load():
+            async with AsyncSessionLocal() as db:
+                blob = await db.get(models.ConfigBlob, content_hash)
+            if blob is not None:
+                self._remember(self._contents, content_hash, blob.content)
+                return blob.content
+            return None
+
+        return await self._once(f"get:{content_hash}", load)
+
+    async def store(self, content_hash: str, content: str):
+        if content_hash in self._contents:
+            return
+
+        async def save():
+            async with AsyncSessionLocal() as db:
+                insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+                await db.execute(
+                    insert(models.ConfigBlob)
+                    .values(**models.ConfigBlob.pack(content))
+                    .on_conflict_do_nothing(index_elements=[models.ConfigBlob.hash])
+                )
+                await db.commit()
+            self._remember(self._contents, content_hash, content)
+
+        await self._once(f"put:{content_hash}", save)
+
+    def delta(self, base_hash: str, base: str, new_hash: str, content: str) -> Optional[Tuple[str, int]]:
+        """Дельта и число изменённых ключей; None, если одна из версий не разбирается как XML"""
+        key = (base_hash, new_hash)
+        if key not in self._deltas:
+            base_keys, new_keys = parse_config_keys(base), parse_config_keys(content)
+            result = None
+            if base_keys is not None and new_keys is not None:
+                keys = changed_keys(base_keys, new_keys)
+                result = (render_delta(content, keys) if keys else "", len(keys))
+            self._remember(self._deltas, key, result)
+        return self._deltas[key]
+
+    async def push(self, device: models.Device, content: str, force: bool = False) -> PushResult:
+        """Отправка content на телефон полностью, дельтой или никак; состояние устройства не меняет"""
+        content = content or ""
+        new_hash = config_hash(content)
+        base_hash = device.applied_config_hash
+        if not force and base_hash == new_hash:
+            return self._result("unchanged", new_hash, 0, 0, "Config already applied")
+
+        # Версия сохраняется до отправки: следующая дельта для этого телефона считается от неё
+        await self.store(new_hash, content)
+        payload, mode, keys = content, "full", None
+        base = await self.content(base_hash) if base_hash and not force else None
+        diff = self.delta(base_hash, base, new_hash, content) if base is not None else None
+        if diff is not None:
+            delta, changed = diff
+            if not changed:
+                # Отличия только в форматировании или удалённых ключах: телефону нечего менять
+                return self._result("unchanged", new_hash, 0, 0, "No changed keys")
+            if len(delta) < len(content):
+                payload, mode, keys = delta, "delta", changed
+
+        response = await utils.get_yealink_client().apply_config(device, payload)
+        return self._result(mode, new_hash, keys, len(payload.encode("utf-8")), response)
+
+    @staticmethod
+    def _result(mode: str, content_hash: str, keys: Optional[int], sent_bytes: int, response: str) -> PushResult:
+        metrics.config_push_total.labels(mode).inc()
+        metrics.config_push_bytes.labels(mode).inc(sent_bytes)
+        return PushResult(mode=mode, content_hash=content_hash, keys=keys, sent_bytes=sent_bytes, response=response)
+
+    def stats(self) -> dict:
+        return {"cached_versions": len(self._contents), "cached_deltas": len(self._deltas)}
+
+
+config_pusher = ConfigPusher()
@@ -0,0 +1,149 @@
+# ydm/app/config_templates.py
+import hashlib
+import json
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Tuple
+
+from jinja2 import StrictUndefined, TemplateError
+from jinja2.sandbox import SandboxedEnvironment
+
+from app import models, settings
+
+# Признаки синтаксиса Jinja: без них конфигурация отдаётся как есть, без компиляции
+_TEMPLATE_MARKERS = ("{{", "{%", "{#")
+
+
+class ConfigTemplateError(ValueError):
+    """Шаблон конфигурации не компилируется или не хватает переменных устройства"""
+
+
+@dataclass
+class CompiledConfig:
+    """Скомпилированная конфигурация; static — обычный XML без подстановок"""
+    content_hash: str
+    static: bool
+    source: str
+    template: object = None
+
+
+def device_context(
+    device_id: int, mac_address: str, ip_address: str, model: Optional[str], variables: Optional[dict]
+) -> dict:
+    """Переменные шаблона: собственные переменные устройства и сведения о нём в device"""
+    context = dict(variables or {})
+    context["device"] = {
+        "id": device_id,
+        "mac_address": mac_address,
+        "mac": (mac_address or "").replace(":", "").lower(),  # Как в именах файлов автопровижининга
+        "ip_address": ip_address,
+        "model": model,
+    }
+    return context
+
+
+def context_for(device: models.Device) -> dict:
+    """Контекст для устройства из ORM (модель должна быть загружена)"""
+    variables = json.loads(device.variables) if device.variables else None
+    model = device.model.name if device.model is not None else None
+    return device_context(device.id, device.mac_address, device.ip_address, model, variables)
+
+
+def context_fingerprint(context: dict) -> str:
+    return hashlib.sha256(json.dumps(context, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class ConfigTemplates:
+    """Компиляция и рендеринг конфигураций-шаблонов Jinja2.
+
+    Шаблон компилируется один раз на содержимое (ключ — хэш), результат
+    рендеринга кэшируется по паре (хэш шаблона, отпечаток переменных), поэтому
+    правка конфигурации или переменных устройства сама даёт новый ключ.
+    Шаблоны исполняются в песочнице, значения экранируются для XML, а
+    неизвестная переменная — ошибка, а не пустая строка.
+    """
+
+    def __init__(self, compiled_size: int = None, rendered_size: int = None):
+        self.compiled_size = compiled_size or settings.TEMPLATE_CACHE_SIZE
+        self.rendered_size = rendered_size or settings.TEMPLATE_RENDER_CACHE_SIZE
+        self.environment = SandboxedEnvironment(autoescape=True, undefined=StrictUndefined, keep_trailing_newline=True)
+        self._compiled: "OrderedDict[str, CompiledConfig]" = OrderedDict()
+        self._rendered: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        self.compiles = 0
+        self.renders = 0
+        self.render_hits = 0
+
+    @staticmethod
+    def _remember(cache: OrderedDict, key, value, max_size: int):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+
+    def compile(self, content: Optional[str]) -> CompiledConfig:
+        content = content or ""
+        content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        compiled = self._compiled.get(content_hash)
+        if compiled is not None:
+            self._compiled.move_to_end(content_hash)
+            return compiled
+        if not any(marker in content for marker in _TEMPLATE_MARKERS):
+            compiled = CompiledConfig(content_hash, True, content)
+        else:
+            try:
+                template = self.environment.from_string(content)
+            except TemplateError as e:
+                raise ConfigTemplateError(f"Template syntax error: {str(e)}")
+            self.compiles += 1
+            compiled = CompiledConfig(content_hash, False, content, template)
+        self._remember(self._compiled, content_hash, compiled, self.compiled_size)
+        return compiled
+
+    def render(self, content: Optional[str], context: dict) -> str:
+        compiled = self.compile(content)
+        if compiled.static:
+            return compiled.source
+        key = (compiled.content_hash, context_fingerprint(context))
+        rendered = self._rendered.get(key)
+        if rendered is not None:
+            self._rendered.move_to_end(key)
+            self.render_hits += 1
+            return rendered
+        try:
+            rendered = compiled.template.render(context)
+        except TemplateError as e:
+            raise ConfigTemplateError(f"Template error for device {context['device']['mac_address']}: {str(e)}")
+        self.renders += 1
+        self._remember(self._rendered, key, rendered, self.rendered_size)
+        return rendered
+
+    def render_for(self, content: Optional[str], device: models.Device) -> str:
+        return self.render(content, context_for(device))
+
+    def render_many(
+        self, content: Optional[str], devices: Iterable[models.Device]
+    ) -> Tuple[Dict[int, str], Dict[int, str]]:
+        """Рендеринг для многих устройств одним проходом: (device_id -> XML, device_id -> ошибка)"""
+        rendered, errors = {}, {}
+        compiled = self.compile(content)
+        for device in devices:
+            if compiled.static:
+                rendered[device.id] = compiled.source
+                continue
+            try:
+                rendered[device.id] = self.render(content, context_for(device))
+            except ConfigTemplateError as e:
+                errors[device.id] = str(e)
+        return rendered, errors
+
+    def stats(self) -> dict:
+        return {
+            "compiled": len(self._compiled),
+            "rendered": len(self._rendered),
+            "compiles": self.compiles,
+            "renders": self.renders,
+            "render_hits": self.render_hits,
+        }
+
+
+config_templates = ConfigTemplates()
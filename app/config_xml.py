@@ -0,0 +1,120 @@
+# ydm/app/config_xml.py
+import difflib
+import hashlib
+import re
+from typing import Dict, List, Optional, Set, Tuple
+from xml.etree import ElementTree
+
+# Строка вида "account.1.sip_server.1.address = 10.0.0.1" внутри элемента (формат <Item> Yealink)
+_ITEM_LINE = re.compile(r"^\s*([A-Za-z0-9_.\-\[\]]+)\s*=\s*(.*?)\s*$", re.S)
+
+
+def config_hash(content: Optional[str]) -> str:
+    """Хэш содержимого конфигурации, по которому сравнивается применённая на телефоне версия"""
+    return hashlib.sha256((content or "").encode("utf-8")).hexdigest()
+
+
+def _walk(element: ElementTree.Element, path: str, found: List[Tuple[str, str, ElementTree.Element]]):
+    """Пары (ключ, значение) элемента и его потомков вместе с элементом, который их задаёт"""
+    for name, value in sorted(element.attrib.items()):
+        found.append((f"{path}@{name}", value, element))
+    children = list(element)
+    if not children:
+        text = (element.text or "").strip()
+        item = _ITEM_LINE.match(text)
+        if item is not None:
+            found.append((item.group(1), item.group(2), element))
+        elif path:
+            found.append((path, text, element))
+        return
+    counts: Dict[str, int] = {}
+    for child in children:
+        counts[child.tag] = counts.get(child.tag, 0) + 1
+    seen: Dict[str, int] = {}
+    for child in children:
+        name = child.tag
+        if counts[name] > 1:
+            seen[name] = seen.get(name, 0) + 1
+            name = f"{name}[{seen[name]}]"
+        _walk(child, f"{path}/{name}" if path else name, found)
+
+
+def _is_item(element: ElementTree.Element) -> bool:
+    return len(element) == 0 and _ITEM_LINE.match((element.text or "").strip()) is not None
+
+
+def _parse(content: Optional[str]) -> Optional[ElementTree.Element]:
+    try:
+        return ElementTree.fromstring(content or "")
+    except ElementTree.ParseError:
+        return None
+
+
+def parse_config_keys(content: Optional[str]) -> Optional[Dict[str, str]]:
+    """Ключи конфигурации: строки "ключ = значение" из <Item> или путь листового элемента
+    (с атрибутами как путь@атрибут). None, если содержимое не XML."""
+    root = _parse(content)
+    if root is None:
+        return None
+    found: List[Tuple[str, str, ElementTree.Element]] = []
+    _walk(root, "", found)
+    return {key: value for key, value, _ in found}
+
+
+def changed_keys(base: Dict[str, str], new: Dict[str, str]) -> Set[str]:
+    """Добавленные и изменённые ключи. Удалённые не учитываются: телефон сохраняет
+    прежнее значение и при полной отправке"""
+    return {key for key, value in new.items() if base.get(key) != value}
+
+
+def render_delta(content: str, keys: Set[str]) -> Optional[str]:
+    """XML только с элементами, задающими keys; структура и порядок как в content"""
+    root = _parse(content)
+    if root is None:
+        return None
+    found: List[Tuple[str, str, ElementTree.Element]] = []
+    _walk(root, "", found)
+    keep = {id(element) for key, _, element in found if key in keys}
+    needed: Set[int] = set()
+
+    def mark(element: ElementTree.Element) -> bool:
+        """Нужен ли элемент в дельте: сам задаёт изменённый ключ или содержит такие"""
+        if any([mark(child) for child in element]) or id(element) in keep:
+            needed.add(id(element))
+            return True
+        return False
+
+    def prune(element: ElementTree.Element):
+        children = list(element)
+        # Повторяющиеся элементы значимы по позиции: нужен один — группа отправляется целиком.
+        # Строки <Item> адресуются своим ключом, их это не касается
+        tags = {child.tag for child in children if id(child) in needed and not _is_item(child)}
+        for child in children:
+            if id(child) in needed:
+                prune(child)
+            elif child.tag not in tags:
+                element.remove(child)
+
+    mark(root)
+    prune(root)
+    body = ElementTree.tostring(root, encoding="unicode")
+    declaration = content.lstrip().startswith("<?xml")
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n' + body) if declaration else body
+
+
+def diff_configs(base: Optional[str], new: Optional[str]) -> dict:
+    """Добавленные, удалённые и изменённые ключи (None, если одна из версий не XML) и построчный diff"""
+    base_keys, new_keys = parse_config_keys(base), parse_config_keys(new)
+    result = {"added": None, "removed": None, "changed": None}
+    if base_keys is not None and new_keys is not None:
+        result["added"] = {key: value for key, value in new_keys.items() if key not in base_keys}
+        result["removed"] = {key: value for key, value in base_keys.items() if key not in new_keys}
+        result["changed"] = {
+            key: {"old": base_keys[key], "new": value}
+            for key, value in new_keys.items() if key in base_keys and base_keys[key] != value
+        }
+    lines = difflib.unified_diff(
+        (base or "").splitlines(keepends=True), (new or "").splitlines(keepends=True), "base", "new"
+    )
+    result["diff"] = "".join(lines)
+    return result
@@ -1,13 +1,21 @@
 # ydm/app/crud.py
-from sqlalchemy.orm import Session
+from sqlalchemy import case, func, or_, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, selectinload
 from . import models, schemas
-from datetime import datetime, timezone
+from .config_xml import parse_config_keys
+from .cache import reference_cache, rendered_config_cache, summary_cache
+from datetime import datetime, timedelta, timezone
+import ipaddress
 
 # По работе с моделями устройств
 def create_device_model(db: Session, model: schemas.DeviceModelCreate):
     db_model = models.DeviceModel(**model.model_dump())
     db.add(db_model)
     db.commit()
+    reference_cache.invalidate("device_models")
+    summary_cache.invalidate()
     db.refresh(db_model)
     return db_model
 
@@ -27,6 +35,8 @@ def update_device_model(db: Session, model_id: int, model_data: schemas.DeviceMo
         setattr(db_model, key, value)
     
     db.commit()
+    reference_cache.invalidate("device_models")
+    summary_cache.invalidate()
     db.refresh(db_model)
     return db_model
 
@@ -35,10 +45,22 @@ def delete_device_model(db: Session, model_id: int):
     if db_model:
         db.delete(db_model)
         db.commit()
+        reference_cache.invalidate("device_models")
+        summary_cache.invalidate()
         return True
     return False
 
 # По работе с устройствами
+
+# Связи для списков: фиксированное число запросов, XML конфигурации не загружается
+def device_list_relations(with_config_content: bool = False):
+    config_loader = selectinload(models.Device.config)
+    if with_config_content:
+        config_loader = config_loader.selectinload(models.Config.blob)
+    else:
+        config_loader = config_loader.load_only(models.Config.id, models.Config.name)
+    return (selectinload(models.Device.model), config_loader)
+
 def create_device(db: Session, device: schemas.DeviceCreate):
 
     # Создаём словарь данных, исключая необязательные поля
@@ -54,17 +76,108 @@ def create_device(db: Session, device: schemas.DeviceCreate):
     
     db.add(db_device)
     db.commit()
+    summary_cache.invalidate()
     db.refresh(db_device)
     return db_device
 
+def upsert_devices_query(dialect_name: str, update_fields: tuple):
+    """Пакетная вставка устройств; при совпадении MAC обновляются update_fields"""
+    insert = postgresql_insert if dialect_name == "postgresql" else sqlite_insert
+    query = insert(models.Device)
+    return query.on_conflict_do_update(
+        index_elements=[models.Device.mac_address],
+        set_={**{field: query.excluded[field] for field in update_fields}, "updated_at": func.now()}
+    )
+
+def upsert_devices(db: Session, rows: list, update_fields: tuple):
+    if not rows:
+        return
+    db.execute(upsert_devices_query(db.get_bind().dialect.name, update_fields), rows)
+    db.commit()
+    summary_cache.invalidate()
+
 def get_device(db: Session, device_id: int):
     return db.query(models.Device).filter(models.Device.id == device_id).first()
 
 def get_device_by_mac(db: Session, mac_address: str):
-    return db.query(models.Device).filter(models.Device.mac_address == mac_address).first()
+    return db.query(models.Device).filter(models.Device.mac_address == models.normalize_mac(mac_address)).first()
+
+def get_devices(db: Session, skip: int = 0, limit: int = 100, filters: schemas.DeviceFilter = None):
+    if filters is not None:
+        query = devices_page_query(filters, limit=limit).offset(skip).options(*device_list_relations())
+        return db.scalars(query).all()
+    return db.query(models.Device).options(*device_list_relations()).offset(skip).limit(limit).all()
+
+def _subnet_clause(subnet: str):
+    network = ipaddress.IPv4Network(subnet, strict=False)
+    return models.Device.ip_int.between(int(network.network_address), int(network.broadcast_address))
 
-def get_devices(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Device).offset(skip).limit(limit).all()
+def devices_selector_query(selector: schemas.DeviceSelector):
+    query = select(models.Device)
+    if selector.device_ids is not None:
+        query = query.where(models.Device.id.in_(selector.device_ids))
+    if selector.model_id is not None:
+        query = query.where(models.Device.model_id == selector.model_id)
+    if selector.config_id is not None:
+        query = query.where(models.Device.config_id == selector.config_id)
+    if selector.ip_range:
+        query = query.where(_subnet_clause(selector.ip_range))
+    return query
+
+def get_devices_by_selector(db: Session, selector: schemas.DeviceSelector):
+    return db.scalars(devices_selector_query(selector)).all()
+
+def devices_page_query(filters: schemas.DeviceFilter, cursor: int = None, limit: int = 100):
+    """Запрос страницы устройств по ключу (id > cursor): стоимость не зависит от глубины"""
+    query = select(models.Device)
+    if cursor is not None:
+        query = query.where(models.Device.id > cursor)
+    if filters.model_id is not None:
+        query = query.where(models.Device.model_id == filters.model_id)
+    if filters.config_id is not None:
+        query = query.where(models.Device.config_id == filters.config_id)
+    if filters.mac_prefix:
+        # Диапазон вместо LIKE, чтобы использовался индекс по mac_address
+        prefix = models.normalize_mac_prefix(filters.mac_prefix)
+        query = query.where(models.Device.mac_address >= prefix, models.Device.mac_address < prefix + "\uffff")
+    if filters.subnet:
+        query = query.where(_subnet_clause(filters.subnet))
+    if filters.registered is not None:
+        query = query.where(models.Device.registered == filters.registered)
+    if filters.firmware is not None:
+        query = query.where(models.Device.firmware == filters.firmware)
+    if filters.fresh_within is not None:
+        query = query.where(models.Device.status_at >= models.utcnow() - timedelta(seconds=filters.fresh_within))
+    if filters.stale_for is not None:
+        threshold = models.utcnow() - timedelta(seconds=filters.stale_for)
+        query = query.where(or_(models.Device.status_at.is_(None), models.Device.status_at < threshold))
+    return query.order_by(models.Device.id).limit(limit)
+
+def get_devices_page(
+    db: Session, filters: schemas.DeviceFilter, cursor: int = None, limit: int = 100,
+    with_config_content: bool = False
+):
+    query = devices_page_query(filters, cursor, limit).options(*device_list_relations(with_config_content))
+    return db.scalars(query).all()
+
+def get_status_history(db: Session, device_id: int, registered: bool = None, limit: int = 100):
+    """История статусов устройства, новые записи первыми"""
+    return db.scalars(status_history_query(device_id, registered, limit)).all()
+
+def command_jobs_query(device_id: int = None, status: str = None, limit: int = 100):
+    """Задания команд, новые первыми"""
+    query = select(models.CommandJob)
+    if device_id is not None:
+        query = query.where(models.CommandJob.device_id == device_id)
+    if status is not None:
+        query = query.where(models.CommandJob.status == status)
+    return query.order_by(models.CommandJob.id.desc()).limit(limit)
+
+def status_history_query(device_id: int, registered: bool = None, limit: int = 100):
+    query = select(models.DeviceStatusHistory).where(models.DeviceStatusHistory.device_id == device_id)
+    if registered is not None:
+        query = query.where(models.DeviceStatusHistory.registered == registered)
+    return query.order_by(models.DeviceStatusHistory.recorded_at.desc()).limit(limit)
 
 def update_device(db: Session, device_id: int, device_data: schemas.DeviceBase):
     db_device = db.query(models.Device).filter(models.Device.id == device_id).first()
@@ -76,41 +189,202 @@ def update_device(db: Session, device_id: int, device_data: schemas.DeviceBase):
         setattr(db_device, key, value)
     
     db.commit()
+    summary_cache.invalidate()
     db.refresh(db_device)
     return db_device
 
 def delete_device(db: Session, device_id: int):
     db_device = db.query(models.Device).filter(models.Device.id == device_id).first()
     if db_device:
+        # История и задания удаляются явно: SQLite не соблюдает ON DELETE CASCADE без PRAGMA foreign_keys
+        db.query(models.DeviceStatusHistory).filter(models.DeviceStatusHistory.device_id == device_id).delete()
+        db.query(models.CommandJob).filter(models.CommandJob.device_id == device_id).delete()
         db.delete(db_device)
         db.commit()
+        summary_cache.invalidate()
         return True
     return False
 
 # По работе с конфигами
+
+# Содержимое конфигураций хранится сжатым в config_blobs по хэшу, в configs — только хэш
+# и номер версии. Каждая версия записывается в config_versions для сравнения и отката
+def insert_blobs_query(dialect_name: str):
+    """Пакетная вставка содержимого; уже сохранённое (тот же хэш) пропускается"""
+    insert = postgresql_insert if dialect_name == "postgresql" else sqlite_insert
+    return insert(models.ConfigBlob).on_conflict_do_nothing(index_elements=[models.ConfigBlob.hash])
+
+def record_versions_query(dialect_name: str, condition):
+    """Запись текущих версий выбранных конфигураций в историю; уже записанные пропускаются"""
+    insert = postgresql_insert if dialect_name == "postgresql" else sqlite_insert
+    current = select(
+        models.Config.id, models.Config.version, models.Config.content_hash, func.now()
+    ).where(condition)
+    return insert(models.ConfigVersion).from_select(
+        ["config_id", "version", "content_hash", "created_at"], current
+    ).on_conflict_do_nothing(index_elements=[models.ConfigVersion.config_id, models.ConfigVersion.version])
+
+def config_key_rows(content_hash: str, content: str) -> list:
+    """Строки config_keys для содержимого; ключи и значения длиннее колонок
+    (сертификаты, длинные списки) не индексируются"""
+    max_key, max_value = models.ConfigKey.key.type.length, models.ConfigKey.value.type.length
+    return [
+        {"content_hash": content_hash, "key": key, "value": value}
+        for key, value in (parse_config_keys(content) or {}).items()
+        if len(key) <= max_key and len(value) <= max_value
+    ]
+
+def insert_config_keys_query(dialect_name: str):
+    insert = postgresql_insert if dialect_name == "postgresql" else sqlite_insert
+    return insert(models.ConfigKey).on_conflict_do_nothing(
+        index_elements=[models.ConfigKey.content_hash, models.ConfigKey.key]
+    )
+
+def set_config_content(db_config: models.Config, content_hash: str) -> bool:
+    """Новое содержимое конфигурации (уже в config_blobs); False, если оно не изменилось"""
+    if db_config.content_hash == content_hash:
+        return False
+    db_config.content_hash = content_hash
+    db_config.version = (db_config.version or 0) + 1
+    return True
+
+def _store_content(db: Session, content: str) -> str:
+    dialect_name = db.get_bind().dialect.name
+    blob = models.ConfigBlob.pack(content)
+    db.execute(insert_blobs_query(dialect_name), [blob])
+    keys = config_key_rows(blob["hash"], content)
+    if keys:
+        db.execute(insert_config_keys_query(dialect_name), keys)
+    return blob["hash"]
+
+def _record_version(db: Session, config_id: int):
+    db.execute(record_versions_query(db.get_bind().dialect.name, models.Config.id == config_id))
+
 def create_config(db: Session, config: schemas.ConfigCreate):
-    db_config = models.Config(**config.model_dump())
+    config_data = config.model_dump()
+    content_hash = _store_content(db, config_data.pop("content"))
+    db_config = models.Config(**config_data, content_hash=content_hash, version=1)
     db.add(db_config)
+    db.flush()
+    _record_version(db, db_config.id)
     db.commit()
+    reference_cache.invalidate("configs")
+    summary_cache.invalidate()
     db.refresh(db_config)
     return db_config
 
+def upsert_configs_query(dialect_name: str):
+    """Пакетная вставка конфигураций; при совпадении имени обновляется содержимое,
+    а номер версии растёт, только если содержимое другое"""
+    insert = postgresql_insert if dialect_name == "postgresql" else sqlite_insert
+    query = insert(models.Config)
+    changed = models.Config.content_hash != query.excluded.content_hash
+    return query.on_conflict_do_update(
+        index_elements=[models.Config.name],
+        set_={
+            "content_hash": query.excluded.content_hash,
+            "version": case((changed, models.Config.version + 1), else_=models.Config.version),
+            "updated_at": func.now(),
+        }
+    )
+
+def config_upsert_rows(rows: list) -> tuple:
+    """Строки {name, content} -> строки config_blobs, config_keys и configs"""
+    blobs, keys = {}, []
+    configs = []
+    for row in rows:
+        blob = models.ConfigBlob.pack(row["content"])
+        if blob["hash"] not in blobs:
+            blobs[blob["hash"]] = blob
+            keys.extend(config_key_rows(blob["hash"], row["content"]))
+        configs.append({"name": row["name"], "content_hash": blob["hash"]})
+    return list(blobs.values()), keys, configs
+
+def upsert_configs(db: Session, rows: list):
+    if not rows:
+        return
+    dialect_name = db.get_bind().dialect.name
+    blobs, keys, configs = config_upsert_rows(rows)
+    db.execute(insert_blobs_query(dialect_name), blobs)
+    if keys:
+        db.execute(insert_config_keys_query(dialect_name), keys)
+    db.execute(upsert_configs_query(dialect_name), configs)
+    db.execute(record_versions_query(dialect_name, models.Config.name.in_([row["name"] for row in configs])))
+    db.commit()
+    reference_cache.invalidate("configs")
+    summary_cache.invalidate()
+    rendered_config_cache.invalidate()
+
+# Поиск по ключам конфигураций: один запрос по индексу (key, value), без чтения содержимого
+def config_key_configs_query(key: str, value: str = None):
+    """Конфигурации, текущая версия которых задаёт key (= value)"""
+    query = (
+        select(
+            models.Config.id.label("config_id"), models.Config.name.label("config_name"),
+            models.Config.version, models.ConfigKey.key, models.ConfigKey.value,
+        )
+        .join(models.ConfigKey, models.ConfigKey.content_hash == models.Config.content_hash)
+        .where(models.ConfigKey.key == key)
+    )
+    if value is not None:
+        query = query.where(models.ConfigKey.value == value)
+    return query.order_by(models.Config.id)
+
+def config_key_devices_query(key: str, value: str = None, cursor: int = None, limit: int = 100):
+    """Устройства, конфигурация которых задаёт key (= value); страницы по id > cursor"""
+    query = (
+        select(
+            models.Device.id.label("device_id"), models.Device.mac_address, models.Device.ip_address,
+            models.Config.id.label("config_id"), models.Config.name.label("config_name"), models.ConfigKey.value,
+        )
+        .join(models.Config, models.Device.config_id == models.Config.id)
+        .join(models.ConfigKey, models.ConfigKey.content_hash == models.Config.content_hash)
+        .where(models.ConfigKey.key == key)
+    )
+    if value is not None:
+        query = query.where(models.ConfigKey.value == value)
+    if cursor is not None:
+        query = query.where(models.Device.id > cursor)
+    return query.order_by(models.Device.id).limit(limit)
+
+def config_key_values_query(key: str):
+    """Значения key по всему парку: сколько конфигураций и устройств получают каждое"""
+    return (
+        select(
+            models.ConfigKey.value,
+            func.count(func.distinct(models.Config.id)).label("configs"),
+            func.count(models.Device.id).label("devices"),
+        )
+        .join(models.Config, models.Config.content_hash == models.ConfigKey.content_hash)
+        .outerjoin(models.Device, models.Device.config_id == models.Config.id)
+        .where(models.ConfigKey.key == key)
+        .group_by(models.ConfigKey.value)
+        .order_by(func.count(models.Device.id).desc(), models.ConfigKey.value)
+    )
+
 def get_configs(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.Config).offset(skip).limit(limit).all()
 
 def get_config(db: Session, config_id: int):
     return db.query(models.Config).filter(models.Config.id == config_id).first()
 
-def update_config(db: Session, config_id: int, config_data: schemas.ConfigBase):
+def update_config(db: Session, config_id: int, config_data: schemas.ConfigUpdate):
     db_config = db.query(models.Config).filter(models.Config.id == config_id).first()
     if not db_config:
         return None
     
     update_data = config_data.model_dump(exclude_unset=True)
+    content = update_data.pop("content", None)
     for key, value in update_data.items():
         setattr(db_config, key, value)
+    if content is not None and set_config_content(db_config, _store_content(db, content)):
+        db.flush()
+        _record_version(db, config_id)
     
     db.commit()
+    reference_cache.invalidate("configs")
+    summary_cache.invalidate()
+    rendered_config_cache.invalidate(config_id)
     db.refresh(db_config)
     return db_config
 
@@ -119,7 +393,13 @@ def delete_config(db: Session, config_id: int):
     if db_config:
         # Сначала отвязываем устройства от конфигурации
         db.query(models.Device).filter(models.Device.config_id == config_id).update({models.Device.config_id: None})
+        # История удаляется явно: SQLite не соблюдает ON DELETE CASCADE без PRAGMA foreign_keys.
+        # Содержимое в config_blobs остаётся — оно может быть общим с другими конфигурациями
+        db.query(models.ConfigVersion).filter(models.ConfigVersion.config_id == config_id).delete()
         db.delete(db_config)
         db.commit()
+        reference_cache.invalidate("configs")
+        summary_cache.invalidate()
+        rendered_config_cache.invalidate(config_id)
         return True
     return False
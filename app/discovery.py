@@ -0,0 +1,144 @@
+# ydm/app/discovery.py
+import asyncio
+import ipaddress
+import logging
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import select
+
+from app import async_crud, models, settings, utils
+from app.cache import reference_cache
+from app.database import AsyncSessionLocal
+from app.poll_scheduler import poll_scheduler
+from app.poller import run_bounded
+
+logger = logging.getLogger(__name__)
+
+# Поля, обновляемые у уже известных устройств при повторном обнаружении
+UPSERT_FIELDS = ("ip_address", "ip_int", "model_id", "firmware")
+
+
+@dataclass
+class DiscoveryJob:
+    """Задание на поиск телефонов в подсетях"""
+    id: str
+    cidrs: List[str]
+    status: str = "running"  # running, done, failed
+    total: int = 0
+    probed: int = 0
+    found: int = 0
+    stored: int = 0
+    error: Optional[str] = None
+    started_at: datetime = field(default_factory=models.utcnow)
+    finished_at: Optional[datetime] = None
+
+
+# Задания текущего процесса; хранятся до перезапуска
+discovery_jobs: Dict[str, DiscoveryJob] = {}
+_tasks: Set[asyncio.Task] = set()
+
+
+def _addresses(cidrs: List[str]):
+    for cidr in cidrs:
+        network = ipaddress.IPv4Network(cidr, strict=False)
+        # У /31 и /32 hosts() возвращает все адреса
+        yield from (str(ip) for ip in network.hosts())
+
+
+def count_addresses(cidrs: List[str]) -> int:
+    total = 0
+    for cidr in cidrs:
+        network = ipaddress.IPv4Network(cidr, strict=False)
+        total += network.num_addresses - 2 if network.prefixlen < 31 else network.num_addresses
+    return total
+
+
+class _ModelResolver:
+    """Сопоставление названия модели с DeviceModel; недостающие модели создаются"""
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+
+    async def load(self, db):
+        rows = await db.execute(select(models.DeviceModel.name, models.DeviceModel.id))
+        self._ids = {name.upper(): model_id for name, model_id in rows}
+
+    async def resolve(self, db, name: Optional[str], firmware: Optional[str]) -> Optional[int]:
+        if not name:
+            return None
+        model_id = self._ids.get(name.upper())
+        if model_id is None:
+            db_model = models.DeviceModel(name=name, firmware=firmware)
+            db.add(db_model)
+            await db.flush()
+            model_id = self._ids[name.upper()] = db_model.id
+            reference_cache.invalidate("device_models")
+        return model_id
+
+
+async def _store(db, resolver: _ModelResolver, found: List[dict]) -> int:
+    # Один MAC дважды в пачке (телефон ответил с двух адресов) ON CONFLICT в Postgres не принимает:
+    # остаётся последний ответ
+    rows = {}
+    for identity in found:
+        rows[identity["mac_address"]] = {
+            "mac_address": identity["mac_address"],
+            "ip_address": identity["ip_address"],
+            "ip_int": models.ip_to_int(identity["ip_address"]),
+            "username": identity["username"],
+            "password": identity["password"],
+            "model_id": await resolver.resolve(db, identity["model"], identity["firmware"]),
+            "firmware": identity["firmware"],
+        }
+    await async_crud.upsert_devices(db, list(rows.values()), UPSERT_FIELDS)
+    return len(rows)
+
+
+async def run_discovery(job: DiscoveryJob, username: str, password: str, concurrency: int = None):
+    """Опрос всех адресов подсетей и пакетная запись найденных телефонов"""
+    client = utils.get_yealink_client()
+    concurrency = concurrency or settings.DISCOVERY_CONCURRENCY
+
+    async def identify(ip_address: str):
+        probe = models.Device(ip_address=ip_address, username=username, password=password)
+        identity = utils.parse_identity(await client.get_status(probe))
+        if identity is not None:
+            identity.update(ip_address=ip_address, username=username, password=password)
+        return identity
+
+    try:
+        async with AsyncSessionLocal() as db:
+            resolver = _ModelResolver()
+            await resolver.load(db)
+            batch = []
+            async for outcome in run_bounded(_addresses(job.cidrs), identify, concurrency):
+                job.probed += 1
+                if outcome.ok and outcome.result is not None:
+                    job.found += 1
+                    batch.append(outcome.result)
+                    if len(batch) >= settings.DISCOVERY_BATCH_SIZE:
+                        job.stored += await _store(db, resolver, batch)
+                        batch.clear()
+            job.stored += await _store(db, resolver, batch)
+        # Новые устройства сразу попадают в расписание опроса
+        await poll_scheduler.sync()
+        job.status = "done"
+    except Exception as e:
+        logger.error(f"Discovery job {job.id} failed: {str(e)}")
+        job.status, job.error = "failed", str(e)
+    finally:
+        job.finished_at = models.utcnow()
+    logger.info(f"Discovery job {job.id}: {job.found} phones found of {job.probed} addresses")
+
+
+def start_discovery(cidrs: List[str], username: str, password: str, concurrency: int = None) -> DiscoveryJob:
+    job = DiscoveryJob(id=uuid.uuid4().hex, cidrs=cidrs, total=count_addresses(cidrs))
+    discovery_jobs[job.id] = job
+    # Ссылка на задачу хранится до её завершения, иначе сборщик мусора может прервать сканирование
+    task = asyncio.create_task(run_discovery(job, username, password, concurrency))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return job
@@ -0,0 +1,160 @@
+# ydm/app/event_relay.py
+import asyncio
+import json
+import logging
+import time
+from datetime import timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import delete, func, insert, or_, select
+
+from app import models, settings
+from app.database import AsyncSessionLocal
+from app.events import event_bus
+from app.poll_shards import ShardCoordinator, shard_coordinator
+
+logger = logging.getLogger(__name__)
+
+# События, которые нужны другим процессам: браузеры на /live/events и сводка главной страницы
+RELAYED_EVENTS = ("device_status", "command_job", "summary_invalidated")
+
+# Больший разрыв номеров считается не транзакциями в полёте, а сдвигом последовательности
+MAX_GAP = 1000
+
+
+class EventRelay:
+    """Передача событий шины между процессами через таблицу bus_events.
+
+    Каждый процесс раз в interval записывает накопленные свои события и
+    читает чужие с номером больше последнего прочитанного, публикуя их в
+    локальную шину. Номера, пропущенные при чтении (транзакция ещё не
+    завершена), перечитываются в течение gap_seconds. Пока процесс один,
+    события не записываются.
+    """
+
+    def __init__(
+        self,
+        coordinator: ShardCoordinator,
+        interval: float = None,
+        retention_seconds: float = None,
+        gap_seconds: float = None,
+    ):
+        self.coordinator = coordinator
+        self.interval = interval or settings.RELAY_INTERVAL_SECONDS
+        self.retention_seconds = retention_seconds or settings.RELAY_RETENTION_SECONDS
+        self.gap_seconds = gap_seconds or settings.RELAY_GAP_SECONDS
+        self.published = 0
+        self.received = 0
+        self._pending: List[dict] = []
+        self._last_id: Optional[int] = None
+        self._gaps: Dict[int, float] = {}  # Пропущенный номер -> до какого момента (monotonic) его ждать
+        self._replaying = False
+        self._pruned_at = 0.0
+        self._stopped = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._listeners: List[Callable[[str, dict], None]] = []
+
+    def listen(self, callback: Callable[[str, dict], None]):
+        """Вызов callback для каждого события, пришедшего из другого процесса"""
+        self._listeners.append(callback)
+        return callback
+
+    def _on_event(self, kind: str, data: dict):
+        # Чужие события, которые сами публикуем в шину, обратно не отправляются
+        if self._replaying or kind not in RELAYED_EVENTS or self.coordinator.live_workers <= 1:
+            return
+        if kind == "summary_invalidated" and any(row["kind"] == kind for row in self._pending):
+            return
+        self._pending.append({
+            "worker_id": self.coordinator.worker_id,
+            "kind": kind,
+            "data": json.dumps(data, default=str),
+            "created_at": models.utcnow(),
+        })
+
+    async def exchange(self):
+        """Запись своих событий и чтение чужих"""
+        pending, self._pending = self._pending, []
+        now = time.monotonic()
+        self._gaps = {event_id: until for event_id, until in self._gaps.items() if until > now}
+        async with AsyncSessionLocal() as db:
+            if pending:
+                await db.execute(insert(models.BusEvent), pending)
+                await db.commit()
+                self.published += len(pending)
+            if self._last_id is None:
+                self._last_id = await db.scalar(select(func.coalesce(func.max(models.BusEvent.id), 0)))
+                return
+            condition = models.BusEvent.id > self._last_id
+            if self._gaps:
+                condition = or_(condition, models.BusEvent.id.in_(sorted(self._gaps)))
+            rows = (await db.execute(
+                select(models.BusEvent.id, models.BusEvent.worker_id, models.BusEvent.kind, models.BusEvent.data)
+                .where(condition)
+                .order_by(models.BusEvent.id)
+            )).all()
+            if now - self._pruned_at >= self.retention_seconds / 10:
+                await db.execute(delete(models.BusEvent).where(
+                    models.BusEvent.created_at < models.utcnow() - timedelta(seconds=self.retention_seconds)
+                ))
+                await db.commit()
+                self._pruned_at = now
+
+        self._replaying = True
+        try:
+            for event_id, worker_id, kind, data in rows:
+                self._gaps.pop(event_id, None)
+                if event_id > self._last_id:
+                    if 1 < event_id - self._last_id <= MAX_GAP:
+                        for missing in range(self._last_id + 1, event_id):
+                            self._gaps[missing] = now + self.gap_seconds
+                    self._last_id = event_id
+                if worker_id == self.coordinator.worker_id:
+                    continue
+                self.received += 1
+                data = json.loads(data)
+                for callback in self._listeners:
+                    callback(kind, data)
+                event_bus.publish(kind, data)
+        finally:
+            self._replaying = False
+
+    async def run(self):
+        while not self._stopped.is_set():
+            try:
+                await self.exchange()
+            except Exception as e:
+                logger.error(f"Event relay failed: {str(e)}")
+            try:
+                await asyncio.wait_for(self._stopped.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._stopped = asyncio.Event()
+        event_bus.subscribe(self._on_event)
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Остановка без прерывания обмена: накопленное до остановки ещё нужно другим процессам"""
+        if self._task is None:
+            return
+        event_bus.unsubscribe(self._on_event)
+        self._stopped.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        try:
+            await self.exchange()
+        except Exception as e:
+            logger.error(f"Event relay failed on shutdown: {str(e)}")
+
+    def stats(self) -> dict:
+        return {
+            "published": self.published,
+            "received": self.received,
+            "pending": len(self._pending),
+            "waiting_gaps": len(self._gaps),
+        }
+
+
+event_relay = EventRelay(shard_coordinator)
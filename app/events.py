@@ -0,0 +1,199 @@
+# ydm/app/events.py
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import insert, select, update
+
+from . import models, settings
+from .database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+# Изменения статуса, которые несут события Action URL
+EVENT_STATES = {
+    "registered": {"registered": True},
+    "unregistered": {"registered": False},
+    "register_failed": {"registered": False},
+    "dnd_on": {"dnd": True},
+    "dnd_off": {"dnd": False},
+}
+
+
+# Метка остановки в очереди событий
+_STOP = object()
+
+
+@dataclass
+class DeviceEvent:
+    """Событие, присланное телефоном через Action URL"""
+    mac_address: str
+    event: str
+    ip_address: Optional[str] = None
+    received_at: datetime = field(default_factory=models.utcnow)
+
+
+class EventIngestor:
+    """Очередь событий Action URL с пакетной записью в БД"""
+
+    def __init__(self, max_queue: int = None, batch_size: int = None, flush_interval: float = None):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue or settings.EVENTS_MAX_QUEUE)
+        self.batch_size = batch_size or settings.EVENTS_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.EVENTS_FLUSH_INTERVAL
+        self.received = 0
+        self.dropped = 0
+        self.unknown = 0
+        self._listeners: List[Callable[[List[int]], None]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def listen(self, callback: Callable[[List[int]], None]):
+        """Вызов callback со списком устройств, у которых события изменили registered или dnd"""
+        self._listeners.append(callback)
+        return callback
+
+    def submit(self, event: DeviceEvent) -> bool:
+        """Постановка события в очередь без ожидания; при переполнении событие отбрасывается"""
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self.received += 1
+        return True
+
+    async def _next_batch(self) -> List[DeviceEvent]:
+        """Пачка событий; до метки остановки, если она встретилась"""
+        batch = []
+        item = await self.queue.get()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while item is not _STOP:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                break
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+        else:
+            self._stopping = True
+        return batch
+
+    async def flush(self, batch: List[DeviceEvent]):
+        """Запись пачки событий: одно чтение устройств по MAC и одно пакетное обновление"""
+        # События одного телефона сводятся в одно обновление
+        merged: Dict[str, dict] = {}
+        for event in batch:
+            values = merged.setdefault(event.mac_address, {})
+            values.update(last_event=event.event, last_event_at=event.received_at)
+            values.update(EVENT_STATES.get(event.event, {}))
+            if event.ip_address:
+                values.update(ip_address=event.ip_address, ip_int=models.ip_to_int(event.ip_address))
+
+        async with AsyncSessionLocal() as db:
+            rows = await db.execute(
+                select(models.Device.mac_address, models.Device.id)
+                .where(models.Device.mac_address.in_(list(merged)))
+            )
+            ids = dict(rows.all())
+            updates, history = [], []
+            for mac_address, values in merged.items():
+                device_id = ids.get(mac_address)
+                if device_id is None:
+                    self.unknown += 1
+                    continue
+                updates.append({"id": device_id, **values})
+                if "registered" in values or "dnd" in values:
+                    history.append({
+                        "device_id": device_id,
+                        "recorded_at": values["last_event_at"],
+                        "registered": values.get("registered"),
+                        "dnd": values.get("dnd"),
+                    })
+            if updates:
+                await db.execute(update(models.Device), updates)
+            if history:
+                await db.execute(insert(models.DeviceStatusHistory), history)
+            await db.commit()
+
+        changed = [item["device_id"] for item in history]
+        for callback in self._listeners:
+            callback(changed)
+        for values in updates:
+            event = {"device_id": values["id"]}
+            for key, value in values.items():
+                if key not in ("id", "ip_int"):
+                    event[key] = value.isoformat() if isinstance(value, datetime) else value
+            event_bus.publish("device_status", event)
+
+    async def run(self):
+        while not self._stopping:
+            batch = await self._next_batch()
+            if not batch:
+                continue
+            try:
+                await self.flush(batch)
+            except Exception as e:
+                logger.error(f"Failed to store {len(batch)} device events: {str(e)}")
+
+    def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Остановка с записью оставшихся в очереди событий. Задача не отменяется, а получает
+        метку в очереди: иначе пачка, уже взятая из очереди, потерялась бы"""
+        if self._task is not None:
+            await self.queue.put(_STOP)
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        pending = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not _STOP:
+                pending.append(item)
+        if pending:
+            await self.flush(pending)
+
+    def stats(self) -> dict:
+        return {
+            "received": self.received,
+            "dropped": self.dropped,
+            "unknown_devices": self.unknown,
+            "queued": self.queue.qsize(),
+        }
+
+
+event_ingestor = EventIngestor()
+
+
+class EventBus:
+    """Рассылка внутренних событий (смена статуса устройства и т.п.) подписчикам"""
+
+    def __init__(self):
+        self._subscribers: List[Callable[[str, dict], None]] = []
+
+    def subscribe(self, callback: Callable[[str, dict], None]):
+        self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback: Callable[[str, dict], None]):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def publish(self, kind: str, data: dict):
+        for callback in list(self._subscribers):
+            try:
+                callback(kind, data)
+            except Exception as e:
+                logger.error(f"Event subscriber failed on {kind}: {str(e)}")
+
+
+event_bus = EventBus()
@@ -0,0 +1,261 @@
+# ydm/app/jobs.py
+import asyncio
+import logging
+import random
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from sqlalchemy import and_, exists, select, update
+from sqlalchemy.orm import aliased
+
+from app import async_crud, models, schemas, settings, utils
+from app.config_push import config_pusher
+from app.config_templates import ConfigTemplateError, config_templates
+from app.database import AsyncSessionLocal
+from app.events import event_bus
+
+logger = logging.getLogger(__name__)
+
+
+class PermanentJobError(Exception):
+    """Ошибка, которую повтор не исправит (нет устройства или конфигурации, отказ в доступе)"""
+
+
+class CommandJobQueue:
+    """Очередь команд устройствам на таблице command_jobs.
+
+    Задания выполняются пулом до concurrency штук, но не больше одного на
+    устройство (в том числе между процессами). Неудачи повторяются с
+    экспоненциальной паузой. Задание, чей исполнитель пропал, возвращается
+    в очередь по истечении locked_until, поэтому перезапуск работу не теряет.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = None,
+        max_attempts: int = None,
+        backoff: float = None,
+        max_backoff: float = None,
+        lease_seconds: float = None,
+        poll_seconds: float = None,
+    ):
+        self.concurrency = concurrency or settings.JOBS_CONCURRENCY
+        self.max_attempts = max_attempts or settings.JOBS_MAX_ATTEMPTS
+        self.backoff = backoff or settings.JOBS_BACKOFF_SECONDS
+        self.max_backoff = max_backoff or settings.JOBS_MAX_BACKOFF
+        self.lease_seconds = lease_seconds or settings.JOBS_LEASE_SECONDS
+        self.poll_seconds = poll_seconds or settings.JOBS_POLL_SECONDS
+        self._running: Dict[int, Tuple[int, asyncio.Task]] = {}  # device_id -> (id задания, задача)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+
+    async def enqueue(self, db, device_id: int, job: schemas.CommandJobCreate) -> models.CommandJob:
+        db_job = await async_crud.create_command_job(db, device_id, job, self.max_attempts)
+        self._publish(db_job)
+        self._wakeup.set()
+        return db_job
+
+    async def enqueue_many(self, db, device_ids: List[int], job: schemas.CommandJobCreate) -> List[int]:
+        """Постановка команды многим устройствам одним INSERT; возвращает номера заданий.
+        О ходе сообщают уже выполненные задания"""
+        job_ids = await async_crud.create_command_jobs(db, device_ids, job, self.max_attempts)
+        self._wakeup.set()
+        return job_ids
+
+    def _publish(self, job: models.CommandJob):
+        event_bus.publish("command_job", schemas.CommandJob.model_validate(job).model_dump(mode="json"))
+
+    def retry_delay(self, attempts: int) -> float:
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        return delay * random.uniform(0.8, 1.2)
+
+    async def requeue_expired(self):
+        """Возврат в очередь заданий, чей исполнитель не завершил их вовремя (упал или перезапущен)"""
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(models.CommandJob)
+                .where(models.CommandJob.status == "running", models.CommandJob.locked_until < models.utcnow())
+                .values(status="queued", locked_until=None)
+            )
+            await db.commit()
+        if result.rowcount:
+            logger.warning(f"Requeued {result.rowcount} interrupted command jobs")
+
+    async def _claim(self, limit: int) -> List[Tuple[int, int]]:
+        """Захват готовых заданий: самое раннее на устройство, без устройств, где уже идёт команда"""
+        now = models.utcnow()
+        running = aliased(models.CommandJob)
+        async with AsyncSessionLocal() as db:
+            candidates = (await db.scalars(
+                select(models.CommandJob)
+                .where(
+                    models.CommandJob.status == "queued",
+                    models.CommandJob.next_attempt_at <= now,
+                    ~exists().where(and_(
+                        running.device_id == models.CommandJob.device_id, running.status == "running"
+                    )),
+                )
+                .order_by(models.CommandJob.id)
+                .limit(limit * 4)
+            )).all()
+            claimed, devices = [], set(self._running)
+            for job in candidates:
+                if len(claimed) >= limit:
+                    break
+                if job.device_id in devices:
+                    continue
+                # Строка устройства блокируется до коммита (в Postgres; SQLite и так пропускает
+                # одну пишущую транзакцию), занятое другим процессом устройство пропускается
+                locked = await db.scalar(
+                    select(models.Device.id)
+                    .where(models.Device.id == job.device_id)
+                    .with_for_update(skip_locked=True)
+                )
+                if locked is None:
+                    continue
+                # Условное обновление: задание достаётся только одному процессу и только если
+                # у устройства нет выполняющейся команды — проверка повторяется под блокировкой
+                result = await db.execute(
+                    update(models.CommandJob)
+                    .where(
+                        models.CommandJob.id == job.id,
+                        models.CommandJob.status == "queued",
+                        ~exists().where(and_(
+                            running.device_id == job.device_id, running.status == "running"
+                        )),
+                    )
+                    .values(
+                        status="running",
+                        attempts=models.CommandJob.attempts + 1,
+                        started_at=now,
+                        locked_until=now + timedelta(seconds=self.lease_seconds),
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                if result.rowcount:
+                    devices.add(job.device_id)
+                    claimed.append((job.device_id, job.id))
+            await db.commit()
+        return claimed
+
+    async def _execute(self, job_id: int):
+        async with AsyncSessionLocal() as db:
+            job = await db.get(models.CommandJob, job_id)
+            try:
+                device = await async_crud.get_device(db, job.device_id)
+                if device is None:
+                    raise PermanentJobError("Device not found")
+                config = None
+                if job.command == "apply_config":
+                    config = await async_crud.get_config(db, job.config_id, with_content=False) if job.config_id else None
+                    if config is None:
+                        raise PermanentJobError("Config not found")
+                # Соединение с БД не держится, пока загружается содержимое и идёт запрос к телефону
+                await db.commit()
+                if job.command == "reboot":
+                    response = await utils.get_yealink_client().reboot_device(device)
+                else:
+                    try:
+                        # Распакованное содержимое кэшируется по хэшу: рассылка не читает его на каждое задание
+                        template = await config_pusher.content(config.content_hash)
+                        content = config_templates.render_for(template, device)
+                    except ConfigTemplateError as e:
+                        raise PermanentJobError(str(e))
+                    pushed = await config_pusher.push(device, content, force=job.force)
+                    response = pushed.response
+                    if pushed.mode == "delta":
+                        response = f"Delta: {pushed.keys} keys, {pushed.sent_bytes} bytes. {response}"
+                    device.config_id = config.id
+                    if pushed.mode != "unchanged" or device.applied_config_hash != pushed.content_hash:
+                        device.applied_config_hash = pushed.content_hash
+                        device.applied_at = models.utcnow()
+                job.status, job.result = "succeeded", response
+                job.finished_at = models.utcnow()
+                self.succeeded += 1
+            except Exception as e:
+                error = e.detail if hasattr(e, "detail") else str(e)
+                permanent = isinstance(e, PermanentJobError) or (
+                    isinstance(e, httpx.HTTPStatusError) and 400 <= e.response.status_code < 500
+                )
+                job.result = str(error)
+                if permanent or job.attempts >= job.max_attempts:
+                    job.status, job.finished_at = "failed", models.utcnow()
+                    self.failed += 1
+                    logger.error(f"Command job {job.id} ({job.command}) failed: {job.result}")
+                else:
+                    job.status = "queued"
+                    job.next_attempt_at = models.utcnow() + timedelta(seconds=self.retry_delay(job.attempts))
+                    self.retried += 1
+            job.locked_until = None
+            await db.commit()
+            self._publish(job)
+
+    def _spawn(self, device_id: int, job_id: int):
+        task = asyncio.create_task(self._execute(job_id))
+        self._running[device_id] = (job_id, task)
+
+        def done(finished: asyncio.Task):
+            self._running.pop(device_id, None)
+            if not finished.cancelled() and finished.exception() is not None:
+                logger.error(f"Command job {job_id} crashed: {str(finished.exception())}")
+            # Освободилось место или у устройства могут быть следующие задания
+            self._wakeup.set()
+
+        task.add_done_callback(done)
+
+    async def run(self):
+        await self.requeue_expired()
+        while True:
+            self._wakeup.clear()
+            free = self.concurrency - len(self._running)
+            try:
+                if free > 0:
+                    for device_id, job_id in await self._claim(free):
+                        self._spawn(device_id, job_id)
+                await self.requeue_expired()
+            except Exception as e:
+                logger.error(f"Command job dispatch failed: {str(e)}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Остановка; незавершённые задания вернутся в очередь при следующем запуске"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        running = list(self._running.values())
+        for _, task in running:
+            task.cancel()
+        await asyncio.gather(*(task for _, task in running), return_exceptions=True)
+        if running:
+            # Прерванная попытка не засчитывается
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(models.CommandJob)
+                    .where(models.CommandJob.id.in_([job_id for job_id, _ in running]))
+                    .where(models.CommandJob.status == "running")
+                    .values(status="queued", locked_until=None, attempts=models.CommandJob.attempts - 1)
+                )
+                await db.commit()
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._running),
+            "concurrency": self.concurrency,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
+
+
+command_jobs = CommandJobQueue()
@@ -0,0 +1,105 @@
+# ydm/app/live.py
+import asyncio
+import json
+import logging
+from typing import AsyncIterator, Dict, Optional, Set, Tuple
+
+from app import settings
+from app.events import event_bus
+
+logger = logging.getLogger(__name__)
+
+# События шины, которые передаются в браузер, и поле, по которому они сводятся
+LIVE_EVENTS = {"device_status": "device_id", "command_job": "id"}
+
+
+class LiveClient:
+    """Подписка одного браузера: события сводятся по ключу и отдаются не чаще раза в throttle секунд"""
+
+    def __init__(self, device_ids: Optional[Set[int]] = None):
+        self.device_ids = device_ids
+        self.pending: Dict[Tuple[str, int], dict] = {}
+        self.overflowed = False
+        self.ready = asyncio.Event()
+
+    def offer(self, kind: str, data: dict):
+        if self.device_ids is not None and data.get("device_id") not in self.device_ids:
+            return
+        key = (kind, data[LIVE_EVENTS[kind]])
+        if key not in self.pending and len(self.pending) >= settings.LIVE_MAX_PENDING:
+            # Клиент не успевает: вместо потока событий он перечитает данные целиком
+            self.pending.clear()
+            self.overflowed = True
+        elif key in self.pending:
+            # Новое событие дополняет ещё не отправленное (например, статус от опроса и Action URL)
+            self.pending[key].update(data)
+        else:
+            self.pending[key] = dict(data)
+        self.ready.set()
+
+    def take(self) -> Tuple[list, bool]:
+        events = [(kind, data) for (kind, _), data in self.pending.items()]
+        overflowed = self.overflowed
+        self.pending = {}
+        self.overflowed = False
+        self.ready.clear()
+        return events, overflowed
+
+
+class LiveHub:
+    """Рассылка событий шины (статусы устройств, результаты команд) подключённым браузерам.
+    События других процессов приходят в шину через event_relay"""
+
+    def __init__(self):
+        self.clients: Set[LiveClient] = set()
+        self.sent = 0
+        self._subscribed = False
+
+    def _on_event(self, kind: str, data: dict):
+        if kind not in LIVE_EVENTS:
+            return
+        for client in self.clients:
+            client.offer(kind, data)
+
+    def connect(self, device_ids: Optional[Set[int]] = None) -> LiveClient:
+        if not self._subscribed:
+            event_bus.subscribe(self._on_event)
+            self._subscribed = True
+        client = LiveClient(device_ids)
+        self.clients.add(client)
+        return client
+
+    def disconnect(self, client: LiveClient):
+        self.clients.discard(client)
+
+    async def stream(self, client: LiveClient, is_disconnected) -> AsyncIterator[str]:
+        """Поток SSE для клиента; пустой комментарий раз в LIVE_PING_SECONDS держит соединение"""
+        loop = asyncio.get_running_loop()
+        try:
+            yield "retry: 3000\n\n"
+            while not await is_disconnected():
+                try:
+                    await asyncio.wait_for(client.ready.wait(), settings.LIVE_PING_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                started = loop.time()
+                events, overflowed = client.take()
+                chunk = "event: resync\ndata: {}\n\n" if overflowed else ""
+                chunk += "".join(f"event: {kind}\ndata: {json.dumps(data)}\n\n" for kind, data in events)
+                self.sent += len(events)
+                yield chunk
+                # Пауза копит новые события в одну отправку
+                await asyncio.sleep(max(settings.LIVE_THROTTLE_SECONDS - (loop.time() - started), 0))
+        finally:
+            self.disconnect(client)
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self.clients),
+            "pending": sum(len(client.pending) for client in self.clients),
+            "sent": self.sent,
+        }
+
+
+live_hub = LiveHub()
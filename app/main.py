@@ -1,23 +1,40 @@
 # ydm/app/main.py
-from fastapi import FastAPI, Depends, HTTPException, Request
-from fastapi import FastAPI, Form
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
+from fastapi import FastAPI, File, Form, UploadFile
 from fastapi.middleware import Middleware
 from starlette.middleware import Middleware
 from starlette.middleware.trustedhost import TrustedHostMiddleware
 from starlette.formparsers import MultiPartParser
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
-from app import models, schemas, crud, utils
-from app.database import SessionLocal, engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import ValidationError
+from app import models, schemas, crud, async_crud, utils, poller, settings
+from app.database import SessionLocal, AsyncSessionLocal, engine
+from app.cache import reference_cache, rendered_config_cache, summary_cache
+from app.events import DeviceEvent, event_bus, event_ingestor
+from app.event_relay import event_relay
+from app.poll_scheduler import poll_scheduler
+from app.poll_shards import shard_coordinator
+from app.jobs import command_jobs
+from app.config_push import config_pusher
+from app.config_xml import diff_configs
+from app.config_templates import ConfigTemplateError, config_templates, context_fingerprint, device_context
+from app.live import live_hub
+from app import discovery, metrics, migrations, transfer
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
+from sqlalchemy import select, update
+import json
 import logging
-from typing import List
+import re
+from typing import List, Literal, Optional
 import os
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 import asyncio
+import time
 from contextlib import asynccontextmanager
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -27,6 +44,19 @@ async def lifespan(app: FastAPI):
     # Запускаем приложение
     logger.info("Starting application")
     
+    # Общий клиент Yealink с пулом соединений на всё время работы
+    utils.get_yealink_client().health.start()
+    event_ingestor.start()
+    command_jobs.start()
+
+    # Опрос устройств по индивидуальному расписанию; шарды делятся между процессами
+    await poller.status_fingerprints.seed()
+    await shard_coordinator.start()
+    # События для браузеров и сводки из других процессов
+    event_relay.start()
+    await poll_scheduler.sync()
+    poll_scheduler.start()
+
     # Запускаем планировщик
     scheduler.start()
     
@@ -35,17 +65,12 @@ async def lifespan(app: FastAPI):
     # Завершаем работу
     logger.info("Shutting down application")
     scheduler.shutdown()
-    await utils.yealink_client.close()
-
-# app = FastAPI(
-#     title="Yealink Device Manager",
-#     description="API для управления устройствами Yealink",
-#     version="0.1.0",
-#     lifespan=lifespan
-# )
-
-# Инициализация клиента Yealink
-yealink_client = utils.YealinkClient()
+    await poll_scheduler.stop()
+    await shard_coordinator.stop()
+    await command_jobs.stop()
+    await event_ingestor.stop()
+    await event_relay.stop()
+    await utils.close_yealink_client()
 
 # Определяем базовый каталог
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -54,19 +79,35 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Создание таблиц в БД
+# Создание таблиц в БД и обновление схемы существующей
 models.Base.metadata.create_all(bind=engine)
+migrations.upgrade(engine)
 
 app = FastAPI(
     title="Yealink Device Manager",
     description="API для управления устройствами Yealink",
     version="0.1.0",
+    lifespan=lifespan,
     middleware=[
         Middleware(TrustedHostMiddleware, allowed_hosts=["*"]),
     ],
     form_parser=MultiPartParser,  # Явно указываем обработчик форм
 )
 
+# Время обработки запросов по шаблону маршрута (а не по конкретному URL)
+@app.middleware("http")
+async def measure_request(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.http_request_seconds.labels(
+            request.method, getattr(route, "path", "unmatched"), status
+        ).observe(time.perf_counter() - started)
 
 # Подключение статических файлов и шаблонов
 app.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "..", "static")), name="static")
@@ -80,18 +121,74 @@ def get_db():
     finally:
         db.close()
 
-# Инициализация клиента Yealink
-yealink_client = utils.YealinkClient()
+# Асинхронная сессия для async-роутов: запросы к БД не блокируют цикл событий
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
 
 # Роуты для веб-интерфейса
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
+# Сводка для главной страницы: агрегаты вместо полных списков, сбрасывается при изменениях
+event_bus.subscribe(summary_cache.on_event)
+
+@app.get("/dashboard/summary", response_model=schemas.DashboardSummary)
+async def read_dashboard_summary(db: AsyncSession = Depends(get_async_db)):
+    return await summary_cache.summary(db)
+
 # API роуты для устройств
-@app.get("/devices/", response_model=List[schemas.Device])
-def read_devices(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return crud.get_devices(db, skip=skip, limit=limit)
+def device_filters(
+    model_id: Optional[int] = None,
+    config_id: Optional[int] = None,
+    mac_prefix: Optional[str] = None,
+    subnet: Optional[str] = None,
+    fresh_within: Optional[int] = Query(None, ge=0),
+    stale_for: Optional[int] = Query(None, ge=0),
+    registered: Optional[bool] = None,
+    firmware: Optional[str] = None
+) -> schemas.DeviceFilter:
+    try:
+        return schemas.DeviceFilter(
+            model_id=model_id, config_id=config_id, mac_prefix=mac_prefix,
+            subnet=subnet, fresh_within=fresh_within, stale_for=stale_for,
+            registered=registered, firmware=firmware
+        )
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+
+@app.get("/devices/", response_model=List[schemas.DeviceListItem])
+def read_devices(
+    response: Response,
+    filters: schemas.DeviceFilter = Depends(device_filters),
+    cursor: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    skip: int = Query(0, ge=0, deprecated=True),
+    fields: Optional[str] = Query(None, example="id,mac_address,ip_address,model.name"),
+    db: Session = Depends(get_db)
+):
+    field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    # XML конфигурации отдаётся только по явному запросу config.content
+    with_content = bool(field_list) and "config.content" in field_list
+
+    if skip and cursor is None:
+        # Совместимость со старыми клиентами, постраничный обход — через cursor
+        devices = crud.get_devices(db, skip=skip, limit=limit, filters=filters)
+    else:
+        devices = crud.get_devices_page(db, filters, cursor=cursor, limit=limit, with_config_content=with_content)
+    # Курсор следующей страницы — id последнего устройства
+    headers = {"X-Next-Cursor": str(devices[-1].id)} if len(devices) == limit else {}
+    if not field_list:
+        response.headers.update(headers)
+        return devices
+
+    schema = schemas.Device if with_content else schemas.DeviceListItem
+    items = [
+        utils.project_fields(schema.model_validate(device).model_dump(mode="json"), field_list)
+        for device in devices
+    ]
+    return JSONResponse(items, headers=headers)
 
 @app.post("/devices/", response_model=schemas.Device)
 def create_device_endpoint(device: schemas.DeviceCreate, db: Session = Depends(get_db)):
@@ -116,37 +213,20 @@ def delete_device_endpoint(device_id: int, db: Session = Depends(get_db)):
     return {"message": "Device deleted"}
 
 # Роуты для работы с устройствами
-@app.post("/devices/{device_id}/reboot", response_model=schemas.CommandResponse)
-async def reboot_device(device_id: int, db: Session = Depends(get_db)):
-    db_device = crud.get_device(db, device_id)
-    if not db_device:
-        raise HTTPException(status_code=404, detail="Device not found")
-    
-    try:
-        response = await yealink_client.reboot_device(db_device)
-        return {
-            "device_id": device_id,
-            "command": "reboot",
-            "response": response,
-            "success": True
-        }
-    except Exception as e:
-        logger.error(f"Reboot failed: {str(e)}")
-        return {
-            "device_id": device_id,
-            "command": "reboot",
-            "response": str(e),
-            "success": False
-        }
+@app.post("/devices/{device_id}/reboot", response_model=schemas.CommandJob, status_code=202)
+async def reboot_device(device_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await enqueue_command(db, device_id, schemas.CommandJobCreate(command="reboot"))
 
 @app.get("/devices/{device_id}/status", response_model=schemas.CommandResponse)
-async def get_device_status(device_id: int, db: Session = Depends(get_db)):
-    db_device = crud.get_device(db, device_id)
+async def get_device_status(device_id: int, db: AsyncSession = Depends(get_async_db)):
+    db_device = await async_crud.get_device(db, device_id)
     if not db_device:
         raise HTTPException(status_code=404, detail="Device not found")
     
     try:
-        response = await yealink_client.get_status(db_device)
+        response = await utils.get_yealink_client().get_status(db_device)
+        # Статус сохраняется как при опросе; изменения уходят подписчикам /live/events
+        await poller.store_statuses(db, [poller.status_values(device_id, response)])
         return {
             "device_id": device_id,
             "command": "status",
@@ -162,11 +242,28 @@ async def get_device_status(device_id: int, db: Session = Depends(get_db)):
             "success": False
         }
 
+@app.get("/devices/{device_id}/status-history", response_model=List[schemas.StatusHistoryEntry])
+async def read_status_history(
+    device_id: int,
+    registered: Optional[bool] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await async_crud.get_status_history(db, device_id, registered=registered, limit=limit)
+
+@app.get("/devices/{device_id}/reachability")
+async def get_device_reachability(device_id: int, db: AsyncSession = Depends(get_async_db)):
+    """Доступность устройства по накопленным данным, без обращения к нему"""
+    ip_address = await db.scalar(select(models.Device.ip_address).where(models.Device.id == device_id))
+    if ip_address is None:
+        raise HTTPException(status_code=404, detail="Device not found")
+    return {"device_id": device_id, **utils.get_yealink_client().health.state(ip_address)}
+
 @app.get("/devices-list", response_class=HTMLResponse)
-async def devices_list(request: Request, db: Session = Depends(get_db)):
-    devices = crud.get_devices(db)
-    device_models = db.query(models.DeviceModel).all()
-    configs = db.query(models.Config).all()
+async def devices_list(request: Request, db: AsyncSession = Depends(get_async_db)):
+    devices = await async_crud.get_devices(db)
+    device_models = await reference_cache.device_models(db)
+    configs = await reference_cache.configs(db)
     return templates.TemplateResponse(
         "devices.html",
         {
@@ -178,20 +275,25 @@ async def devices_list(request: Request, db: Session = Depends(get_db)):
     )
 
 @app.get("/device-detail/{device_id}", response_class=HTMLResponse)
-async def device_detail(request: Request, device_id: int, db: Session = Depends(get_db)):
-    device = crud.get_device(db, device_id)
+async def device_detail(request: Request, device_id: int, db: AsyncSession = Depends(get_async_db)):
+    device = await async_crud.get_device(db, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
     
     return templates.TemplateResponse(
         "device_detail.html",
-        {"request": request, "device": device}
+        {
+            "request": request,
+            "device": device,
+            "configs": await reference_cache.configs(db),
+            "reachability": utils.get_yealink_client().health.state(device.ip_address)
+        }
     )
 
 @app.get("/device-add", response_class=HTMLResponse)
-async def add_device_form(request: Request, db: Session = Depends(get_db)):
-    device_models = db.query(models.DeviceModel).all()
-    configs = db.query(models.Config).all()
+async def add_device_form(request: Request, db: AsyncSession = Depends(get_async_db)):
+    device_models = await reference_cache.device_models(db)
+    configs = await reference_cache.configs(db)
     return templates.TemplateResponse(
         "device_form.html",
         {
@@ -203,7 +305,7 @@ async def add_device_form(request: Request, db: Session = Depends(get_db)):
     )
 
 @app.post("/device-add", response_class=RedirectResponse)
-async def add_device_submit(request: Request, db: Session = Depends(get_db)):
+async def add_device_submit(request: Request, db: AsyncSession = Depends(get_async_db)):
     form_data = await request.form()
     logger.info(f"Form data: {dict(form_data)}")
     
@@ -218,11 +320,12 @@ async def add_device_submit(request: Request, db: Session = Depends(get_db)):
             username=form_data.get("username", "admin"),
             password=form_data.get("password", "admin"),
             model_id=int(model_id) if model_id else None,
-            config_id=int(config_id) if config_id else None
+            config_id=int(config_id) if config_id else None,
+            variables=form_data.get("variables")
         )
         
         logger.info(f"Device data: {device_data}")
-        device = crud.create_device(db, device_data)
+        device = await async_crud.create_device(db, device_data)
         logger.info(f"Device created: ID={device.id}, MAC={device.mac_address}")
         return RedirectResponse(url="/devices-list", status_code=303)
     except Exception as e:
@@ -231,13 +334,13 @@ async def add_device_submit(request: Request, db: Session = Depends(get_db)):
         return RedirectResponse(url="/device-add?error=1", status_code=303)
 
 @app.get("/device-edit/{device_id}", response_class=HTMLResponse)
-async def edit_device_form(request: Request, device_id: int, db: Session = Depends(get_db)):
-    device = crud.get_device(db, device_id)
+async def edit_device_form(request: Request, device_id: int, db: AsyncSession = Depends(get_async_db)):
+    device = await async_crud.get_device(db, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
     
-    device_models = db.query(models.DeviceModel).all()
-    configs = db.query(models.Config).all()
+    device_models = await reference_cache.device_models(db)
+    configs = await reference_cache.configs(db)
 
     return templates.TemplateResponse(
         "device_form.html",
@@ -250,7 +353,7 @@ async def edit_device_form(request: Request, device_id: int, db: Session = Depen
     )
 
 @app.post("/device-edit/{device_id}", response_class=RedirectResponse)
-async def edit_device_submit(device_id: int, request: Request, db: Session = Depends(get_db)):
+async def edit_device_submit(device_id: int, request: Request, db: AsyncSession = Depends(get_async_db)):
     logger.info(f"Editing device ID: {device_id}")
     form_data = await request.form()
     
@@ -258,16 +361,20 @@ async def edit_device_submit(device_id: int, request: Request, db: Session = Dep
     model_id = form_data.get("model_id")
     config_id = form_data.get("config_id")
     
-    device_data = schemas.DeviceBase(
-        mac_address=form_data.get("mac_address"),
-        ip_address=form_data.get("ip_address"),
-        username=form_data.get("username"),
-        password=form_data.get("password"),
-        model_id=int(model_id) if model_id else None,
-        config_id=int(config_id) if config_id else None
-    )
+    try:
+        device_data = schemas.DeviceBase(
+            mac_address=form_data.get("mac_address"),
+            ip_address=form_data.get("ip_address"),
+            username=form_data.get("username"),
+            password=form_data.get("password"),
+            model_id=int(model_id) if model_id else None,
+            config_id=int(config_id) if config_id else None,
+            variables=form_data.get("variables")
+        )
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
     
-    updated_device = crud.update_device(db, device_id, device_data)
+    updated_device = await async_crud.update_device(db, device_id, device_data)
     if not updated_device:
         raise HTTPException(status_code=404, detail="Device not found")
     
@@ -279,8 +386,8 @@ def read_device_models(skip: int = 0, limit: int = 100, db: Session = Depends(ge
     return crud.get_device_models(db, skip=skip, limit=limit)
 
 @app.get("/device-model-list/", response_class=HTMLResponse)
-async def device_models_list(request: Request, db: Session = Depends(get_db)):
-    models_list = crud.get_device_models(db)
+async def device_models_list(request: Request, db: AsyncSession = Depends(get_async_db)):
+    models_list = await async_crud.get_device_models(db)
     return templates.TemplateResponse(
         "device_models.html",
         {"request": request, "device_models": models_list}
@@ -298,7 +405,7 @@ async def add_device_model_submit(
     name: str = Form(...),
     firmware: str = Form(None),
     image: str = Form(None),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     model_data = schemas.DeviceModelCreate(
         name=name,
@@ -306,12 +413,12 @@ async def add_device_model_submit(
         image=image
     )
     
-    model = crud.create_device_model(db, model_data)
+    model = await async_crud.create_device_model(db, model_data)
     return RedirectResponse(url="/device-models", status_code=303)
 
 @app.get("/device-model-edit/{model_id}", response_class=HTMLResponse)
-async def edit_device_model_form(request: Request, model_id: int, db: Session = Depends(get_db)):
-    device_model = crud.get_device_model(db, model_id)
+async def edit_device_model_form(request: Request, model_id: int, db: AsyncSession = Depends(get_async_db)):
+    device_model = await async_crud.get_device_model(db, model_id)
     if not device_model:
         raise HTTPException(status_code=404, detail="Device model not found")
     
@@ -326,7 +433,7 @@ async def edit_device_model_submit(
     name: str = Form(...),
     firmware: str = Form(None),
     image: str = Form(None),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     model_data = schemas.DeviceModelBase(
         name=name,
@@ -334,14 +441,15 @@ async def edit_device_model_submit(
         image=image
     )
     
-    updated_model = crud.update_device_model(db, model_id, model_data)
+    updated_model = await async_crud.update_device_model(db, model_id, model_data)
     if not updated_model:
         raise HTTPException(status_code=404, detail="Device model not found")
     
     return RedirectResponse(url="/device-models", status_code=303)
 
 # Роуты для конфигураций
-@app.get("/configs/", response_model=List[schemas.Config])
+# Список без содержимого: XML загружается только для одной конфигурации
+@app.get("/configs/", response_model=List[schemas.ConfigListItem])
 def read_configs(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
     return crud.get_configs(db, skip=skip, limit=limit)
 
@@ -351,7 +459,7 @@ def create_config_endpoint(config: schemas.ConfigCreate, db: Session = Depends(g
 
 @app.get("/configs/{config_id}", response_model=schemas.Config)
 def read_config(config_id: int, db: Session = Depends(get_db)):
-    db_config = crud.get_configs(db, config_id)
+    db_config = crud.get_config(db, config_id)
     if db_config is None:
         raise HTTPException(status_code=404, detail="Config not found")
     return db_config
@@ -361,8 +469,8 @@ if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
 @app.get("/configs-list", response_class=HTMLResponse)
-async def configs_list(request: Request, db: Session = Depends(get_db)):
-    configs = crud.get_configs(db)
+async def configs_list(request: Request, db: AsyncSession = Depends(get_async_db)):
+    configs = await async_crud.get_configs(db)
     return templates.TemplateResponse(
         "configs.html",
         {"request": request, "configs": configs}
@@ -376,14 +484,17 @@ async def add_config_form(request: Request):
     )
 
 @app.post("/config-add", response_class=RedirectResponse)
-async def add_config_submit(request: Request, db: Session = Depends(get_db)):
+async def add_config_submit(request: Request, db: AsyncSession = Depends(get_async_db)):
     form_data = await request.form()
-    config_data = schemas.ConfigCreate(
-        name=form_data.get("name"),
-        content=form_data.get("content")
-    )
+    try:
+        config_data = schemas.ConfigCreate(
+            name=form_data.get("name"),
+            content=form_data.get("content")
+        )
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
 
-    config = crud.create_config(db, config_data)
+    config = await async_crud.create_config(db, config_data)
     return RedirectResponse(url="/configs-list", status_code=303)
 
 # Просмотр деталей конфигурации
@@ -391,9 +502,9 @@ async def add_config_submit(request: Request, db: Session = Depends(get_db)):
 async def config_detail(
     request: Request, 
     config_id: int, 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    config = crud.get_config(db, config_id)
+    config = await async_crud.get_config(db, config_id)
     if not config:
         raise HTTPException(status_code=404, detail="Config not found")
     
@@ -404,8 +515,8 @@ async def config_detail(
 
 # Форма редактирования конфигурации
 @app.get("/config-edit/{config_id}", response_class=HTMLResponse)
-async def edit_config_form(request: Request, config_id: int, db: Session = Depends(get_db)):
-    config = crud.get_config(db, config_id)
+async def edit_config_form(request: Request, config_id: int, db: AsyncSession = Depends(get_async_db)):
+    config = await async_crud.get_config(db, config_id)
     if not config:
         raise HTTPException(status_code=404, detail="Config not found")
     
@@ -415,86 +526,489 @@ async def edit_config_form(request: Request, config_id: int, db: Session = Depen
     )
 
 @app.post("/config-edit/{config_id}", response_class=RedirectResponse)
-async def edit_config_submit(config_id: int, request: Request, db: Session = Depends(get_db)):
+async def edit_config_submit(config_id: int, request: Request, db: AsyncSession = Depends(get_async_db)):
     form_data = await request.form()
-    config_data = schemas.ConfigBase(
-        name=form_data.get("name"),
-        content=form_data.get("content")
-    )
+    try:
+        config_data = schemas.ConfigUpdate(
+            name=form_data.get("name"),
+            content=form_data.get("content")
+        )
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
 
-    updated_config = crud.update_config(db, config_id, config_data)
+    updated_config = await async_crud.update_config(db, config_id, config_data)
     if not updated_config:
         raise HTTPException(status_code=404, detail="Config not found")
+    if form_data.get("push"):
+        await push_config_to_devices(db, config_id)
     
     return RedirectResponse(url="/config-list", status_code=303)
 
 @app.post("/config-delete/{config_id}", response_class=RedirectResponse)
-async def delete_config_submit(config_id: int, db: Session = Depends(get_db)):
-    success = crud.delete_config(db, config_id)
+async def delete_config_submit(config_id: int, db: AsyncSession = Depends(get_async_db)):
+    success = await async_crud.delete_config(db, config_id)
     if not success:
         raise HTTPException(status_code=404, detail="Config not found")
     
     return RedirectResponse(url="/config-list", status_code=303)
 
-@app.post("/devices/{device_id}/apply-config", response_model=schemas.CommandResponse)
-async def apply_config_to_device(device_id: int, config_id: int = Form(...), db: Session = Depends(get_db)):
-    device = crud.get_device(db, device_id)
-    config = crud.get_config(db, config_id)
-    
-    if not device:
-        raise HTTPException(status_code=404, detail="Device not found")
+# История конфигурации: сравнение версий и откат
+@app.get("/configs/{config_id}/versions", response_model=List[schemas.ConfigVersion])
+async def read_config_versions(config_id: int, db: AsyncSession = Depends(get_async_db)):
+    if not await async_crud.get_config(db, config_id, with_content=False):
+        raise HTTPException(status_code=404, detail="Config not found")
+    return await async_crud.get_config_versions(db, config_id)
+
+@app.get("/configs/{config_id}/versions/{version}", response_model=schemas.ConfigVersionContent)
+async def read_config_version(config_id: int, version: int, db: AsyncSession = Depends(get_async_db)):
+    config_version = await async_crud.get_config_version(db, config_id, version)
+    if config_version is None:
+        raise HTTPException(status_code=404, detail="Config version not found")
+    return config_version
+
+@app.get("/configs/{config_id}/diff", response_model=schemas.ConfigDiff)
+async def diff_config_versions(
+    config_id: int,
+    from_version: Optional[int] = None,
+    to_version: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db)
+):
+    # По умолчанию — текущая версия против предыдущей
+    config = await async_crud.get_config(db, config_id, with_content=False)
     if not config:
         raise HTTPException(status_code=404, detail="Config not found")
-    
+    to_version = to_version if to_version is not None else config.version
+    from_version = from_version if from_version is not None else to_version - 1
+    base = await async_crud.get_config_version(db, config_id, from_version)
+    new = await async_crud.get_config_version(db, config_id, to_version)
+    if base is None or new is None:
+        raise HTTPException(status_code=404, detail="Config version not found")
+    return {"from_version": from_version, "to_version": to_version, **diff_configs(base["content"], new["content"])}
+
+@app.post("/configs/{config_id}/rollback/{version}", response_model=schemas.Config)
+async def rollback_config(config_id: int, version: int, db: AsyncSession = Depends(get_async_db)):
+    # Телефонам откат не рассылается: для этого есть /configs/{config_id}/push
+    config = await async_crud.rollback_config(db, config_id, version)
+    if config is None:
+        raise HTTPException(status_code=404, detail="Config version not found")
+    return config
+
+# Кто что задаёт: поиск по ключам конфигураций (индекс config_keys) без загрузки XML.
+# Для шаблонов значение — строка шаблона, например "{{ extension }}"
+@app.get("/config-keys", response_model=List[schemas.ConfigKeyMatch])
+async def find_configs_by_key(
+    key: str = Query(..., example="account.1.sip_server.1.address"),
+    value: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await async_crud.find_configs_by_key(db, key, value)
+
+@app.get("/config-keys/devices", response_model=List[schemas.DeviceKeyMatch])
+async def find_devices_by_key(
+    response: Response,
+    key: str = Query(..., example="local_time.ntp_server1"),
+    value: Optional[str] = None,
+    cursor: Optional[int] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    db: AsyncSession = Depends(get_async_db)
+):
+    devices = await async_crud.find_devices_by_key(db, key, value, cursor=cursor, limit=limit)
+    if len(devices) == limit:
+        response.headers["X-Next-Cursor"] = str(devices[-1]["device_id"])
+    return devices
+
+@app.get("/config-keys/values", response_model=List[schemas.ConfigKeyValue])
+async def read_config_key_values(key: str = Query(..., example="local_time.ntp_server1"), db: AsyncSession = Depends(get_async_db)):
+    return await async_crud.get_config_key_values(db, key)
+
+# Конфигурация, как её получат устройства: шаблон с подставленными переменными каждого
+@app.get("/configs/{config_id}/render", response_model=List[schemas.ConfigRender])
+async def render_config(config_id: int, device_id: List[int] = Query(None), db: AsyncSession = Depends(get_async_db)):
+    config = await async_crud.get_config(db, config_id)
+    if not config:
+        raise HTTPException(status_code=404, detail="Config not found")
+    # Без device_id — все устройства с этой конфигурацией
+    selector = schemas.DeviceSelector(device_ids=device_id) if device_id else schemas.DeviceSelector(config_id=config_id)
+    devices = await async_crud.get_devices_by_selector(db, selector)
+    rendered, errors = config_templates.render_many(config.content, devices)
+    if errors:
+        raise HTTPException(status_code=422, detail=[{"device_id": key, "error": value} for key, value in errors.items()])
+    return [{"device_id": key, "content": value} for key, value in rendered.items()]
+
+# Рассылка конфигурации привязанным устройствам: каждому уйдут только ключи, изменённые
+# относительно применённой на нём версии, а устройствам с актуальной версией — ничего
+async def push_config_to_devices(db: AsyncSession, config_id: int, force: bool = False) -> int:
+    device_ids = (await db.scalars(select(models.Device.id).where(models.Device.config_id == config_id))).all()
+    job = schemas.CommandJobCreate(command="apply_config", config_id=config_id, force=force)
+    return len(await command_jobs.enqueue_many(db, device_ids, job))
+
+@app.post("/configs/{config_id}/push", status_code=202)
+async def push_config(config_id: int, request: schemas.ConfigPushRequest = None, db: AsyncSession = Depends(get_async_db)):
+    if not await async_crud.get_config(db, config_id, with_content=False):
+        raise HTTPException(status_code=404, detail="Config not found")
+    return {"config_id": config_id, "queued": await push_config_to_devices(db, config_id, request.force if request else False)}
+
+@app.post("/devices/{device_id}/apply-config", response_model=schemas.CommandJob, status_code=202)
+async def apply_config_to_device(device_id: int, config_id: int = Form(...), db: AsyncSession = Depends(get_async_db)):
+    return await enqueue_command(db, device_id, schemas.CommandJobCreate(command="apply_config", config_id=config_id))
+
+# Команды устройствам выполняются в фоне: ответ 202 с заданием, результат — в /jobs/{job_id}
+async def enqueue_command(db: AsyncSession, device_id: int, job: schemas.CommandJobCreate) -> models.CommandJob:
+    if not await db.get(models.Device, device_id):
+        raise HTTPException(status_code=404, detail="Device not found")
+    if job.config_id is not None and not await async_crud.get_config(db, job.config_id, with_content=False):
+        raise HTTPException(status_code=404, detail="Config not found")
+    return await command_jobs.enqueue(db, device_id, job)
+
+@app.post("/devices/{device_id}/jobs", response_model=schemas.CommandJob, status_code=202)
+async def create_command_job(device_id: int, job: schemas.CommandJobCreate, db: AsyncSession = Depends(get_async_db)):
+    return await enqueue_command(db, device_id, job)
+
+@app.get("/devices/{device_id}/jobs", response_model=List[schemas.CommandJob])
+async def read_device_jobs(
+    device_id: int,
+    status: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await async_crud.get_command_jobs(db, device_id=device_id, status=status, limit=limit)
+
+@app.get("/jobs", response_model=List[schemas.CommandJob])
+async def read_jobs(
+    status: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await async_crud.get_command_jobs(db, status=status, limit=limit)
+
+@app.get("/jobs-stats")
+def read_jobs_stats():
+    return command_jobs.stats()
+
+@app.get("/jobs/{job_id}", response_model=schemas.CommandJob)
+async def read_job(job_id: int, db: AsyncSession = Depends(get_async_db)):
+    job = await async_crud.get_command_job(db, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+async def execute_command(device: models.Device, command: str) -> dict:
+    """Запрос статуса устройства с результатом в формате CommandResponse"""
     try:
-        response = await yealink_client.apply_config(device, config.content)
-        # Обновляем связь устройства с конфигурацией
-        device.config_id = config_id
-        db.commit()
-        
-        return {
-            "device_id": device_id,
-            "command": "apply_config",
-            "response": response,
-            "success": True
-        }
+        response = await utils.get_yealink_client().get_status(device)
+        success = True
     except Exception as e:
-        logger.error(f"Config apply failed: {str(e)}")
-        return {
-            "device_id": device_id,
-            "command": "apply_config",
-            "response": str(e),
-            "success": False
-        }
+        logger.error(f"Command {command} failed for device {device.id}: {str(e)}")
+        response, success = str(e), False
+    return {"device_id": device.id, "command": command, "response": response, "success": success}
+
+@app.post("/devices-bulk/{command}")
+async def bulk_command(
+    command: Literal["reboot", "status", "apply_config"],
+    request: schemas.BulkCommandRequest,
+    db: AsyncSession = Depends(get_async_db)
+):
+    config = None
+    if command == "apply_config":
+        config = await async_crud.get_config(db, request.config_id) if request.config_id is not None else None
+        if not config:
+            raise HTTPException(status_code=404, detail="Config not found")
+    devices = await async_crud.get_devices_by_selector(db, request.selector)
+    render_errors = {}
+    if config is not None:
+        # Шаблон проверяется до постановки: устройства с ошибкой рендера сразу получают отказ
+        rendered, render_errors = config_templates.render_many(config.content, devices)
+        devices = [device for device in devices if device.id in rendered]
+    job_ids = {}
+    if command != "status":
+        # Перезагрузка и применение конфигурации идут через очередь заданий: не больше одной
+        # команды на телефон, повторы и история в /jobs
+        job = schemas.CommandJobCreate(command=command, config_id=request.config_id, force=request.force)
+        ids = await command_jobs.enqueue_many(db, [device.id for device in devices], job)
+        job_ids = dict(zip(ids, (device.id for device in devices)))
+
+    async def results():
+        total = succeeded = 0
+        for device_id, error in render_errors.items():
+            total += 1
+            result = {"device_id": device_id, "command": command, "response": error, "success": False}
+            yield _bulk_event("result", schemas.CommandResponse(**result).model_dump(), request.format)
+        if command == "status":
+            async for outcome in poller.run_bounded(
+                devices, lambda device: execute_command(device, command), settings.BULK_CONCURRENCY, settings.BULK_DEADLINE
+            ):
+                if outcome.ok:
+                    result = outcome.result
+                else:
+                    result = {"device_id": outcome.item.id, "command": command,
+                              "response": f"Timed out: {str(outcome.error)}", "success": False}
+                total += 1
+                succeeded += result["success"]
+                yield _bulk_event("result", schemas.CommandResponse(**result).model_dump(), request.format)
+            yield _bulk_event("done", {"total": total, "succeeded": succeeded, "failed": total - succeeded}, request.format)
+            return
+
+        yield _bulk_event("queued", {"jobs": len(job_ids)}, request.format)
+        pending = set(job_ids)
+        async for job in _finished_jobs(pending, settings.BULK_DEADLINE):
+            total += 1
+            succeeded += job.status == "succeeded"
+            result = {"device_id": job.device_id, "command": command, "response": job.result or "",
+                      "success": job.status == "succeeded", "job_id": job.id}
+            yield _bulk_event("result", schemas.CommandResponse(**result).model_dump(), request.format)
+        # Не завершённые к сроку задания продолжают выполняться, их ход — в /jobs/{job_id}
+        yield _bulk_event("done", {
+            "total": total, "succeeded": succeeded, "failed": total - succeeded, "pending": sorted(pending),
+        }, request.format)
+
+    media_type = "text/event-stream" if request.format == "sse" else "application/x-ndjson"
+    return StreamingResponse(results(), media_type=media_type)
+
+async def _finished_jobs(pending: set, deadline: float):
+    """Задания из pending по мере завершения; завершённые удаляются из pending.
+    Ход узнаётся из шины событий и проверкой БД: задание может выполнить другой процесс"""
+    loop = asyncio.get_running_loop()
+    end = loop.time() + deadline
+    changed = asyncio.Event()
+
+    def on_event(kind: str, data: dict):
+        if kind == "command_job" and data.get("id") in pending and data.get("status") in ("succeeded", "failed"):
+            changed.set()
+
+    event_bus.subscribe(on_event)
+    try:
+        while pending:
+            changed.clear()
+            async with AsyncSessionLocal() as db_session:
+                finished = (await db_session.scalars(
+                    select(models.CommandJob)
+                    .where(models.CommandJob.id.in_(sorted(pending)), models.CommandJob.status.in_(("succeeded", "failed")))
+                )).all()
+            for job in finished:
+                pending.discard(job.id)
+                yield job
+            remaining = end - loop.time()
+            if not pending or remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(changed.wait(), min(remaining, settings.JOBS_POLL_SECONDS))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        event_bus.unsubscribe(on_event)
+
+def _bulk_event(event: str, data: dict, format: str) -> str:
+    if format == "sse":
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return json.dumps({"event": event, **data}) + "\n"
+
+# Импорт и экспорт устройств и конфигураций
+TransferFormat = Literal["csv", "jsonl"]
 
-async def collect_device_statuses():
-    """Асинхронная функция для сбора статусов устройств"""
-    with SessionLocal() as db_session:
-        devices = crud.get_devices(db_session)
-        for device in devices:
+_EXPORT_MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "jsonl": "application/x-ndjson"}
+
+def _import_format(file: UploadFile, format: Optional[TransferFormat]) -> str:
+    if format:
+        return format
+    return "jsonl" if (file.filename or "").lower().endswith((".jsonl", ".ndjson", ".json")) else "csv"
+
+def _export_response(kind: str, format: str) -> StreamingResponse:
+    return StreamingResponse(
+        transfer.export_rows(kind, format),
+        media_type=_EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{kind}.{format}"'},
+    )
+
+@app.post("/devices-import", response_model=schemas.ImportReport)
+async def import_devices(file: UploadFile = File(...), format: Optional[TransferFormat] = None):
+    report = await transfer.import_rows("devices", transfer.read_rows(file.file, _import_format(file, format)))
+    await poll_scheduler.sync()
+    return report
+
+@app.get("/devices-export")
+async def export_devices(format: TransferFormat = "csv"):
+    return _export_response("devices", format)
+
+@app.post("/configs-import", response_model=schemas.ImportReport)
+async def import_configs(file: UploadFile = File(...), format: Optional[TransferFormat] = None):
+    return await transfer.import_rows("configs", transfer.read_rows(file.file, _import_format(file, format)))
+
+@app.get("/configs-export")
+async def export_configs(format: TransferFormat = "csv"):
+    return _export_response("configs", format)
+
+# Метрики для Prometheus
+@metrics.registry.collector
+def _collect_runtime_metrics():
+    for key, value in utils.get_yealink_client().transport.stats().items():
+        if value is not None:
+            metrics.http_pool.labels(key).set(value)
+    schedule = poll_scheduler.stats()
+    metrics.scheduler_devices.labels("total").set(schedule["devices"])
+    metrics.scheduler_devices.labels("failing").set(schedule["failing"])
+    metrics.scheduler_devices.labels("due_next_minute").set(schedule["due_next_minute"])
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# События для браузеров: статусы устройств и результаты команд
+@app.get("/live/events")
+async def live_events(request: Request, device_id: List[int] = Query(None)):
+    client = live_hub.connect(set(device_id) if device_id else None)
+    return StreamingResponse(
+        live_hub.stream(client, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/live/stats")
+def read_live_stats():
+    return {**live_hub.stats(), "relay": event_relay.stats()}
+
+@app.get("/http-pool/stats")
+def read_http_pool_stats():
+    return utils.get_yealink_client().transport.stats()
+
+# События от телефонов (Action URL), например:
+# http://server/action-url/registered?mac=$mac&ip=$ip
+@app.get("/action-url/{event}", response_class=PlainTextResponse)
+async def action_url_event(event: str, mac: str, request: Request, ip: Optional[str] = None):
+    mac_address = models.normalize_mac(mac)
+    if not re.fullmatch(r"([0-9A-F]{2}:){5}[0-9A-F]{2}", mac_address):
+        raise HTTPException(status_code=422, detail="Invalid MAC address")
+    # Адрес попадает в Device.ip_address, по которому идут опрос и команды вместе с паролем
+    # устройства. Запрос не аутентифицирован, поэтому адрес берётся только совпадающий
+    # с источником запроса; чужой ip событие не отклоняет, но адрес не меняет
+    if ip and models.ip_to_int(ip) is None:
+        raise HTTPException(status_code=422, detail="Invalid IP address")
+    source = request.client.host if request.client else None
+    if ip and ip != source:
+        logger.warning(f"Action URL {event} for {mac_address}: ip {ip} differs from source {source}, ignored")
+        ip = None
+    if not event_ingestor.submit(DeviceEvent(mac_address, event.lower()[:50], ip or None)):
+        raise HTTPException(status_code=503, detail="Event queue is full")
+    return "OK"
+
+@app.get("/action-url-stats")
+def read_action_url_stats():
+    return event_ingestor.stats()
+
+@app.get("/cache/stats")
+def read_cache_stats():
+    return {
+        "reference": reference_cache.stats(),
+        "provisioning": rendered_config_cache.stats(),
+        "dashboard": summary_cache.stats(),
+        "config_push": config_pusher.stats(),
+        "templates": config_templates.stats(),
+    }
+
+# Автопровижининг: телефоны сами забирают <mac>.cfg при загрузке
+@app.get("/provision/{filename}")
+async def provision_config(filename: str, request: Request, db: AsyncSession = Depends(get_async_db)):
+    stem, _, extension = filename.rpartition(".")
+    if extension != "cfg" or len(stem) != 12:
+        raise HTTPException(status_code=404, detail="Config not found")
+
+    row = (await db.execute(
+        select(
+            models.Device.id, models.Device.config_id, models.Config.content_hash, models.Device.mac_address,
+            models.Device.ip_address, models.Device.variables, models.DeviceModel.name, models.Device.provisioned_at,
+        )
+        .join(models.Config, models.Device.config_id == models.Config.id)
+        .outerjoin(models.DeviceModel, models.Device.model_id == models.DeviceModel.id)
+        .where(models.Device.mac_address == models.normalize_mac(stem))
+    )).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Config not found")
+    # Версия кэша — хэш содержимого: updated_at с точностью до секунды пропускает быстрые правки
+    device_id, config_id, version, mac_address, ip_address, variables, model, provisioned_at = row
+
+    rendered = rendered_config_cache.get(config_id, version, count_miss=False)
+    if rendered is None:
+        # Шаблон: готовый файл у каждого устройства свой и зависит от его переменных
+        context = device_context(device_id, mac_address, ip_address, model, json.loads(variables) if variables else None)
+        variant = (version, context_fingerprint(context))
+        rendered = rendered_config_cache.get((config_id, device_id), variant)
+        if rendered is None:
+            content = await async_crud.get_config_content(db, config_id)
             try:
-                async with utils.YealinkClient() as client:
-                    status = await client.get_status(device)
-                    device.last_status = status
-                    db_session.add(device)
-                    db_session.commit()
-            except Exception as e:
-                logger.error(f"Failed to get status for device {device.id}: {str(e)}")
+                compiled = config_templates.compile(content)
+                if compiled.static:
+                    rendered = rendered_config_cache.put(config_id, version, content)
+                else:
+                    rendered = rendered_config_cache.put((config_id, device_id), variant, config_templates.render(content, context))
+            except ConfigTemplateError as e:
+                logger.error(f"Provisioning {filename} failed: {str(e)}")
+                raise HTTPException(status_code=500, detail=str(e))
+
+    # Запоминаем время запроса, не трогая updated_at устройства; не чаще раза в PROVISION_TOUCH_SECONDS,
+    # чтобы повторные запросы и проверки ETag обходились без записи в БД
+    now = models.utcnow()
+    if provisioned_at is None or (now - provisioned_at).total_seconds() >= settings.PROVISION_TOUCH_SECONDS:
+        await db.execute(
+            update(models.Device)
+            .where(models.Device.id == device_id)
+            .values(provisioned_at=now, updated_at=models.Device.updated_at)
+        )
+        await db.commit()
+
+    # У сжатого и несжатого ответа разные ETag: это разные представления одного файла
+    gzipped = "gzip" in request.headers.get("accept-encoding", "")
+    etag = rendered.etag[:-1] + '-gzip"' if gzipped else rendered.etag
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if etag in (value.strip() for value in request.headers.get("if-none-match", "").split(",")):
+        return Response(status_code=304, headers=headers)
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+        return Response(rendered.gzip_body, media_type="application/xml", headers=headers)
+    return Response(rendered.body, media_type="application/xml", headers=headers)
+
+# Поиск телефонов в подсетях
+@app.post("/discovery", response_model=schemas.DiscoveryJob, status_code=202)
+async def start_discovery(request: schemas.DiscoveryRequest):
+    if discovery.count_addresses(request.cidrs) > settings.DISCOVERY_MAX_ADDRESSES:
+        raise HTTPException(status_code=422, detail="Too many addresses to scan")
+    return discovery.start_discovery(request.cidrs, request.username, request.password, request.concurrency)
+
+@app.get("/discovery", response_model=List[schemas.DiscoveryJob])
+def read_discovery_jobs():
+    return list(discovery.discovery_jobs.values())
+
+@app.get("/discovery/{job_id}", response_model=schemas.DiscoveryJob)
+def read_discovery_job(job_id: str):
+    job = discovery.discovery_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Discovery job not found")
+    return job
+
+@app.get("/poller/schedule")
+def read_poll_schedule():
+    return poll_scheduler.stats()
+
+@app.get("/poller/shards")
+def read_poller_shards():
+    return shard_coordinator.stats()
+
+@app.post("/poller/sweep", response_model=schemas.SweepReport)
+async def run_sweep():
+    """Внеплановый обход всех устройств"""
+    return await poller.collect_device_statuses()
+
+@app.get("/poller/last-sweep", response_model=schemas.SweepReport)
+def read_last_sweep():
+    if poller.last_report is None:
+        raise HTTPException(status_code=404, detail="No sweep has finished yet")
+    return poller.last_report
 
 # Планировщик задач
 scheduler = AsyncIOScheduler()
+# Устройства опрашиваются poll_scheduler, здесь только сверка их списка с БД
 scheduler.add_job(
-    collect_device_statuses,
+    poll_scheduler.sync,
     'interval',
-    minutes=10
+    seconds=settings.POLL_SYNC_SECONDS,
+    max_instances=1,
+    coalesce=True
 )
-
-# Запускаем планировщик при старте приложения
-@app.on_event("startup")
-async def startup_event():
-    scheduler.start()
-
-# Остановка планировщика при завершении приложения
-@app.on_event("shutdown")
-def shutdown_event():
-    scheduler.shutdown()
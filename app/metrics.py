@@ -0,0 +1,229 @@
+# ydm/app/metrics.py
+# Метрики приложения в текстовом формате Prometheus
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from sqlalchemy import event
+
+# Границы корзин гистограмм по умолчанию, сек
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"] + self._samples()
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(child.value)}" for key, child in self._children.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class _HistogramValue:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self):
+        lines = []
+        for key, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, child.counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(child.sum)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {child.count}")
+        return lines
+
+
+class Registry:
+    """Набор метрик; collectors обновляют снимковые метрики (пул, планировщик) перед выдачей"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, func: Callable[[], None]):
+        self._collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        for collect in self._collectors:
+            collect()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Обращения к телефонам
+device_command_seconds = registry.register(Histogram(
+    "ydm_device_command_seconds", "Duration of requests to phones", ("command", "outcome"),
+))
+
+# Сбор статусов
+sweep_duration_seconds = registry.register(Histogram(
+    "ydm_sweep_duration_seconds", "Duration of full status sweeps",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600),
+))
+sweep_devices = registry.register(Gauge(
+    "ydm_sweep_devices", "Devices in the last status sweep by result", ("result",),
+))
+scheduler_lag_seconds = registry.register(Gauge(
+    "ydm_poll_scheduler_lag_seconds", "How far the last scheduled poll lagged behind its due time",
+))
+scheduler_devices = registry.register(Gauge(
+    "ydm_poll_scheduler_devices", "Devices known to the poll scheduler by state", ("state",),
+))
+scheduler_polled_total = registry.register(Counter(
+    "ydm_poll_scheduler_polled_total", "Polls made by the adaptive scheduler",
+))
+
+# Отправка конфигураций
+config_push_total = registry.register(Counter(
+    "ydm_config_push_total", "Config pushes by mode (full, delta, unchanged)", ("mode",),
+))
+config_push_bytes = registry.register(Counter(
+    "ydm_config_push_bytes_total", "Config bytes sent to phones by mode", ("mode",),
+))
+
+# Пул соединений к телефонам
+http_pool = registry.register(Gauge(
+    "ydm_http_pool", "Connection pool to phones", ("value",),
+))
+
+# Запросы к API
+http_request_seconds = registry.register(Histogram(
+    "ydm_http_request_seconds", "Duration of API requests", ("method", "route", "status"),
+))
+
+# Запросы к БД
+db_query_seconds = registry.register(Histogram(
+    "ydm_db_query_seconds", "Duration of database queries", ("engine", "operation"),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+))
+
+
+def instrument_engine(engine, name: str):
+    """Учёт времени SQL-запросов через события движка"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("ydm_query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["ydm_query_started"].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        db_query_seconds.labels(name, operation).observe(time.perf_counter() - started)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        # Неудавшийся запрос не доходит до after_cursor_execute
+        started = context.connection.info.get("ydm_query_started") if context.connection is not None else None
+        if started:
+            started.pop()
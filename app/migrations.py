@@ -0,0 +1,115 @@
+# ydm/app/migrations.py
+# Обновление схемы существующей БД при запуске: create_all создаёт только недостающие таблицы
+import logging
+
+from sqlalchemy import bindparam, exists, inspect, literal, select, text, update
+
+from . import models
+from .crud import config_key_rows, insert_blobs_query, insert_config_keys_query, record_versions_query
+
+logger = logging.getLogger(__name__)
+
+
+def _column_ddl(connection, column) -> str:
+    """Описание колонки для ALTER TABLE ADD COLUMN. NOT NULL не ставится: у уже
+    существующих строк значения нет, такие колонки заполняются отдельно"""
+    preparer = connection.dialect.identifier_preparer
+    ddl = f"{preparer.quote(column.name)} {column.type.compile(dialect=connection.dialect)}"
+    if column.default is not None and column.default.is_scalar:
+        value = literal(column.default.arg, column.type).compile(
+            dialect=connection.dialect, compile_kwargs={"literal_binds": True}
+        )
+        ddl += f" DEFAULT {value}"
+    return ddl
+
+
+def add_missing_columns(connection) -> list:
+    """Добавление колонок и индексов, появившихся в моделях после создания таблиц"""
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    added = []
+    for table in models.Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                connection.execute(text(
+                    f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {_column_ddl(connection, column)}"
+                ))
+                added.append(f"{table.name}.{column.name}")
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+    return added
+
+
+def migrate_config_contents(connection) -> int:
+    """Перенос XML из прежней колонки configs.content в config_blobs: хэш, версия 1 и запись в истории"""
+    if "content" not in {column["name"] for column in inspect(connection).get_columns("configs")}:
+        return 0
+    dialect_name = connection.dialect.name
+    rows = connection.execute(text("SELECT id, content FROM configs WHERE content_hash IS NULL")).all()
+    for config_id, content in rows:
+        blob = models.ConfigBlob.pack(content)
+        connection.execute(insert_blobs_query(dialect_name), [blob])
+        keys = config_key_rows(blob["hash"], content)
+        if keys:
+            connection.execute(insert_config_keys_query(dialect_name), keys)
+        connection.execute(
+            update(models.Config)
+            .where(models.Config.id == config_id)
+            .values(content_hash=blob["hash"], version=1, updated_at=models.Config.updated_at)
+        )
+        connection.execute(record_versions_query(dialect_name, models.Config.id == config_id))
+    return len(rows)
+
+
+def fill_ip_int(connection) -> int:
+    """ip_int для устройств, добавленных до появления колонки (по ней ищутся подсети)"""
+    rows = connection.execute(text(
+        "SELECT id, ip_address FROM devices WHERE ip_int IS NULL AND ip_address IS NOT NULL"
+    )).all()
+    values = [{"id": device_id, "ip_int": models.ip_to_int(ip_address)} for device_id, ip_address in rows]
+    values = [row for row in values if row["ip_int"] is not None]
+    if values:
+        connection.execute(
+            update(models.Device.__table__)
+            .where(models.Device.__table__.c.id == bindparam("device_id"))
+            .values(ip_int=bindparam("ip_int")),
+            [{"device_id": row["id"], "ip_int": row["ip_int"]} for row in values],
+        )
+    return len(values)
+
+
+def index_config_keys(connection, batch_size: int = 100) -> int:
+    """Ключи содержимого конфигураций и их версий, ещё не попавшего в config_keys.
+    Файлы, отправленные на телефоны, не индексируются: поиск идёт только по конфигурациям"""
+    referenced = select(models.Config.content_hash).union(select(models.ConfigVersion.content_hash)).subquery()
+    hashes = connection.scalars(
+        select(referenced.c.content_hash)
+        .where(~exists().where(models.ConfigKey.content_hash == referenced.c.content_hash))
+    ).all()
+    dialect_name = connection.dialect.name
+    for start in range(0, len(hashes), batch_size):
+        blobs = connection.execute(
+            select(models.ConfigBlob.hash, models.ConfigBlob.data)
+            .where(models.ConfigBlob.hash.in_(hashes[start:start + batch_size]))
+        ).all()
+        keys = [row for content_hash, data in blobs for row in config_key_rows(content_hash, models.ConfigBlob.unpack(data))]
+        if keys:
+            connection.execute(insert_config_keys_query(dialect_name), keys)
+    return len(hashes)
+
+
+def upgrade(engine):
+    with engine.begin() as connection:
+        added = add_missing_columns(connection)
+        if added:
+            logger.info(f"Added columns: {', '.join(added)}")
+        fill_ip_int(connection)
+        migrated = migrate_config_contents(connection)
+        if migrated:
+            logger.info(f"Moved {migrated} config bodies to config_blobs")
+        indexed = index_config_keys(connection)
+        if indexed:
+            logger.info(f"Indexed keys of {indexed} config bodies")
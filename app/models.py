@@ -1,11 +1,43 @@
 # ydm/app/models.py
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, BigInteger, Boolean, String, Text, LargeBinary, ForeignKey, DateTime, Index
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, validates
+from datetime import datetime, timezone
+import hashlib
+import ipaddress
+import json
+import re
+import zlib
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+def utcnow() -> datetime:
+    """Текущее время UTC без часового пояса, как его хранят колонки DateTime"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def normalize_mac(mac_address: str):
+    """MAC-адрес в едином виде 00:15:65:AA:BB:CC (принимает и 001565aabbcc, и 00-15-65-...)"""
+    if not mac_address:
+        return mac_address
+    digits = re.sub(r"[^0-9A-Fa-f]", "", mac_address)
+    if len(digits) != 12:
+        return mac_address
+    digits = digits.upper()
+    return ":".join(digits[i:i + 2] for i in range(0, 12, 2))
+
+def normalize_mac_prefix(prefix: str) -> str:
+    """Начало MAC-адреса в том же виде, что normalize_mac: 001565 и 00-15-65 -> 00:15:65"""
+    digits = re.sub(r"[^0-9A-Fa-f]", "", prefix or "").upper()[:12]
+    return ":".join(digits[i:i + 2] for i in range(0, len(digits), 2))
+
+def ip_to_int(ip_address: str):
+    """Числовое представление IPv4-адреса для поиска по подсетям"""
+    try:
+        return int(ipaddress.IPv4Address(ip_address))
+    except (ValueError, TypeError):
+        return None
+
 class DeviceModel(Base):
     __tablename__ = "device_models"
     
@@ -20,9 +52,24 @@ class Device(Base):
     id = Column(Integer, primary_key=True, index=True)
     mac_address = Column(String(17), unique=True, index=True)
     ip_address = Column(String(15))
+    ip_int = Column(BigInteger, index=True)  # IP-адрес числом, заполняется автоматически
     username = Column(String(50), default="admin")  # Для аутентификации
     password = Column(String(50), default="admin")   # Для аутентификации
     last_status = Column(Text)  # JSON-строка с последним статусом
+    status_at = Column(DateTime, index=True)  # Когда статус был получен
+    # Разобранный статус (см. utils.parse_status)
+    registered = Column(Boolean, index=True)  # Зарегистрированы все линии
+    account_states = Column(Text)  # JSON: номер линии -> состояние
+    dnd = Column(Boolean)
+    firmware = Column(String(50), index=True)
+    uptime = Column(Integer)  # Секунды
+    next_poll_at = Column(DateTime)  # Когда опросить по расписанию; по нему продолжает новый владелец шарда
+    provisioned_at = Column(DateTime)  # Когда телефон последний раз забрал конфигурацию
+    last_event = Column(String(50))  # Последнее событие Action URL (registered, dnd_on и т.д.)
+    last_event_at = Column(DateTime)
+    variables = Column(Text)  # JSON: переменные для шаблона конфигурации (extension, display_name и т.д.)
+    applied_config_hash = Column(String(64))  # Хэш конфигурации, последней отправленной на телефон
+    applied_at = Column(DateTime)
     config_id = Column(Integer, ForeignKey("configs.id"))
     model_id = Column(Integer, ForeignKey("device_models.id"))  # Связь с моделью
     created_at = Column(DateTime, default=func.now())
@@ -32,14 +79,158 @@ class Device(Base):
     config = relationship("Config", back_populates="devices")
     model = relationship("DeviceModel")
 
+    # Составные индексы для постраничной выборки по id внутри фильтра
+    __table_args__ = (
+        Index("ix_devices_model_id_id", "model_id", "id"),
+        Index("ix_devices_config_id_id", "config_id", "id"),
+    )
+
+    @validates("mac_address")
+    def _normalize_mac(self, key, value):
+        return normalize_mac(value)
+
+    @validates("ip_address")
+    def _sync_ip_int(self, key, value):
+        self.ip_int = ip_to_int(value)
+        return value
+
+    @validates("variables")
+    def _dump_variables(self, key, value):
+        return json.dumps(value, ensure_ascii=False, sort_keys=True) if isinstance(value, dict) else value
+
+class DeviceStatusHistory(Base):
+    """История разобранных статусов устройства (только добавление)"""
+    __tablename__ = "device_status_history"
+
+    id = Column(Integer, primary_key=True)
+    device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False)
+    recorded_at = Column(DateTime, nullable=False)
+    registered = Column(Boolean)
+    account_states = Column(Text)
+    dnd = Column(Boolean)
+    firmware = Column(String(50))
+    uptime = Column(Integer)
+
+    __table_args__ = (
+        Index("ix_device_status_history_device_id_recorded_at", "device_id", "recorded_at"),
+    )
+
+class CommandJob(Base):
+    """Команда устройству, выполняемая в фоне (см. jobs.py)"""
+    __tablename__ = "command_jobs"
+
+    id = Column(Integer, primary_key=True)
+    device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False, index=True)
+    command = Column(String(20), nullable=False)  # reboot, apply_config
+    config_id = Column(Integer, ForeignKey("configs.id", ondelete="SET NULL"))
+    status = Column(String(20), nullable=False, default="queued")  # queued, running, succeeded, failed
+    force = Column(Boolean, nullable=False, default=False)  # Полная отправка конфигурации, даже если она уже применена
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False)
+    next_attempt_at = Column(DateTime, nullable=False)
+    locked_until = Column(DateTime)  # Пока задание выполняется; просроченное возвращается в очередь
+    result = Column(Text)  # Ответ телефона или текст последней ошибки
+    created_at = Column(DateTime, default=func.now())
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_command_jobs_status_next_attempt_at", "status", "next_attempt_at"),
+    )
+
+class ConfigBlob(Base):
+    """Содержимое конфигурации по хэшу, сжатое zlib: одинаковое содержимое хранится один раз.
+    Здесь и версии конфигураций, и отправленные на телефоны файлы (от них считается дельта)"""
+    __tablename__ = "config_blobs"
+
+    hash = Column(String(64), primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    size = Column(Integer, nullable=False)  # Размер без сжатия, байт
+    created_at = Column(DateTime, default=func.now())
+
+    @staticmethod
+    def pack(content: str) -> dict:
+        """Строка для вставки в config_blobs; хэш тот же, что у config_xml.config_hash"""
+        data = (content or "").encode("utf-8")
+        return {"hash": hashlib.sha256(data).hexdigest(), "data": zlib.compress(data), "size": len(data), "created_at": utcnow()}
+
+    @staticmethod
+    def unpack(data: bytes) -> str:
+        return zlib.decompress(data).decode("utf-8")
+
+    @property
+    def content(self) -> str:
+        return self.unpack(self.data)
+
 class Config(Base):
     __tablename__ = "configs"
     
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(100), unique=True)
-    content = Column(Text)  # XML-конфигурация Yealink
+    content_hash = Column(String(64), ForeignKey("config_blobs.hash"), nullable=False, index=True)  # XML-конфигурация Yealink в config_blobs
+    version = Column(Integer, nullable=False, default=1)  # Растёт при каждом изменении содержимого
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
     
     devices = relationship("Device", back_populates="config")
-    
\ No newline at end of file
+    # Содержимое загружается отдельно и только когда нужно: списки его не читают
+    blob = relationship("ConfigBlob", lazy="select")
+
+    @property
+    def content(self) -> str:
+        return self.blob.content if self.blob is not None else None
+
+class ConfigVersion(Base):
+    """История содержимого конфигурации: для сравнения версий и отката"""
+    __tablename__ = "config_versions"
+
+    id = Column(Integer, primary_key=True)
+    config_id = Column(Integer, ForeignKey("configs.id", ondelete="CASCADE"), nullable=False)
+    version = Column(Integer, nullable=False)
+    content_hash = Column(String(64), ForeignKey("config_blobs.hash"), nullable=False)
+    created_at = Column(DateTime, default=func.now())
+
+    __table_args__ = (
+        Index("ix_config_versions_config_id_version", "config_id", "version", unique=True),
+    )
+    
+class ConfigKey(Base):
+    """Ключи содержимого конфигурации (config_xml.parse_config_keys) для поиска «кто что задаёт».
+    Привязаны к хэшу содержимого: одинаковое содержимое разбирается один раз"""
+    __tablename__ = "config_keys"
+
+    content_hash = Column(String(64), ForeignKey("config_blobs.hash"), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    value = Column(String(1024), nullable=False)
+
+    __table_args__ = (
+        Index("ix_config_keys_key_value", "key", "value"),
+    )
+
+class PollWorker(Base):
+    """Процесс, участвующий в опросе устройств (воркер uvicorn или реплика)"""
+    __tablename__ = "poll_workers"
+
+    id = Column(String(100), primary_key=True)  # хост:pid:случайный суффикс
+    hostname = Column(String(100))
+    pid = Column(Integer)
+    started_at = Column(DateTime)
+    heartbeat_at = Column(DateTime, index=True)
+
+class BusEvent(Base):
+    """Событие шины, переданное другим процессам (см. event_relay.py); хранится недолго"""
+    __tablename__ = "bus_events"
+
+    id = Column(Integer, primary_key=True)
+    worker_id = Column(String(100), nullable=False)  # Процесс-источник
+    kind = Column(String(30), nullable=False)
+    data = Column(Text, nullable=False)  # JSON
+    created_at = Column(DateTime, nullable=False, index=True)
+
+class PollLease(Base):
+    """Аренда шарда устройств (Device.id % POLL_SHARDS) одним воркером"""
+    __tablename__ = "poll_leases"
+
+    shard = Column(Integer, primary_key=True)
+    worker_id = Column(String(100), index=True)
+    expires_at = Column(DateTime, nullable=False)
@@ -0,0 +1,264 @@
+# ydm/app/poll_scheduler.py
+import asyncio
+import heapq
+import logging
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.orm import load_only
+
+from app import metrics, models, settings, utils
+from app.database import AsyncSessionLocal
+from app.poll_shards import ShardCoordinator, shard_coordinator
+from app.poller import status_fingerprints, status_values, store_statuses
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DeviceSchedule:
+    """Расписание опроса одного устройства"""
+    device: models.Device
+    next_due: float
+    failures: int = 0
+    last_fingerprint: Optional[bytes] = None
+
+
+class AdaptivePollScheduler:
+    """Опрос устройств по индивидуальному расписанию.
+
+    Здоровые устройства равномерно распределены по интервалу со случайным
+    сдвигом, недоступные опрашиваются с экспоненциально растущей паузой,
+    а недавно изменившие статус — чаще обычного. При нескольких процессах
+    каждый опрашивает только устройства своих шардов (см. poll_shards).
+    """
+
+    def __init__(
+        self,
+        interval: float = None,
+        jitter: float = None,
+        max_backoff: float = None,
+        changed_factor: float = None,
+        concurrency: int = None,
+        batch_size: int = None,
+        flush_interval: float = None,
+        coordinator: ShardCoordinator = None,
+    ):
+        self.interval = interval or settings.POLL_INTERVAL_MINUTES * 60
+        self.jitter = jitter if jitter is not None else settings.POLL_JITTER
+        self.max_backoff = max_backoff or settings.POLL_MAX_BACKOFF
+        self.changed_factor = changed_factor or settings.POLL_CHANGED_FACTOR
+        self.concurrency = concurrency or settings.POLL_CONCURRENCY
+        self.batch_size = batch_size or settings.POLL_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.POLL_FLUSH_SECONDS
+        self.coordinator = coordinator
+        self._schedules: Dict[int, DeviceSchedule] = {}
+        self._heap: List[tuple] = []  # (next_due, device_id)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._polls: Set[asyncio.Task] = set()
+        # Ещё не записанные результаты опросов
+        self._statuses: List[dict] = []
+        self._next_polls: Dict[int, datetime] = {}
+        self._flush_wanted = asyncio.Event()
+        self.polled = 0
+        self.lag = 0.0  # Насколько последний опрос отстал от расписания, сек
+
+    def _schedule(self, schedule: DeviceSchedule, delay: float):
+        schedule.next_due = time.monotonic() + delay
+        heapq.heappush(self._heap, (schedule.next_due, schedule.device.id))
+
+    def _with_jitter(self, delay: float) -> float:
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def next_delay(self, schedule: DeviceSchedule, ok: bool, changed: bool) -> float:
+        """Пауза до следующего опроса по результату текущего"""
+        if not ok:
+            return self._with_jitter(min(self.interval * 2 ** (schedule.failures - 1), self.max_backoff))
+        if changed:
+            return self._with_jitter(self.interval * self.changed_factor)
+        return self._with_jitter(self.interval)
+
+    def _first_delay(self, device: models.Device) -> float:
+        """Пауза до первого опроса: по сохранённому расписанию, иначе случайно в пределах интервала.
+
+        Так устройство, перешедшее от другого процесса, не опрашивается дважды за интервал.
+        status_at для этого не годится: у неизменных статусов он обновляется редко.
+        """
+        if device.next_poll_at is not None:
+            delay = (device.next_poll_at - models.utcnow()).total_seconds()
+            if delay >= 0:
+                return min(delay, self.max_backoff)
+            if -delay < self.interval:
+                # Пропущенные за время передачи шарда опросы не должны прийтись на один момент
+                return random.uniform(0, self.interval * max(self.jitter, 0.05))
+        return random.uniform(0, self.interval)
+
+    async def sync(self):
+        """Сверка списка устройств с БД: новые распределяются по интервалу, удалённые и чужие выбывают"""
+        # Только то, что нужно для запроса к телефону и расписания
+        query = select(models.Device).options(load_only(
+            models.Device.ip_address, models.Device.username, models.Device.password, models.Device.next_poll_at
+        ))
+        if self.coordinator is not None:
+            query = query.where(self.coordinator.device_filter())
+        async with AsyncSessionLocal() as db:
+            devices = (await db.scalars(query)).all()
+        seen, added = set(), []
+        for device in devices:
+            seen.add(device.id)
+            schedule = self._schedules.get(device.id)
+            if schedule is None:
+                schedule = DeviceSchedule(device, 0.0)
+                self._schedules[device.id] = schedule
+                self._schedule(schedule, self._first_delay(device))
+                added.append(device.id)
+            else:
+                # Адрес и учётные данные могли измениться
+                schedule.device = device
+        if added:
+            await status_fingerprints.reseed(added)
+        for device_id in set(self._schedules) - seen:
+            del self._schedules[device_id]
+            status_fingerprints.forget(device_id)
+        self._wakeup.set()
+
+    def _pop_due(self) -> Optional[DeviceSchedule]:
+        """Следующее устройство, которому пора опроситься"""
+        now = time.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+            next_due, device_id = heapq.heappop(self._heap)
+            schedule = self._schedules.get(device_id)
+            # Устаревшие записи кучи (устройство удалено или перепланировано) пропускаем
+            if schedule is None or schedule.next_due != next_due:
+                continue
+            if self.coordinator is not None and not self.coordinator.owns(device_id):
+                # Шард ушёл другому процессу или аренда не продлена: устройство выбудет при сверке
+                self._schedule(schedule, self.interval)
+                continue
+            self.lag = now - next_due
+            metrics.scheduler_lag_seconds.set(self.lag)
+            return schedule
+        return None
+
+    async def poll(self, schedule: DeviceSchedule):
+        """Опрос одного устройства; статус и расписание уходят в пакетную запись"""
+        client = utils.get_yealink_client()
+        changed = False
+        try:
+            text = await client.get_status(schedule.device)
+        except Exception as e:
+            schedule.failures += 1
+            logger.error(f"Failed to get status for device {schedule.device.id}: {str(e)}")
+            ok = False
+        else:
+            schedule.failures = 0
+            values = status_values(schedule.device.id, text)
+            fingerprint = status_fingerprints.fingerprint(values)
+            # Первый ответ после запуска сменой статуса не считается
+            changed = schedule.last_fingerprint is not None and fingerprint != schedule.last_fingerprint
+            schedule.last_fingerprint = fingerprint
+            self._statuses.append(values)
+            ok = True
+        delay = self.next_delay(schedule, ok, changed)
+        self._schedule(schedule, delay)
+        self._next_polls[schedule.device.id] = models.utcnow() + timedelta(seconds=delay)
+        self.polled += 1
+        metrics.scheduler_polled_total.inc()
+        if len(self._next_polls) >= self.batch_size:
+            self._flush_wanted.set()
+
+    async def flush(self):
+        """Запись накопленных статусов и расписания одним коммитом"""
+        if not self._next_polls and not self._statuses:
+            return
+        batch, self._statuses = self._statuses, []
+        next_polls = [{"device_id": device_id, "next_poll_at": value} for device_id, value in self._next_polls.items()]
+        self._next_polls = {}
+        async with AsyncSessionLocal() as db:
+            if batch:
+                await store_statuses(db, batch)
+            if next_polls:
+                # Расписание сохраняется одним пакетным обновлением, updated_at не меняется
+                devices = models.Device.__table__
+                await db.execute(
+                    update(devices)
+                    .where(devices.c.id == bindparam("device_id"))
+                    .values(next_poll_at=bindparam("next_poll_at"), updated_at=devices.c.updated_at),
+                    next_polls,
+                )
+            await db.commit()
+
+    async def _write(self):
+        """Пакетная запись: по накоплении batch_size опросов или раз в flush_interval"""
+        stopping = False
+        while not stopping:
+            try:
+                await asyncio.wait_for(self._flush_wanted.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wanted.clear()
+            stopping = self._task is None
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to store scheduled polls: {str(e)}")
+
+    async def _wait_due(self):
+        timeout = self._heap[0][0] - time.monotonic() if self._heap else self.interval
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        """Непрерывная раздача: как только освобождается одно из concurrency мест,
+        опрашивается следующее по сроку устройство, медленные телефоны не задерживают остальные"""
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            await slots.acquire()
+            schedule = self._pop_due()
+            while schedule is None:
+                await self._wait_due()
+                schedule = self._pop_due()
+            task = asyncio.create_task(self.poll(schedule))
+            self._polls.add(task)
+            task.add_done_callback(self._polls.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+        self._writer = asyncio.create_task(self._write())
+
+    async def stop(self):
+        tasks = [task for task in (self._task, *self._polls) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        if self._writer is not None:
+            # Запись не прерывается: писатель сохраняет опрошенное до остановки и завершается
+            self._flush_wanted.set()
+            await asyncio.gather(self._writer, return_exceptions=True)
+            self._writer = None
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        failing = [s for s in self._schedules.values() if s.failures]
+        return {
+            "devices": len(self._schedules),
+            "failing": len(failing),
+            "due_next_minute": sum(1 for s in self._schedules.values() if s.next_due - now <= 60),
+            "polled": self.polled,
+            "lag": self.lag,
+        }
+
+
+poll_scheduler = AdaptivePollScheduler(coordinator=shard_coordinator)
+shard_coordinator.listen(poll_scheduler.sync)
@@ -0,0 +1,186 @@
+# ydm/app/poll_shards.py
+import asyncio
+import logging
+import math
+import os
+import socket
+import time
+import uuid
+from datetime import timedelta
+from typing import Awaitable, Callable, List, Optional, Set
+
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app import models, settings
+from app.database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class ShardCoordinator:
+    """Распределение шардов устройств между процессами через аренды в БД.
+
+    Устройство относится к шарду Device.id % shards. Каждый процесс раз в
+    heartbeat_seconds отмечается в poll_workers, продлевает свои аренды,
+    отдаёт шарды сверх справедливой доли и забирает свободные или
+    просроченные. Шарды упавшего процесса освобождаются по истечении аренды.
+    """
+
+    def __init__(self, shards: int = None, lease_seconds: float = None, heartbeat_seconds: float = None):
+        self.shards = shards or settings.POLL_SHARDS
+        self.lease_seconds = lease_seconds or settings.POLL_LEASE_SECONDS
+        self.heartbeat_seconds = heartbeat_seconds or settings.POLL_HEARTBEAT_SECONDS
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.owned: Set[int] = set()
+        self.live_workers = 0
+        self._valid_until = 0.0  # По monotonic: после этого момента аренды считаются потерянными
+        self._initialized = False
+        self._listeners: List[Callable[[], Awaitable]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def shard_of(self, device_id: int) -> int:
+        return device_id % self.shards
+
+    def owns(self, device_id: int) -> bool:
+        """Опрашивать ли устройство этому процессу; без продления аренд — нет"""
+        return time.monotonic() < self._valid_until and self.shard_of(device_id) in self.owned
+
+    def device_filter(self):
+        """Условие выборки устройств своих шардов"""
+        return (models.Device.id % self.shards).in_(sorted(self.owned))
+
+    def listen(self, callback: Callable[[], Awaitable]):
+        """Вызов callback после изменения набора своих шардов"""
+        self._listeners.append(callback)
+        return callback
+
+    async def heartbeat(self) -> bool:
+        """Отметка процесса, продление и перераспределение аренд; True, если набор шардов изменился"""
+        started = time.monotonic()
+        now = models.utcnow()
+        expires_at = now + timedelta(seconds=self.lease_seconds)
+        previous = set(self.owned)
+
+        async with AsyncSessionLocal() as db:
+            insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+            if not self._initialized:
+                await db.execute(
+                    insert(models.PollLease).on_conflict_do_nothing(index_elements=[models.PollLease.shard]),
+                    [{"shard": shard, "worker_id": None, "expires_at": now} for shard in range(self.shards)],
+                )
+            query = insert(models.PollWorker).values(
+                id=self.worker_id, hostname=socket.gethostname(), pid=os.getpid(), started_at=now, heartbeat_at=now
+            )
+            await db.execute(query.on_conflict_do_update(
+                index_elements=[models.PollWorker.id], set_={"heartbeat_at": now}
+            ))
+            # Записи давно пропавших процессов больше не нужны
+            await db.execute(delete(models.PollWorker).where(
+                models.PollWorker.heartbeat_at < now - timedelta(seconds=self.lease_seconds * 10)
+            ))
+            self.live_workers = await db.scalar(
+                select(func.count()).select_from(models.PollWorker)
+                .where(models.PollWorker.heartbeat_at >= now - timedelta(seconds=self.lease_seconds))
+            )
+
+            # Продлеваются только не истёкшие аренды: истёкшую мог забрать другой процесс
+            await db.execute(
+                update(models.PollLease)
+                .where(models.PollLease.worker_id == self.worker_id, models.PollLease.expires_at >= now)
+                .values(expires_at=expires_at)
+            )
+            owned = set(await db.scalars(
+                select(models.PollLease.shard)
+                .where(models.PollLease.worker_id == self.worker_id, models.PollLease.expires_at >= now)
+            ))
+
+            fair_share = math.ceil(self.shards / max(self.live_workers, 1))
+            if len(owned) > fair_share:
+                extra = sorted(owned)[fair_share:]
+                await db.execute(
+                    update(models.PollLease)
+                    .where(models.PollLease.shard.in_(extra), models.PollLease.worker_id == self.worker_id)
+                    .values(worker_id=None, expires_at=now)
+                )
+                owned.difference_update(extra)
+            elif len(owned) < fair_share:
+                free = await db.scalars(
+                    select(models.PollLease.shard)
+                    .where(or_(models.PollLease.worker_id.is_(None), models.PollLease.expires_at < now))
+                    .order_by(models.PollLease.shard)
+                    .limit(fair_share - len(owned))
+                )
+                for shard in free.all():
+                    # Условное обновление: из двух процессов шард получит только один
+                    result = await db.execute(
+                        update(models.PollLease)
+                        .where(
+                            models.PollLease.shard == shard,
+                            or_(models.PollLease.worker_id.is_(None), models.PollLease.expires_at < now),
+                        )
+                        .values(worker_id=self.worker_id, expires_at=expires_at)
+                    )
+                    if result.rowcount:
+                        owned.add(shard)
+            await db.commit()
+
+        self._initialized = True
+        self.owned = owned
+        self._valid_until = started + self.lease_seconds
+        if owned != previous:
+            logger.info(f"Poll worker {self.worker_id} owns {len(owned)}/{self.shards} shards ({self.live_workers} workers)")
+        return owned != previous
+
+    async def release(self):
+        """Освобождение аренд при остановке, чтобы другие процессы забрали шарды сразу"""
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(models.PollLease)
+                .where(models.PollLease.worker_id == self.worker_id)
+                .values(worker_id=None, expires_at=models.utcnow())
+            )
+            await db.execute(delete(models.PollWorker).where(models.PollWorker.id == self.worker_id))
+            await db.commit()
+        self.owned = set()
+        self._valid_until = 0.0
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_seconds)
+            try:
+                changed = await self.heartbeat()
+            except Exception as e:
+                logger.error(f"Poll shard heartbeat failed: {str(e)}")
+                continue
+            if changed:
+                for callback in self._listeners:
+                    await callback()
+
+    async def start(self):
+        """Первая раздача шардов до запуска опроса, затем фоновое продление"""
+        await self.heartbeat()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await self.release()
+        except Exception as e:
+            logger.error(f"Failed to release poll shards: {str(e)}")
+
+    def stats(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "shards": self.shards,
+            "owned": sorted(self.owned),
+            "live_workers": self.live_workers,
+            "lease_valid_for": max(self._valid_until - time.monotonic(), 0.0),
+        }
+
+
+shard_coordinator = ShardCoordinator()
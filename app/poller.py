@@ -0,0 +1,288 @@
+# ydm/app/poller.py
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import insert, select, update
+
+from app import metrics, models, settings, utils
+from app.database import AsyncSessionLocal
+from app.event_relay import event_relay
+from app.events import event_bus, event_ingestor
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Outcome:
+    """Результат выполнения задачи для одного элемента"""
+    item: Any
+    result: Any = None
+    error: Optional[BaseException] = None
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+async def run_bounded(
+    items: Iterable[Any],
+    func: Callable[[Any], Awaitable[Any]],
+    concurrency: int,
+    deadline: Optional[float] = None,
+) -> AsyncIterator[Outcome]:
+    """Выполняет func для каждого элемента не более чем в concurrency потоков,
+    отдавая результаты по мере готовности.
+
+    Если задан deadline (сек), незавершённые к этому моменту элементы
+    возвращаются с ошибкой asyncio.TimeoutError.
+    """
+    loop = asyncio.get_running_loop()
+    end = loop.time() + deadline if deadline is not None else None
+    pending = iter(items)
+    results: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def worker():
+        try:
+            for item in pending:
+                started = time.perf_counter()
+                try:
+                    if end is None:
+                        result = await func(item)
+                    else:
+                        remaining = end - loop.time()
+                        if remaining <= 0:
+                            raise asyncio.TimeoutError()
+                        result = await asyncio.wait_for(func(item), timeout=remaining)
+                    outcome = Outcome(item, result=result)
+                except Exception as e:
+                    outcome = Outcome(item, error=e)
+                outcome.elapsed = time.perf_counter() - started
+                await results.put(outcome)
+        finally:
+            await results.put(done)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, concurrency))]
+    try:
+        finished = 0
+        while finished < len(workers):
+            outcome = await results.get()
+            if outcome is done:
+                finished += 1
+                continue
+            yield outcome
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+@dataclass
+class SweepReport:
+    """Итоги одного обхода устройств"""
+    started_at: datetime
+    duration: float = 0.0
+    total: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    timed_out: int = 0
+    slowest: List[Tuple[int, float]] = field(default_factory=list)  # (device_id, сек)
+    latency_p50: float = 0.0  # Время ответа устройства, сек
+    latency_p99: float = 0.0
+
+
+# Итоги последнего обхода для API
+last_report: Optional[SweepReport] = None
+
+
+def status_values(device_id: int, text: str) -> dict:
+    """Значения для записи статуса: исходный ответ и разобранные из него поля"""
+    parsed = utils.parse_status(text)
+    if parsed["account_states"] is not None:
+        parsed["account_states"] = json.dumps(parsed["account_states"], sort_keys=True)
+    return {"id": device_id, "last_status": text, "status_at": models.utcnow(), **parsed}
+
+
+HISTORY_FIELDS = ("registered", "account_states", "dnd", "firmware", "uptime")
+
+# Поля, по которым определяется смена статуса (аптайм растёт при каждом опросе)
+FINGERPRINT_FIELDS = ("registered", "account_states", "dnd", "firmware")
+
+
+class StatusFingerprints:
+    """Отпечатки последних записанных статусов устройств.
+
+    Позволяют писать в БД только изменившиеся статусы; у неизменных
+    status_at обновляется не чаще раза в STATUS_TOUCH_SECONDS.
+    """
+
+    def __init__(self, touch_seconds: float = None):
+        self.touch_seconds = touch_seconds or settings.STATUS_TOUCH_SECONDS
+        self._prints: Dict[int, Tuple[bytes, datetime]] = {}  # device_id -> (отпечаток, когда записан)
+
+    @staticmethod
+    def fingerprint(values: dict) -> bytes:
+        fields = [values.get(key) for key in FINGERPRINT_FIELDS]
+        if all(field is None for field in fields):
+            # Ответ не разобран — сравниваем исходный текст
+            fields = [values.get("last_status")]
+        return hashlib.blake2b(json.dumps(fields).encode("utf-8"), digest_size=8).digest()
+
+    async def seed(self):
+        """Загрузка отпечатков из БД при старте"""
+        async with AsyncSessionLocal() as db:
+            rows = await db.execute(select(
+                models.Device.id, models.Device.last_status, models.Device.status_at,
+                *(getattr(models.Device, key) for key in FINGERPRINT_FIELDS)
+            ))
+            for row in rows.mappings():
+                if row["status_at"] is not None:
+                    self._prints[row["id"]] = (self.fingerprint(row), row["status_at"])
+
+    def split(self, batch: List[dict]) -> Tuple[List[dict], List[int], Dict[int, Tuple[bytes, datetime]]]:
+        """Делит пачку на изменившиеся статусы и устройства, которым пора обновить status_at.
+        Новые отпечатки возвращаются отдельно и применяются (apply) только после коммита:
+        иначе при сбое записи следующий такой же статус счёлся бы уже записанным"""
+        changed, touched, prints = [], [], {}
+        for values in batch:
+            device_id = values["id"]
+            fingerprint = self.fingerprint(values)
+            previous = prints.get(device_id) or self._prints.get(device_id)
+            if previous is None or previous[0] != fingerprint:
+                changed.append(values)
+            elif (values["status_at"] - previous[1]).total_seconds() >= self.touch_seconds:
+                touched.append(device_id)
+            else:
+                continue
+            prints[device_id] = (fingerprint, values["status_at"])
+        return changed, touched, prints
+
+    def apply(self, prints: Dict[int, Tuple[bytes, datetime]]):
+        self._prints.update(prints)
+
+    async def reseed(self, device_ids: List[int], batch_size: int = 500):
+        """Отпечатки по значениям из БД для устройств, перешедших к этому процессу: прежний
+        владелец шарда мог записать статус, которого здесь нет"""
+        async with AsyncSessionLocal() as db:
+            for start in range(0, len(device_ids), batch_size):
+                chunk = device_ids[start:start + batch_size]
+                rows = await db.execute(
+                    select(
+                        models.Device.id, models.Device.last_status, models.Device.status_at,
+                        *(getattr(models.Device, key) for key in FINGERPRINT_FIELDS)
+                    ).where(models.Device.id.in_(chunk))
+                )
+                for row in rows.mappings():
+                    if row["status_at"] is None:
+                        self._prints.pop(row["id"], None)
+                    else:
+                        self._prints[row["id"]] = (self.fingerprint(row), row["status_at"])
+
+    def on_remote_event(self, kind: str, data: dict):
+        """Статус, записанный другим процессом (например, ручным обходом), сбрасывает отпечаток"""
+        if kind == "device_status":
+            self._prints.pop(data.get("device_id"), None)
+
+    def forget(self, device_id: int):
+        self._prints.pop(device_id, None)
+
+    def forget_many(self, device_ids: Iterable[int]):
+        for device_id in device_ids:
+            self._prints.pop(device_id, None)
+
+
+status_fingerprints = StatusFingerprints()
+# Событие Action URL меняет registered и dnd в обход отпечатков: следующий опрос запишет статус
+event_ingestor.listen(status_fingerprints.forget_many)
+event_relay.listen(status_fingerprints.on_remote_event)
+
+
+async def store_statuses(db_session, batch: List[dict]):
+    """Пакетная запись изменившихся статусов и их истории одним коммитом"""
+    changed, touched, prints = status_fingerprints.split(batch)
+    batch.clear()
+    if changed:
+        await db_session.execute(update(models.Device), changed)
+        await db_session.execute(insert(models.DeviceStatusHistory), [
+            {"device_id": values["id"], "recorded_at": values["status_at"],
+             **{key: values.get(key) for key in HISTORY_FIELDS}}
+            for values in changed
+        ])
+    if touched:
+        await db_session.execute(
+            update(models.Device)
+            .where(models.Device.id.in_(touched))
+            .values(status_at=models.utcnow(), updated_at=models.Device.updated_at)
+        )
+    if changed or touched:
+        await db_session.commit()
+    status_fingerprints.apply(prints)
+    for values in changed:
+        event_bus.publish("device_status", {
+            "device_id": values["id"],
+            "status_at": values["status_at"].isoformat(),
+            **{key: values.get(key) for key in HISTORY_FIELDS},
+        })
+
+
+async def collect_device_statuses(
+    concurrency: int = None,
+    deadline: float = None,
+    batch_size: int = None,
+) -> SweepReport:
+    """Параллельный сбор статусов всех устройств через общий клиент приложения"""
+    global last_report
+
+    concurrency = concurrency or settings.POLL_CONCURRENCY
+    deadline = deadline or settings.POLL_DEADLINE
+    batch_size = batch_size or settings.POLL_BATCH_SIZE
+
+    report = SweepReport(started_at=models.utcnow())
+    started = time.perf_counter()
+    timings: List[Tuple[int, float]] = []
+
+    async with AsyncSessionLocal() as db_session:
+        devices = (await db_session.scalars(select(models.Device))).all()
+        # Отсоединяем объекты: пакетные коммиты не должны перечитывать их из БД
+        db_session.expunge_all()
+        report.total = len(devices)
+        client = utils.get_yealink_client()
+
+        batch: List[dict] = []
+        async for outcome in run_bounded(devices, client.get_status, concurrency, deadline):
+            device = outcome.item
+            timings.append((device.id, outcome.elapsed))
+            if outcome.ok:
+                report.succeeded += 1
+                batch.append(status_values(device.id, outcome.result))
+                if len(batch) >= batch_size:
+                    await store_statuses(db_session, batch)
+            else:
+                report.failed += 1
+                if isinstance(outcome.error, asyncio.TimeoutError):
+                    report.timed_out += 1
+                logger.error(f"Failed to get status for device {device.id}: {str(outcome.error)}")
+        await store_statuses(db_session, batch)
+
+    report.duration = time.perf_counter() - started
+    metrics.sweep_duration_seconds.observe(report.duration)
+    for result in ("total", "succeeded", "failed", "timed_out"):
+        metrics.sweep_devices.labels(result).set(getattr(report, result))
+    ordered = sorted(timings, key=lambda t: t[1], reverse=True)
+    report.slowest = ordered[:settings.POLL_SLOWEST_REPORTED]
+    if ordered:
+        report.latency_p50 = ordered[len(ordered) // 2][1]
+        report.latency_p99 = ordered[len(ordered) // 100][1]
+    last_report = report
+    logger.info(
+        f"Status sweep finished in {report.duration:.1f}s: "
+        f"{report.succeeded} ok, {report.failed} failed ({report.timed_out} timed out) of {report.total}"
+    )
+    return report
@@ -1,8 +1,12 @@
 # ydm/app/schemas.py
-from pydantic import BaseModel, Field, ConfigDict
-from typing import Optional
+from pydantic import BaseModel, Field, ConfigDict, field_validator, model_validator
+from typing import Any, Dict, List, Literal, Optional, Tuple
+import ipaddress
+import json
 from datetime import datetime
 
+from app.config_templates import config_templates
+
 class DeviceModelBase(BaseModel):
     name: str = Field(..., example="T54S")
     firmware: Optional[str] = Field(None, example="96.86.0.5")
@@ -23,13 +27,42 @@ class DeviceBase(BaseModel):
     password: str = Field("admin", example="admin")
     config_id: Optional[int] = None
     model_id: Optional[int] = None
+    variables: Optional[Dict[str, Any]] = Field(None, example={"extension": "1001", "display_name": "Reception"})
+
+    @field_validator("variables", mode="before")
+    @classmethod
+    def load_variables(cls, value):
+        # В БД и в формах переменные приходят JSON-строкой
+        if isinstance(value, str):
+            return json.loads(value) if value.strip() else None
+        return value
 
 class DeviceCreate(DeviceBase):
     pass
 
-class Device(DeviceBase):
+class DeviceStatusFields(BaseModel):
+    """Разобранный статус устройства"""
+    registered: Optional[bool] = None
+    account_states: Optional[Dict[str, str]] = None
+    dnd: Optional[bool] = None
+    firmware: Optional[str] = None
+    uptime: Optional[int] = None
+
+    @field_validator("account_states", mode="before")
+    @classmethod
+    def load_account_states(cls, value):
+        # В БД состояния линий хранятся JSON-строкой
+        return json.loads(value) if isinstance(value, str) else value
+
+class Device(DeviceBase, DeviceStatusFields):
     id: int
     last_status: Optional[str] = None
+    status_at: Optional[datetime] = None
+    provisioned_at: Optional[datetime] = None
+    last_event: Optional[str] = None
+    last_event_at: Optional[datetime] = None
+    applied_config_hash: Optional[str] = None
+    applied_at: Optional[datetime] = None
     created_at: datetime
     updated_at: datetime
     config: Optional["Config"] = None
@@ -42,12 +75,104 @@ class ConfigBase(BaseModel):
     content: str = Field(..., example="<YealinkIPPhoneConfiguration>...</YealinkIPPhoneConfiguration>")
 
 class ConfigCreate(ConfigBase):
+    @field_validator("content")
+    @classmethod
+    def check_template(cls, value):
+        # Содержимое может быть шаблоном Jinja2 с переменными устройства; синтаксис проверяется
+        # только на входе: ответы с уже сохранёнными конфигурациями не компилируют шаблон
+        config_templates.compile(value)
+        return value
+
+class ConfigUpdate(ConfigCreate):
     pass
 
 class Config(ConfigBase):
     id: int
+    content_hash: str
+    version: int
+    created_at: datetime
+    updated_at: datetime
+
+    model_config = ConfigDict(from_attributes=True)
+
+class ConfigListItem(BaseModel):
+    """Конфигурация в списке: без XML-содержимого"""
+    id: int
+    name: str
+    content_hash: str
+    version: int
+    created_at: datetime
+    updated_at: datetime
+
+    model_config = ConfigDict(from_attributes=True)
+
+class ConfigVersion(BaseModel):
+    version: int
+    content_hash: str
+    size: int  # Размер без сжатия, байт
+    created_at: datetime
+
+    model_config = ConfigDict(from_attributes=True)
+
+class ConfigVersionContent(ConfigVersion):
+    content: str
+
+class ConfigKeyMatch(BaseModel):
+    """Конфигурация, задающая ключ"""
+    config_id: int
+    config_name: str
+    version: int
+    key: str
+    value: str
+
+class DeviceKeyMatch(BaseModel):
+    """Устройство, конфигурация которого задаёт ключ"""
+    device_id: int
+    mac_address: str
+    ip_address: Optional[str] = None
+    config_id: int
+    config_name: str
+    value: str
+
+class ConfigKeyValue(BaseModel):
+    """Значение ключа и сколько конфигураций и устройств его получают"""
+    value: str
+    configs: int
+    devices: int
+
+class ConfigKeyChange(BaseModel):
+    old: str
+    new: str
+
+class ConfigDiff(BaseModel):
+    """Разница между версиями: по ключам (если обе версии — XML) и построчно"""
+    from_version: int
+    to_version: int
+    added: Optional[Dict[str, str]] = None
+    removed: Optional[Dict[str, str]] = None
+    changed: Optional[Dict[str, ConfigKeyChange]] = None
+    diff: str
+
+class ConfigSummary(BaseModel):
+    id: int
+    name: str
+
+    model_config = ConfigDict(from_attributes=True)
+
+class DeviceListItem(DeviceBase, DeviceStatusFields):
+    """Устройство в списке: конфигурация без XML-содержимого"""
+    id: int
+    last_status: Optional[str] = None
+    status_at: Optional[datetime] = None
+    provisioned_at: Optional[datetime] = None
+    last_event: Optional[str] = None
+    last_event_at: Optional[datetime] = None
+    applied_config_hash: Optional[str] = None
+    applied_at: Optional[datetime] = None
     created_at: datetime
     updated_at: datetime
+    config: Optional[ConfigSummary] = None
+    model: Optional[DeviceModel] = None
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -60,3 +185,170 @@ class CommandResponse(BaseModel):
     command: str
     response: str
     success: bool
+    job_id: Optional[int] = None  # Для команд, выполняемых через очередь заданий
+
+class CommandJobCreate(BaseModel):
+    command: Literal["reboot", "apply_config"]
+    config_id: Optional[int] = None
+    force: bool = Field(False, description="Отправить конфигурацию целиком, даже если она уже применена")
+
+    @model_validator(mode="after")
+    def check_config(self):
+        if self.command == "apply_config" and self.config_id is None:
+            raise ValueError("config_id is required for apply_config")
+        return self
+
+class CommandJob(BaseModel):
+    id: int
+    device_id: int
+    command: str
+    config_id: Optional[int] = None
+    force: bool = False
+    status: str
+    attempts: int
+    max_attempts: int
+    next_attempt_at: datetime
+    result: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+class SweepReport(BaseModel):
+    started_at: datetime
+    duration: float
+    total: int
+    succeeded: int
+    failed: int
+    timed_out: int
+    slowest: List[Tuple[int, float]] = []
+    latency_p50: float = 0.0
+    latency_p99: float = 0.0
+
+    model_config = ConfigDict(from_attributes=True)
+
+class DeviceSelector(BaseModel):
+    device_ids: Optional[List[int]] = None
+    model_id: Optional[int] = None
+    config_id: Optional[int] = None
+    ip_range: Optional[str] = Field(None, example="10.20.0.0/16")
+
+    @field_validator("ip_range")
+    @classmethod
+    def check_ip_range(cls, value):
+        if value is not None:
+            ipaddress.IPv4Network(value, strict=False)
+        return value
+
+    @model_validator(mode="after")
+    def check_not_empty(self):
+        if self.device_ids is None and self.model_id is None and self.config_id is None and self.ip_range is None:
+            raise ValueError("At least one selector criterion is required")
+        return self
+
+class DeviceFilter(BaseModel):
+    model_id: Optional[int] = None
+    config_id: Optional[int] = None
+    mac_prefix: Optional[str] = Field(None, example="00:15:65")
+    subnet: Optional[str] = Field(None, example="10.20.0.0/16")
+    fresh_within: Optional[int] = Field(None, description="Статус получен не позднее N секунд назад")
+    stale_for: Optional[int] = Field(None, description="Статус не обновлялся N секунд или не получен")
+    registered: Optional[bool] = None
+    firmware: Optional[str] = None
+
+    @field_validator("subnet")
+    @classmethod
+    def check_subnet(cls, value):
+        if value is not None:
+            ipaddress.IPv4Network(value, strict=False)
+        return value
+
+class BulkCommandRequest(BaseModel):
+    selector: DeviceSelector
+    config_id: Optional[int] = None  # Для apply_config
+    force: bool = False  # Для apply_config: отправить целиком, даже если уже применена
+    format: Literal["ndjson", "sse"] = "ndjson"
+
+class StatusHistoryEntry(DeviceStatusFields):
+    recorded_at: datetime
+
+    model_config = ConfigDict(from_attributes=True)
+
+class DiscoveryRequest(BaseModel):
+    cidrs: List[str] = Field(..., example=["10.20.0.0/22"])
+    username: str = "admin"
+    password: str = "admin"
+    concurrency: Optional[int] = Field(None, ge=1, le=1024)
+
+    @field_validator("cidrs")
+    @classmethod
+    def check_cidrs(cls, value):
+        if not value:
+            raise ValueError("At least one CIDR range is required")
+        for cidr in value:
+            ipaddress.IPv4Network(cidr, strict=False)
+        return value
+
+class DiscoveryJob(BaseModel):
+    id: str
+    cidrs: List[str]
+    status: str
+    total: int
+    probed: int
+    found: int
+    stored: int
+    error: Optional[str] = None
+    started_at: datetime
+    finished_at: Optional[datetime] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+class ImportRowError(BaseModel):
+    line: int
+    error: str
+
+class ImportReport(BaseModel):
+    processed: int
+    stored: int
+    failed: int
+    errors: List[ImportRowError]
+
+    model_config = ConfigDict(from_attributes=True)
+
+class SummaryGroup(BaseModel):
+    id: Optional[int] = None  # None — устройства без модели
+    name: Optional[str] = None
+    devices: int
+
+class SummaryFailure(BaseModel):
+    job_id: int
+    device_id: int
+    mac_address: str
+    command: str
+    result: str
+    finished_at: datetime
+
+class DashboardSummary(BaseModel):
+    generated_at: datetime
+    devices: int
+    device_models: int
+    configs: int
+    registered: int
+    unregistered: int
+    never_polled: int
+    stale: int  # Статус старше YDM_DASHBOARD_STALE_SECONDS
+    without_config: int
+    by_model: List[SummaryGroup]
+    by_config: List[SummaryGroup]
+    jobs_queued: int
+    jobs_running: int
+    jobs_failed: int  # За последние YDM_DASHBOARD_FAILURES_HOURS часов
+    recent_failures: List[SummaryFailure]
+
+class ConfigPushRequest(BaseModel):
+    force: bool = False
+
+class ConfigRender(BaseModel):
+    device_id: int
+    content: str
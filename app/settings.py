@@ -0,0 +1,93 @@
+# ydm/app/settings.py
+import os
+
+# Фоновый опрос статусов устройств. При настроенных на телефонах Action URL
+# опрос служит страховкой и интервал можно увеличить (например, до 60 минут)
+POLL_INTERVAL_MINUTES = int(os.getenv("YDM_POLL_INTERVAL_MINUTES", "10"))
+POLL_CONCURRENCY = int(os.getenv("YDM_POLL_CONCURRENCY", "100"))  # Одновременных запросов к телефонам
+POLL_DEADLINE = float(os.getenv("YDM_POLL_DEADLINE", "540"))  # Предельная длительность одного обхода, сек
+POLL_BATCH_SIZE = int(os.getenv("YDM_POLL_BATCH_SIZE", "200"))  # Устройств в одном коммите
+POLL_SLOWEST_REPORTED = int(os.getenv("YDM_POLL_SLOWEST_REPORTED", "10"))
+POLL_JITTER = float(os.getenv("YDM_POLL_JITTER", "0.1"))  # Доля случайного разброса интервала
+POLL_MAX_BACKOFF = float(os.getenv("YDM_POLL_MAX_BACKOFF", "3600"))  # Предельная пауза для недоступных, сек
+POLL_CHANGED_FACTOR = float(os.getenv("YDM_POLL_CHANGED_FACTOR", "0.25"))  # Доля интервала после смены статуса
+STATUS_TOUCH_SECONDS = int(os.getenv("YDM_STATUS_TOUCH_SECONDS", "3600"))  # Как часто обновлять status_at без изменений
+POLL_SYNC_SECONDS = int(os.getenv("YDM_POLL_SYNC_SECONDS", "60"))  # Сверка списка устройств с БД
+POLL_FLUSH_SECONDS = float(os.getenv("YDM_POLL_FLUSH_SECONDS", "1.0"))  # Запись результатов опроса не реже, сек
+
+# Распределение опроса между процессами (uvicorn --workers, реплики) через аренды в БД
+POLL_SHARDS = int(os.getenv("YDM_POLL_SHARDS", "64"))  # Устройство попадает в шард Device.id % POLL_SHARDS
+POLL_LEASE_SECONDS = float(os.getenv("YDM_POLL_LEASE_SECONDS", "30"))  # Срок аренды; должен заметно превышать расхождение часов узлов
+POLL_HEARTBEAT_SECONDS = float(os.getenv("YDM_POLL_HEARTBEAT_SECONDS", "10"))  # Продление аренд и перераспределение
+
+# Массовые команды
+BULK_CONCURRENCY = int(os.getenv("YDM_BULK_CONCURRENCY", "200"))
+BULK_DEADLINE = float(os.getenv("YDM_BULK_DEADLINE", "120"))
+
+# HTTPS-порт веб-интерфейса телефонов (другой порт нужен для симулятора bench/simulator.py)
+DEVICE_PORT = int(os.getenv("YDM_DEVICE_PORT", "443"))
+
+# Фоновое выполнение команд (перезагрузка, применение конфигурации)
+JOBS_CONCURRENCY = int(os.getenv("YDM_JOBS_CONCURRENCY", "50"))  # Одновременно выполняемых заданий в процессе
+JOBS_MAX_ATTEMPTS = int(os.getenv("YDM_JOBS_MAX_ATTEMPTS", "5"))
+JOBS_BACKOFF_SECONDS = float(os.getenv("YDM_JOBS_BACKOFF_SECONDS", "10"))  # Пауза перед первым повтором, далее удваивается
+JOBS_MAX_BACKOFF = float(os.getenv("YDM_JOBS_MAX_BACKOFF", "600"))
+JOBS_LEASE_SECONDS = float(os.getenv("YDM_JOBS_LEASE_SECONDS", "120"))  # Через сколько зависшее задание вернётся в очередь
+JOBS_POLL_SECONDS = float(os.getenv("YDM_JOBS_POLL_SECONDS", "2"))  # Проверка очереди в БД (повторы, задания других процессов)
+
+# Конфигурации-шаблоны Jinja2 с переменными устройств
+TEMPLATE_CACHE_SIZE = int(os.getenv("YDM_TEMPLATE_CACHE_SIZE", "500"))  # Скомпилированных шаблонов
+TEMPLATE_RENDER_CACHE_SIZE = int(os.getenv("YDM_TEMPLATE_RENDER_CACHE_SIZE", "20000"))  # Готовых конфигураций устройств
+
+# Отправка конфигураций: только изменённые ключи относительно применённой на телефоне версии
+CONFIG_PUSH_CACHE_SIZE = int(os.getenv("YDM_CONFIG_PUSH_CACHE_SIZE", "1000"))  # Версий и дельт в памяти
+
+# Пул HTTP-соединений к телефонам
+HTTP_MAX_CONNECTIONS = int(os.getenv("YDM_HTTP_MAX_CONNECTIONS", "500"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("YDM_HTTP_MAX_KEEPALIVE", "500"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("YDM_HTTP_KEEPALIVE_EXPIRY", "120"))  # Сек простоя до закрытия
+HTTP_MAX_PER_HOST = int(os.getenv("YDM_HTTP_MAX_PER_HOST", "2"))  # Телефоны плохо держат много соединений
+
+# Кэш справочников для форм, сек
+REFERENCE_CACHE_TTL = float(os.getenv("YDM_REFERENCE_CACHE_TTL", "300"))
+
+# Сводка на главной странице (/dashboard/summary)
+DASHBOARD_CACHE_TTL = float(os.getenv("YDM_DASHBOARD_CACHE_TTL", "30"))  # Сек; запись в БД сбрасывает сводку раньше
+DASHBOARD_STALE_SECONDS = int(os.getenv("YDM_DASHBOARD_STALE_SECONDS", str(POLL_INTERVAL_MINUTES * 60 * 3)))  # Статус считается устаревшим
+DASHBOARD_FAILURES_HOURS = int(os.getenv("YDM_DASHBOARD_FAILURES_HOURS", "24"))  # Окно для неудачных команд
+DASHBOARD_RECENT_FAILURES = int(os.getenv("YDM_DASHBOARD_RECENT_FAILURES", "10"))
+DASHBOARD_TOP = int(os.getenv("YDM_DASHBOARD_TOP", "20"))  # Моделей и конфигураций в разбивке
+
+# Автопровижининг: число конфигураций, хранимых в памяти в готовом виде
+PROVISION_CACHE_SIZE = int(os.getenv("YDM_PROVISION_CACHE_SIZE", "1000"))
+PROVISION_TOUCH_SECONDS = int(os.getenv("YDM_PROVISION_TOUCH_SECONDS", "300"))  # Как часто обновлять provisioned_at
+
+# События Action URL от телефонов
+EVENTS_MAX_QUEUE = int(os.getenv("YDM_EVENTS_MAX_QUEUE", "50000"))
+EVENTS_BATCH_SIZE = int(os.getenv("YDM_EVENTS_BATCH_SIZE", "500"))
+EVENTS_FLUSH_INTERVAL = float(os.getenv("YDM_EVENTS_FLUSH_INTERVAL", "1.0"))  # Сек
+
+# Поток событий в браузер (/live/events)
+LIVE_THROTTLE_SECONDS = float(os.getenv("YDM_LIVE_THROTTLE_SECONDS", "1.0"))  # Не чаще одной отправки клиенту
+LIVE_MAX_PENDING = int(os.getenv("YDM_LIVE_MAX_PENDING", "5000"))  # Больше — клиенту отправляется resync
+LIVE_PING_SECONDS = float(os.getenv("YDM_LIVE_PING_SECONDS", "15"))
+
+# Передача событий шины (статусы, команды, сброс сводки) между процессами через таблицу bus_events
+RELAY_INTERVAL_SECONDS = float(os.getenv("YDM_RELAY_INTERVAL_SECONDS", "1.0"))  # Запись и чтение событий
+RELAY_RETENTION_SECONDS = float(os.getenv("YDM_RELAY_RETENTION_SECONDS", "300"))  # Сколько хранить события
+RELAY_GAP_SECONDS = float(os.getenv("YDM_RELAY_GAP_SECONDS", "30"))  # Ожидание событий из незавершённых транзакций
+
+# Учёт доступности телефонов
+HEALTH_FAILURE_THRESHOLD = int(os.getenv("YDM_HEALTH_FAILURE_THRESHOLD", "3"))  # Неудач подряд до отключения
+HEALTH_OPEN_SECONDS = float(os.getenv("YDM_HEALTH_OPEN_SECONDS", "300"))  # Пауза до повторной проверки
+HEALTH_PROBE_TIMEOUT = float(os.getenv("YDM_HEALTH_PROBE_TIMEOUT", "1.0"))  # Таймаут TCP-проверки
+HEALTH_IDLE_SECONDS = float(os.getenv("YDM_HEALTH_IDLE_SECONDS", "3600"))  # Забывать телефоны без запросов
+
+# Поиск телефонов в подсетях
+DISCOVERY_CONCURRENCY = int(os.getenv("YDM_DISCOVERY_CONCURRENCY", "256"))
+DISCOVERY_BATCH_SIZE = int(os.getenv("YDM_DISCOVERY_BATCH_SIZE", "200"))
+DISCOVERY_MAX_ADDRESSES = int(os.getenv("YDM_DISCOVERY_MAX_ADDRESSES", "65536"))
+
+# Импорт и экспорт устройств и конфигураций
+TRANSFER_BATCH_SIZE = int(os.getenv("YDM_TRANSFER_BATCH_SIZE", "1000"))  # Строк на один INSERT
+TRANSFER_MAX_ERRORS = int(os.getenv("YDM_TRANSFER_MAX_ERRORS", "1000"))  # Ошибок в отчёте, остальные только считаются
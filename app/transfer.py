@@ -0,0 +1,244 @@
+# ydm/app/transfer.py
+# Потоковый импорт и экспорт устройств и конфигураций в CSV/JSONL
+import csv
+import io
+import json
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import async_crud, models, settings
+from app.config_templates import ConfigTemplateError, config_templates
+from app.database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+DEVICE_FIELDS = ("mac_address", "ip_address", "username", "password", "model", "config", "variables")
+CONFIG_FIELDS = ("name", "content")
+
+# Поля, обновляемые у существующего устройства при импорте
+DEVICE_UPSERT_FIELDS = ("ip_address", "ip_int", "username", "password", "model_id", "config_id", "variables")
+
+MAC_PATTERN = re.compile(r"([0-9A-F]{2}:){5}[0-9A-F]{2}")
+
+
+class RowError(ValueError):
+    """Строка файла не прошла проверку"""
+
+
+@dataclass
+class ImportReport:
+    """Итог импорта: сколько строк записано и какие отклонены"""
+    processed: int = 0
+    stored: int = 0
+    failed: int = 0
+    errors: List[dict] = field(default_factory=list)
+
+    def add_error(self, line: int, error: str):
+        self.failed += 1
+        if len(self.errors) < settings.TRANSFER_MAX_ERRORS:
+            self.errors.append({"line": line, "error": error})
+
+
+def read_rows(stream, format: str) -> Iterator[Tuple[int, dict]]:
+    """Построчное чтение загруженного файла: (номер строки, словарь полей)"""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if format == "csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_num, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            row = RowError(f"Invalid JSON: {str(e)}")
+        yield line_num, row if isinstance(row, (dict, RowError)) else RowError("Expected a JSON object")
+
+
+def _text(row: dict, key: str) -> str:
+    value = row.get(key)
+    return str(value).strip() if value is not None else ""
+
+
+async def _lookup(db: AsyncSession, model) -> Dict[str, int]:
+    rows = await db.execute(select(model.name, model.id))
+    return dict(rows.all())
+
+
+def _variables(value):
+    """Переменные шаблона: объект в JSONL или JSON-строка в CSV"""
+    if isinstance(value, str):
+        if not value.strip():
+            return None
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise RowError("Invalid variables JSON")
+    if value is None:
+        return None
+    if not isinstance(value, dict):
+        raise RowError("Variables must be a JSON object")
+    return json.dumps(value, ensure_ascii=False, sort_keys=True)
+
+
+def device_row(row: dict, model_ids: Dict[str, int], config_ids: Dict[str, int]) -> dict:
+    """Проверка строки устройства и перевод в значения колонок"""
+    mac_address = models.normalize_mac(_text(row, "mac_address"))
+    if not MAC_PATTERN.fullmatch(mac_address or ""):
+        raise RowError("Invalid MAC address")
+    ip_address = _text(row, "ip_address")
+    ip_int = models.ip_to_int(ip_address)
+    if ip_int is None:
+        raise RowError("Invalid IP address")
+    values = {
+        "mac_address": mac_address,
+        "ip_address": ip_address,
+        "ip_int": ip_int,
+        "username": _text(row, "username") or "admin",
+        "password": _text(row, "password") or "admin",
+        "model_id": None,
+        "config_id": None,
+        "variables": _variables(row.get("variables")),
+    }
+    for key, ids in (("model", model_ids), ("config", config_ids)):
+        name = _text(row, key)
+        if name:
+            if name not in ids:
+                raise RowError(f"Unknown {key}: {name}")
+            values[f"{key}_id"] = ids[name]
+    return values
+
+
+def config_row(row: dict, *_) -> dict:
+    name = _text(row, "name")
+    if not name:
+        raise RowError("Config name is required")
+    if len(name) > 100:
+        raise RowError("Config name is too long")
+    content = row.get("content")
+    if not isinstance(content, str) or not content.strip():
+        raise RowError("Config content is required")
+    try:
+        # Как и при сохранении через API: шаблон с ошибкой не должен дойти до автопровижининга
+        config_templates.compile(content)
+    except ConfigTemplateError as e:
+        raise RowError(str(e))
+    return {"name": name, "content": content}
+
+
+async def _store_batch(report: ImportReport, batch: Dict[str, Tuple[int, dict]], store: Callable):
+    """Запись пачки одним запросом; при ошибке пачка пишется построчно, чтобы найти виноватую строку"""
+    rows = [values for _, values in batch.values()]
+    try:
+        await store(rows)
+        report.stored += len(rows)
+        return
+    except SQLAlchemyError as e:
+        logger.warning(f"Batch import of {len(rows)} rows failed, retrying row by row: {str(e)}")
+    for line_num, values in batch.values():
+        try:
+            await store([values])
+            report.stored += 1
+        except SQLAlchemyError as e:
+            report.add_error(line_num, str(e.orig if hasattr(e, "orig") else e))
+
+
+async def import_rows(kind: str, rows: Iterator[Tuple[int, dict]]) -> ImportReport:
+    """Импорт устройств (ключ — MAC) или конфигураций (ключ — имя) пачками по TRANSFER_BATCH_SIZE"""
+    report = ImportReport()
+    async with AsyncSessionLocal() as db:
+        if kind == "devices":
+            key, convert = "mac_address", device_row
+            lookups = (await _lookup(db, models.DeviceModel), await _lookup(db, models.Config))
+
+            async def store(batch_rows):
+                try:
+                    await async_crud.upsert_devices(db, batch_rows, DEVICE_UPSERT_FIELDS)
+                except SQLAlchemyError:
+                    await db.rollback()
+                    raise
+        else:
+            key, convert, lookups = "name", config_row, ()
+
+            async def store(batch_rows):
+                try:
+                    await async_crud.upsert_configs(db, batch_rows)
+                except SQLAlchemyError:
+                    await db.rollback()
+                    raise
+
+        # Повтор ключа внутри пачки: ON CONFLICT не обновляет строку дважды, побеждает последняя
+        batch: Dict[str, Tuple[int, dict]] = {}
+        for line_num, row in rows:
+            report.processed += 1
+            try:
+                if isinstance(row, RowError):
+                    raise row
+                values = convert(row, *lookups)
+            except RowError as e:
+                report.add_error(line_num, str(e))
+                continue
+            batch.pop(values[key], None)
+            batch[values[key]] = (line_num, values)
+            if len(batch) >= settings.TRANSFER_BATCH_SIZE:
+                await _store_batch(report, batch, store)
+                batch = {}
+        if batch:
+            await _store_batch(report, batch, store)
+    return report
+
+
+def _write(format: str, fields: tuple, rows: list, header: bool = False) -> str:
+    buffer = io.StringIO()
+    if format == "csv":
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(fields)
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            buffer.write(json.dumps(dict(zip(fields, row)), ensure_ascii=False) + "\n")
+    return buffer.getvalue()
+
+
+async def export_rows(kind: str, format: str) -> AsyncIterator[str]:
+    """Выгрузка через серверный курсор: в памяти не больше одной пачки строк"""
+    if kind == "devices":
+        fields = DEVICE_FIELDS
+        query = (
+            select(
+                models.Device.mac_address, models.Device.ip_address, models.Device.username,
+                models.Device.password, models.DeviceModel.name, models.Config.name, models.Device.variables,
+            )
+            .outerjoin(models.DeviceModel, models.Device.model_id == models.DeviceModel.id)
+            .outerjoin(models.Config, models.Device.config_id == models.Config.id)
+            .order_by(models.Device.id)
+        )
+    else:
+        fields = CONFIG_FIELDS
+        query = (
+            select(models.Config.name, models.ConfigBlob.data)
+            .join(models.ConfigBlob, models.Config.content_hash == models.ConfigBlob.hash)
+            .order_by(models.Config.id)
+        )
+
+    header = True
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(query.execution_options(yield_per=settings.TRANSFER_BATCH_SIZE))
+        async for partition in result.partitions():
+            if kind == "configs":
+                rows = [(name, models.ConfigBlob.unpack(data)) for name, data in partition]
+            else:
+                rows = [tuple(row) for row in partition]
+            yield _write(format, fields, rows, header)
+            header = False
+    if header and format == "csv":
+        yield _write(format, fields, [], header)
@@ -1,11 +1,411 @@
+import asyncio
+import json
+import logging
+import re
+import ssl
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional
+
 import httpx
 from fastapi import HTTPException
-from .models import Device
+from . import metrics, settings
+from .models import Device, normalize_mac
+
+logger = logging.getLogger(__name__)
+
+
+def _ssl_context() -> ssl.SSLContext:
+    """Общий SSL-контекст без проверки сертификатов (у телефонов самоподписанные)"""
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+_TRUE_VALUES = {"1", "on", "true", "yes", "enabled"}
+_REGISTERED_STATES = {"registered", "1", "ok", "online"}
+
+def _parse_uptime(value: str) -> Optional[int]:
+    """Аптайм в секундах из «3600», «01:00:00» или «2d 01:00:00»"""
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    match = re.fullmatch(r"(?:(\d+)\s*d(?:ays?)?,?\s*)?(\d+):(\d{2}):(\d{2})", value)
+    if not match:
+        return None
+    days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+def _status_pairs(text: str) -> dict:
+    """Пары ключ-значение из ответа телефона (JSON или строки key=value / key: value)"""
+    pairs = {}
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict):
+            pairs = {str(k).lower(): v for k, v in data.items()}
+    except (TypeError, ValueError):
+        for line in (text or "").replace(";", "\n").splitlines():
+            key, sep, value = line.partition("=")
+            if not sep:
+                key, sep, value = line.partition(":")
+            if sep:
+                pairs[key.strip().lower()] = value.strip()
+    return pairs
+
+def parse_status(text: str) -> dict:
+    """Разбор ответа phonecfg=get в типизированные поля.
+
+    Поддерживается JSON и строки вида key=value / key: value, например
+    «account.1.status=Registered», «accounts=1:registered,2:failed»,
+    «dnd=0», «fw=96.86.0.5», «uptime=1d 02:03:04».
+    """
+    pairs = _status_pairs(text)
+    accounts = {}
+    dnd = firmware = uptime = None
+    for key, value in pairs.items():
+        if key == "accounts" and isinstance(value, dict):
+            accounts.update({str(k): str(v).lower() for k, v in value.items()})
+        elif key == "accounts":
+            for item in str(value).split(","):
+                number, sep, state = item.partition(":")
+                if sep:
+                    accounts[number.strip()] = state.strip().lower()
+        elif match := re.fullmatch(r"account\.?(\d+)(?:\.status|\.state)?", key):
+            accounts[match.group(1)] = str(value).lower()
+        elif key == "dnd":
+            dnd = str(value).lower() in _TRUE_VALUES
+        elif key in ("fw", "firmware", "firmware_version"):
+            firmware = str(value)[:50]
+        elif key == "uptime":
+            uptime = _parse_uptime(str(value))
+
+    return {
+        "account_states": accounts or None,
+        # Телефон зарегистрирован, если зарегистрированы все его линии
+        "registered": all(state in _REGISTERED_STATES for state in accounts.values()) if accounts else None,
+        "dnd": dnd,
+        "firmware": firmware,
+        "uptime": uptime,
+    }
+
+
+def parse_identity(text: str) -> Optional[dict]:
+    """MAC, модель и прошивка телефона из ответа phonecfg=get; None, если это не телефон Yealink"""
+    pairs = _status_pairs(text)
+    mac_address = normalize_mac(str(pairs.get("mac") or pairs.get("mac_address") or ""))
+    if not re.fullmatch(r"([0-9A-F]{2}:){5}[0-9A-F]{2}", mac_address or ""):
+        return None
+    model = pairs.get("model") or pairs.get("device_model")
+    firmware = pairs.get("fw") or pairs.get("firmware") or pairs.get("firmware_version")
+    return {
+        "mac_address": mac_address,
+        # «Yealink SIP-T46U» и «T46U» считаем одной моделью
+        "model": str(model).split()[-1].replace("SIP-", "")[:50] if model else None,
+        "firmware": str(firmware)[:20] if firmware else None,
+    }
+
+
+def project_fields(data: dict, fields: list) -> dict:
+    """Оставляет в словаре только указанные поля, вложенные задаются через точку (model.name)"""
+    result = {}
+    for path in fields:
+        source, target = data, result
+        keys = path.split(".")
+        for key in keys[:-1]:
+            source = source.get(key) if isinstance(source, dict) else None
+            if source is None:
+                break
+            target = target.setdefault(key, {})
+        else:
+            if isinstance(source, dict) and keys[-1] in source:
+                target[keys[-1]] = source[keys[-1]]
+            continue
+        # Промежуточный объект отсутствует (например, у устройства нет модели)
+        result.setdefault(keys[0], None)
+    return result
+
+
+@dataclass
+class HostSlot:
+    """Ограничение одновременных запросов к одному телефону"""
+    semaphore: asyncio.Semaphore
+    users: int = 0  # Запросы, ожидающие или выполняемые
+
+
+class PooledTransport(httpx.AsyncBaseTransport):
+    """Транспорт с пулом keep-alive соединений, ограничением соединений
+    на один телефон и счётчиками использования пула"""
+
+    def __init__(
+        self,
+        max_connections: int = None,
+        max_keepalive_connections: int = None,
+        keepalive_expiry: float = None,
+        max_per_host: int = None,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections or settings.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=max_keepalive_connections or settings.HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=keepalive_expiry or settings.HTTP_KEEPALIVE_EXPIRY,
+        )
+        self.max_per_host = max_per_host or settings.HTTP_MAX_PER_HOST
+        # Один SSL-контекст на всё приложение: сертификаты и шифры не настраиваются заново
+        self.transport = httpx.AsyncHTTPTransport(verify=_ssl_context(), limits=self.limits)
+        self._host_slots: Dict[str, HostSlot] = {}
+        self.requests_total = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.tls_handshakes = 0
+        self.waiting = 0
+        self.in_flight = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # Запрос, для которого не открывалось новое соединение, ушёл по соединению из пула
+        connected = False
+
+        async def trace(event_name: str, info: dict):
+            nonlocal connected
+            if event_name == "connection.connect_tcp.complete":
+                connected = True
+                self.connections_opened += 1
+            elif event_name == "connection.start_tls.complete":
+                self.tls_handshakes += 1
+            elif event_name == "http11.send_request_headers.started" and not connected:
+                self.connections_reused += 1
+
+        request.extensions["trace"] = trace
+        host = request.url.host
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = self._host_slots[host] = HostSlot(asyncio.Semaphore(self.max_per_host))
+        slot.users += 1
+        try:
+            self.waiting += 1
+            try:
+                await slot.semaphore.acquire()
+            finally:
+                self.waiting -= 1
+            self.requests_total += 1
+            self.in_flight += 1
+            try:
+                response = await self.transport.handle_async_request(request)
+                # Ответы телефонов небольшие: читаем сразу, чтобы вернуть соединение в пул
+                await response.aread()
+                return response
+            finally:
+                self.in_flight -= 1
+                slot.semaphore.release()
+        finally:
+            # Ограничитель хранится, только пока к телефону есть запросы
+            slot.users -= 1
+            if not slot.users:
+                del self._host_slots[host]
+
+    def stats(self) -> dict:
+        """Состояние пула соединений. open, idle и active берутся из внутреннего пула httpcore
+        и равны None, если в установленной версии httpx его нет"""
+        connections = getattr(getattr(self.transport, "_pool", None), "connections", None)
+        idle = None
+        if connections is not None:
+            idle = sum(1 for connection in connections if connection.is_idle())
+        return {
+            "open": len(connections) if connections is not None else None,
+            "idle": idle,
+            "active": len(connections) - idle if connections is not None else None,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "requests_total": self.requests_total,
+            "connections_opened": self.connections_opened,
+            "connections_reused": self.connections_reused,
+            "tls_handshakes": self.tls_handshakes,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "max_per_host": self.max_per_host,
+            "keepalive_expiry": self.limits.keepalive_expiry,
+        }
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class DeviceOfflineError(HTTPException):
+    """Устройство считается недоступным, запрос к нему не отправлялся"""
+
+    def __init__(self, ip_address: str):
+        super().__init__(status_code=503, detail=f"Device offline: {ip_address}")
+
+
+@dataclass
+class DeviceHealth:
+    """Состояние доступности одного телефона"""
+    state: str = "closed"  # closed — доступен, open — недоступен, half_open — пробный запрос
+    failures: int = 0
+    opened_at: Optional[float] = None
+    last_success: Optional[float] = None
+    last_failure: Optional[float] = None
+    last_error: Optional[str] = None
+
+
+class HealthTracker:
+    """Учёт доступности телефонов: автоматический выключатель после серии
+    неудач и быстрая TCP-проверка перед пробным запросом"""
+
+    def __init__(
+        self,
+        port: int = None,
+        failure_threshold: int = None,
+        open_seconds: float = None,
+        probe_timeout: float = None,
+        idle_seconds: float = None,
+    ):
+        self.port = port or settings.DEVICE_PORT
+        self.failure_threshold = failure_threshold or settings.HEALTH_FAILURE_THRESHOLD
+        self.open_seconds = open_seconds or settings.HEALTH_OPEN_SECONDS
+        self.probe_timeout = probe_timeout or settings.HEALTH_PROBE_TIMEOUT
+        self.idle_seconds = idle_seconds or settings.HEALTH_IDLE_SECONDS
+        self._hosts: Dict[str, DeviceHealth] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def probe(self, host: str) -> bool:
+        """Проверка, принимает ли телефон TCP-соединения"""
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, self.port), self.probe_timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        return True
+
+    async def before_request(self, host: str):
+        """Вызывается перед запросом; для недоступного телефона сразу бросает DeviceOfflineError.
+        TCP-проверка только перед пробным запросом после отключения: для доступного телефона
+        сигналом служит неудача самого запроса, а соединение берётся из пула"""
+        health = self._hosts.get(host)
+        if health is None or health.state == "closed":
+            return
+        if health.state == "open":
+            if time.monotonic() - health.opened_at < self.open_seconds:
+                raise DeviceOfflineError(host)
+            health.state = "half_open"
+        if not await self.probe(host):
+            self.record_failure(host, "TCP probe failed")
+            raise DeviceOfflineError(host)
+
+    def record_success(self, host: str):
+        health = self._hosts.setdefault(host, DeviceHealth())
+        health.state = "closed"
+        health.failures = 0
+        health.opened_at = None
+        health.last_success = time.monotonic()
+
+    def record_failure(self, host: str, error: str):
+        health = self._hosts.setdefault(host, DeviceHealth())
+        health.failures += 1
+        health.last_failure = time.monotonic()
+        health.last_error = error
+        if health.state == "half_open" or health.failures >= self.failure_threshold:
+            health.state = "open"
+            health.opened_at = health.last_failure
+
+    def _evict_idle(self, now: float):
+        """Забываем телефоны без запросов дольше idle_seconds (например, адреса из поиска в подсетях)"""
+        for host, health in list(self._hosts.items()):
+            last_seen = max(health.last_success or 0.0, health.last_failure or 0.0)
+            if now - last_seen >= self.idle_seconds:
+                del self._hosts[host]
+
+    async def _recover(self):
+        """Фоновая проверка недоступных телефонов: ответившие снова считаются доступными"""
+        while True:
+            await asyncio.sleep(self.open_seconds / 2)
+            now = time.monotonic()
+            self._evict_idle(now)
+            hosts = [
+                host for host, health in self._hosts.items()
+                if health.state == "open" and now - health.opened_at >= self.open_seconds
+            ]
+            for host, alive in zip(hosts, await asyncio.gather(*(self.probe(host) for host in hosts))):
+                if alive:
+                    logger.info(f"Device {host} is reachable again")
+                    self.record_success(host)
+                elif host in self._hosts:
+                    self._hosts[host].opened_at = now
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._recover())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def state(self, host: str) -> dict:
+        """Состояние доступности без обращения к телефону"""
+        health = self._hosts.get(host) or DeviceHealth(state="unknown")
+        data = asdict(health)
+        now = time.monotonic()
+        for key in ("opened_at", "last_success", "last_failure"):
+            # Вместо монотонного времени — сколько секунд назад
+            data[key] = round(now - data[key], 1) if data[key] is not None else None
+        return data
+
+
+@contextmanager
+def _command_metrics(command: str):
+    """Учёт длительности и результата команды телефону"""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    except DeviceOfflineError:
+        outcome = "offline"
+        raise
+    except httpx.HTTPStatusError:
+        outcome = "http_error"
+        raise
+    except HTTPException:
+        outcome = "unreachable"
+        raise
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        metrics.device_command_seconds.labels(command, outcome).observe(time.perf_counter() - started)
+
 
 class YealinkClient:
-    def __init__(self):
-        # Создаем клиент с отключенной SSL-проверкой
-        self.client = httpx.AsyncClient(verify=False)
+    def __init__(self, transport: PooledTransport = None, health: HealthTracker = None):
+        self.transport = transport or PooledTransport()
+        self.client = httpx.AsyncClient(transport=self.transport)
+        self.health = health or HealthTracker()
+
+    @staticmethod
+    def _url(host: str) -> str:
+        if settings.DEVICE_PORT == 443:
+            return f"https://{host}/servlet"
+        return f"https://{host}:{settings.DEVICE_PORT}/servlet"
+
+    async def _request(self, device: Device, method: str, timeout: float, **kwargs) -> httpx.Response:
+        """Запрос к /servlet телефона с учётом его доступности"""
+        host = device.ip_address
+        await self.health.before_request(host)
+        try:
+            response = await self.client.request(
+                method,
+                self._url(host),
+                auth=(device.username, device.password),  # Basic Auth
+                timeout=timeout,
+                **kwargs
+            )
+        except httpx.RequestError as e:
+            self.health.record_failure(host, str(e))
+            raise
+        self.health.record_success(host)
+        return response
 
     async def __aenter__(self):
         return self
@@ -15,21 +415,13 @@ class YealinkClient:
     
     async def send_command(self, device: Device, query: str, command: str, params: dict = None):
         """Отправка команды на устройство Yealink с аутентификацией"""
-        base_url = f"https://{device.ip_address}/servlet"
         query_params = {query: command}
         
         if params:
             query_params.update(params)
         
         try:
-            # Добавляем Basic Auth
-            auth = (device.username, device.password)
-            response = await self.client.get(
-                base_url,
-                params=query_params,
-                auth=auth,
-                timeout=10.0
-            )
+            response = await self._request(device, "GET", 10.0, params=query_params)
             response.raise_for_status()
             return response.text
         except httpx.RequestError as e:
@@ -40,37 +432,55 @@ class YealinkClient:
     
     async def get_status(self, device: Device):
         """Получение статуса устройства с дополнительными параметрами"""
-        return await self.send_command(
-            device, 
-            "phonecfg", 
-            "get",
-            {"accounts": "1", "dnd": "1", "fw": "1"}
-        )
+        with _command_metrics("status"):
+            return await self.send_command(
+                device,
+                "phonecfg",
+                "get",
+                {"accounts": "1", "dnd": "1", "fw": "1"}
+            )
     
     async def reboot_device(self, device: Device):
         """Перезагрузка устройства"""
-        return await self.send_command(device, "key", "Reboot")
+        with _command_metrics("reboot"):
+            return await self.send_command(device, "key", "Reboot")
     
     async def apply_config(self, device: Device, config_content: str):
         """Применение конфигурации к устройству"""
-        base_url = f"https://{device.ip_address}/servlet"
-        try:
-            auth = (device.username, device.password)
-            response = await self.client.post(
-                base_url,
-                content=config_content,
-                auth=auth,
-                timeout=30.0,
-                headers={"Content-Type": "application/xml"}
-            )
-            response.raise_for_status()
-            return response.text
-        except httpx.RequestError as e:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Ошибка применения конфигурации: {str(e)}"
-            )
+        with _command_metrics("apply_config"):
+            try:
+                response = await self._request(
+                    device,
+                    "POST",
+                    30.0,
+                    content=config_content,
+                    headers={"Content-Type": "application/xml"}
+                )
+                response.raise_for_status()
+                return response.text
+            except httpx.RequestError as e:
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Ошибка применения конфигурации: {str(e)}"
+                )
     
     async def close(self):
         """Закрыть клиент при завершении"""
-        await self.client.aclose()
\ No newline at end of file
+        await self.health.stop()
+        await self.client.aclose()
+
+# Общий клиент приложения, открывается и закрывается в lifespan
+_shared_client: Optional[YealinkClient] = None
+
+def get_yealink_client() -> YealinkClient:
+    """Общий клиент Yealink с пулом соединений (создаётся при первом обращении)"""
+    global _shared_client
+    if _shared_client is None:
+        _shared_client = YealinkClient()
+    return _shared_client
+
+async def close_yealink_client():
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.close()
+        _shared_client = None
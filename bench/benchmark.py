@@ -0,0 +1,338 @@
+# ydm/bench/benchmark.py
+"""Нагрузочный тест опроса, команд и списков устройств на симуляторе телефонов.
+
+Для каждого размера парка (по умолчанию 1k и 10k) создаётся отдельная
+SQLite-база во временном каталоге, устройства получают адреса 127.1.x.y,
+а приложение обращается к симулятору bench/simulator.py. Выводится
+пропускная способность и p50/p99 задержки по каждому сценарию.
+
+Запуск:
+    python -m bench.benchmark --devices 1000 10000 --json results.json
+    python -m bench.benchmark --baseline results.json  # код выхода 1 при регрессии
+"""
+import argparse
+import asyncio
+import ipaddress
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional
+
+ROOT = Path(__file__).resolve().parents[1]
+FIRST_ADDRESS = int(ipaddress.IPv4Address("127.1.0.1"))
+
+# Что измеряет каждый сценарий; выводится под таблицей результатов
+SCENARIOS = {
+    "sweep": "полный обход опроса статусов",
+    "status_route": "GET /devices/{id}/status, запрос к телефону",
+    "reboot_enqueue": "POST /devices/{id}/reboot, только постановка задания в очередь (ответ 202)",
+    "reboot_jobs": "выполнение этих заданий: seconds и req/s — до завершения всех, p50/p99 — от started_at до finished_at",
+    "list_pages": "полный обход /devices/ по курсору, страницы по 100",
+    "list_sparse": "GET /devices/?fields=..., 100 устройств",
+    "devices_page_html": "HTML-страница /devices-list",
+}
+
+
+@dataclass
+class Result:
+    scenario: str
+    devices: int
+    requests: int
+    errors: int
+    seconds: float
+    throughput: float  # Запросов в секунду
+    p50_ms: float
+    p99_ms: float
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def make_result(scenario: str, devices: int, latencies: List[float], errors: int, seconds: float) -> Result:
+    return Result(
+        scenario=scenario,
+        devices=devices,
+        requests=len(latencies),
+        errors=errors,
+        seconds=round(seconds, 3),
+        throughput=round(len(latencies) / seconds, 1) if seconds else 0.0,
+        p50_ms=round(percentile(latencies, 0.5) * 1000, 2),
+        p99_ms=round(percentile(latencies, 0.99) * 1000, 2),
+    )
+
+
+async def run_requests(
+    calls: List[Callable[[], Awaitable]], concurrency: int
+) -> tuple:
+    """Выполнение вызовов с ограничением параллельности; возвращает задержки, число ошибок и общее время"""
+    latencies: List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(call):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await call()
+                if response.status_code >= 400:
+                    errors += 1
+                elif response.headers.get("content-type") == "application/json":
+                    # Команды сообщают об ошибке телефона в теле ответа
+                    data = response.json()
+                    errors += isinstance(data, dict) and data.get("success") is False
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed(call) for call in calls))
+    return latencies, errors, time.perf_counter() - started
+
+
+def wait_for_port(port: int, process: subprocess.Popen = None, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Simulator exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Simulator did not start on port {port}")
+
+
+def seed_devices(count: int):
+    """Чистая база с count устройствами на адресах симулятора"""
+    from app import crud, models
+    from app.database import SessionLocal, engine
+
+    models.Base.metadata.create_all(bind=engine)
+    rows = []
+    with SessionLocal() as db:
+        for i in range(count):
+            address = FIRST_ADDRESS + i
+            rows.append({
+                "mac_address": "00:15:65:" + ":".join(f"{address >> shift & 0xFF:02X}" for shift in (16, 8, 0)),
+                "ip_address": str(ipaddress.IPv4Address(address)),
+                "ip_int": address,
+                "username": "admin",
+                "password": "admin",
+            })
+            if len(rows) == 1000:
+                crud.upsert_devices(db, rows, ("ip_address", "ip_int"))
+                rows = []
+        crud.upsert_devices(db, rows, ("ip_address", "ip_int"))
+
+
+async def bench_size(count: int, args) -> List[Result]:
+    import httpx
+
+    from app import poller
+    from app.main import app
+
+    seed_devices(count)
+    results = []
+    sample = random.Random(count).sample(range(1, count + 1), min(count, args.commands))
+
+    async with app.router.lifespan_context(app):
+        report = await poller.collect_device_statuses(concurrency=args.concurrency)
+        results.append(Result(
+            scenario="sweep",
+            devices=count,
+            requests=report.total,
+            errors=report.failed,
+            seconds=round(report.duration, 3),
+            throughput=round(report.total / report.duration, 1) if report.duration else 0.0,
+            p50_ms=round(report.latency_p50 * 1000, 2),
+            p99_ms=round(report.latency_p99 * 1000, 2),
+        ))
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            for scenario, method, path in (
+                ("status_route", "GET", "/devices/{}/status"),
+                ("reboot_enqueue", "POST", "/devices/{}/reboot"),
+            ):
+                calls = [lambda p=path.format(i), m=method: client.request(m, p) for i in sample]
+                started = time.perf_counter()
+                latencies, errors, seconds = await run_requests(calls, args.concurrency)
+                results.append(make_result(scenario, count, latencies, errors, seconds))
+
+            # Перезагрузки выполняются в фоне; следующие сценарии замеряются после их завершения
+            results.append(await wait_for_jobs(client, count, started, args.jobs_timeout))
+
+            # Полный обход списка по курсору, страницы по 100
+            latencies, errors = [], 0
+            started = time.perf_counter()
+            cursor = None
+            while True:
+                params = {"limit": 100, **({"cursor": cursor} if cursor else {})}
+                page_started = time.perf_counter()
+                response = await client.get("/devices/", params=params)
+                latencies.append(time.perf_counter() - page_started)
+                if response.status_code != 200:
+                    errors += 1
+                    break
+                cursor = response.headers.get("x-next-cursor")
+                if not cursor:
+                    break
+            results.append(make_result("list_pages", count, latencies, errors, time.perf_counter() - started))
+
+            calls = [lambda: client.get("/devices/", params={"limit": 100, "fields": "id,mac_address,ip_address"})] * args.list_requests
+            latencies, errors, seconds = await run_requests(calls, args.concurrency)
+            results.append(make_result("list_sparse", count, latencies, errors, seconds))
+
+            calls = [lambda: client.get("/devices-list")] * args.list_requests
+            latencies, errors, seconds = await run_requests(calls, args.concurrency)
+            results.append(make_result("devices_page_html", count, latencies, errors, seconds))
+    return results
+
+
+async def wait_for_jobs(client, devices: int, started: float, timeout: float) -> Result:
+    """Ожидание, пока в очереди не останется заданий; незавершённые к сроку считаются ошибками"""
+    from sqlalchemy import select
+
+    from app import models
+    from app.database import SessionLocal
+
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        pending = [
+            (await client.get("/jobs", params={"status": status, "limit": 1})).json()
+            for status in ("queued", "running")
+        ]
+        if not any(pending):
+            break
+        await asyncio.sleep(0.2)
+    seconds = time.perf_counter() - started
+
+    def load():
+        with SessionLocal() as db:
+            return db.execute(
+                select(models.CommandJob.status, models.CommandJob.started_at, models.CommandJob.finished_at)
+            ).all()
+
+    jobs = await asyncio.to_thread(load)
+    latencies = [
+        (finished_at - started_at).total_seconds()
+        for status, started_at, finished_at in jobs
+        if status == "succeeded" and started_at and finished_at
+    ]
+    result = make_result("reboot_jobs", devices, latencies, len(jobs) - len(latencies), seconds)
+    # Пропускная способность — завершённые задания за всё время с постановки в очередь
+    result.requests = len(jobs)
+    result.throughput = round(len(jobs) / seconds, 1) if seconds else 0.0
+    return result
+
+
+def print_results(results: List[Result]):
+    header = f"{'scenario':<20}{'devices':>9}{'requests':>10}{'errors':>8}{'seconds':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r.scenario:<20}{r.devices:>9}{r.requests:>10}{r.errors:>8}{r.seconds:>10}{r.throughput:>10}{r.p50_ms:>10}{r.p99_ms:>10}")
+    print()
+    for scenario in dict.fromkeys(r.scenario for r in results):
+        print(f"{scenario:<20}{SCENARIOS.get(scenario, '')}")
+
+
+def find_regressions(results: List[Result], baseline: List[dict], tolerance: float) -> List[str]:
+    """Сценарии, где p99 вырос или пропускная способность упала больше чем на tolerance"""
+    previous = {(item["scenario"], item["devices"]): item for item in baseline}
+    regressions = []
+    for r in results:
+        base = previous.get((r.scenario, r.devices))
+        if base is None:
+            continue
+        if base["p99_ms"] and r.p99_ms > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{r.scenario}@{r.devices}: p99 {base['p99_ms']} -> {r.p99_ms} ms")
+        if base["throughput"] and r.throughput < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{r.scenario}@{r.devices}: throughput {base['throughput']} -> {r.throughput} req/s")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест на симуляторе телефонов")
+    parser.add_argument("--devices", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--port", type=int, default=8443, help="Порт симулятора")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--commands", type=int, default=1000, help="Команд на сценарий")
+    parser.add_argument("--list-requests", type=int, default=200, help="Запросов на сценарий списков")
+    parser.add_argument("--jobs-timeout", type=float, default=300, help="Ожидание фоновых заданий, сек")
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--dead-share", type=float, default=0.0)
+    parser.add_argument("--simulator-workers", type=int, default=1)
+    parser.add_argument("--no-simulator", action="store_true", help="Симулятор уже запущен отдельно")
+    parser.add_argument("--json", help="Сохранить результаты в файл")
+    parser.add_argument("--baseline", help="Результаты прошлого запуска для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--run-size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_size:
+        # Один размер парка в отдельном процессе: своя база и чистое состояние приложения
+        results = asyncio.run(bench_size(args.run_size, args))
+        Path(args.json).write_text(json.dumps([asdict(r) for r in results]))
+        return 0
+
+    simulator = None
+    if not args.no_simulator:
+        simulator = subprocess.Popen(
+            [sys.executable, "-m", "bench.simulator", "--port", str(args.port),
+             "--workers", str(args.simulator_workers), "--latency", str(args.latency),
+             "--error-rate", str(args.error_rate), "--dead-share", str(args.dead_share)],
+            cwd=ROOT,
+        )
+    results = []
+    try:
+        wait_for_port(args.port, simulator)
+        env = {
+            **os.environ,
+            "PYTHONPATH": str(ROOT),
+            "YDM_DEVICE_PORT": str(args.port),
+            # Фоновый опрос не должен мешать замерам
+            "YDM_POLL_INTERVAL_MINUTES": os.getenv("YDM_POLL_INTERVAL_MINUTES", "100000"),
+        }
+        for count in args.devices:
+            # Приложение создаёт ./yealink.db при импорте, поэтому каждый прогон — во временном каталоге
+            with tempfile.TemporaryDirectory() as workdir:
+                output = os.path.join(workdir, "results.json")
+                subprocess.run(
+                    [sys.executable, "-m", "bench.benchmark", "--run-size", str(count), "--json", output,
+                     "--concurrency", str(args.concurrency), "--commands", str(args.commands),
+                     "--list-requests", str(args.list_requests), "--jobs-timeout", str(args.jobs_timeout)],
+                    cwd=workdir, env=env, check=True,
+                )
+                results.extend(Result(**item) for item in json.loads(Path(output).read_text()))
+        print_results(results)
+    finally:
+        if simulator is not None:
+            simulator.terminate()
+            simulator.wait()
+
+    if args.json:
+        Path(args.json).write_text(json.dumps([asdict(r) for r in results], indent=2))
+    if args.baseline:
+        regressions = find_regressions(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
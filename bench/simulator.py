@@ -0,0 +1,217 @@
+# ydm/bench/simulator.py
+"""Симулятор телефонов Yealink для нагрузочных тестов.
+
+Отвечает на /servlet так же, как веб-интерфейс телефона: phonecfg=get,
+key=Reboot и POST XML-конфигурации, с Basic Auth и по HTTPS.
+Каждый адрес 127.x.y.z — отдельный виртуальный телефон: сервер слушает
+все адреса loopback, а телефон определяется по адресу, на который пришёл
+запрос. MAC, модель и состояние линий выводятся из адреса, поэтому
+повторные запуски отвечают одинаково.
+
+Запуск:
+    python -m bench.simulator --port 8443 --latency 0.05 --error-rate 0.01 --dead-share 0.02
+
+Приложение при этом запускается с YDM_DEVICE_PORT=8443.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import ipaddress
+import os
+import random
+import subprocess
+import tempfile
+import time
+from dataclasses import dataclass
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+MODELS = ("T46U", "T54W", "T57W", "T58W", "T33G")
+FIRMWARE = {"T46U": "108.86.0.75", "T54W": "96.86.0.70", "T57W": "96.86.0.70", "T58W": "150.86.0.10", "T33G": "124.86.0.40"}
+
+
+@dataclass
+class SimulatorConfig:
+    """Параметры симулятора; читаются из окружения, чтобы их видели все воркеры uvicorn"""
+    username: str = "admin"
+    password: str = "admin"
+    latency: float = 0.02  # Средняя задержка ответа, сек
+    jitter: float = 0.5  # Разброс задержки, доля от средней
+    error_rate: float = 0.0  # Доля запросов, завершающихся ошибкой 500
+    dead_share: float = 0.0  # Доля телефонов, которые принимают соединение, но не отвечают
+    unregistered_share: float = 0.05  # Доля телефонов с незарегистрированной линией
+
+    @classmethod
+    def from_env(cls) -> "SimulatorConfig":
+        return cls(
+            username=os.getenv("SIM_USERNAME", "admin"),
+            password=os.getenv("SIM_PASSWORD", "admin"),
+            latency=float(os.getenv("SIM_LATENCY", "0.02")),
+            jitter=float(os.getenv("SIM_JITTER", "0.5")),
+            error_rate=float(os.getenv("SIM_ERROR_RATE", "0")),
+            dead_share=float(os.getenv("SIM_DEAD_SHARE", "0")),
+            unregistered_share=float(os.getenv("SIM_UNREGISTERED_SHARE", "0.05")),
+        )
+
+    def to_env(self) -> dict:
+        return {
+            "SIM_USERNAME": self.username,
+            "SIM_PASSWORD": self.password,
+            "SIM_LATENCY": str(self.latency),
+            "SIM_JITTER": str(self.jitter),
+            "SIM_ERROR_RATE": str(self.error_rate),
+            "SIM_DEAD_SHARE": str(self.dead_share),
+            "SIM_UNREGISTERED_SHARE": str(self.unregistered_share),
+        }
+
+
+class VirtualPhone:
+    """Виртуальный телефон, все свойства которого выводятся из его адреса"""
+
+    def __init__(self, address: str, config: SimulatorConfig):
+        self.address = address
+        seed = int.from_bytes(hashlib.blake2b(address.encode(), digest_size=8).digest(), "big")
+        low = int(ipaddress.IPv4Address(address)) & 0xFFFFFF
+        self.mac_address = "00:15:65:" + ":".join(f"{low >> shift & 0xFF:02X}" for shift in (16, 8, 0))
+        self.model = MODELS[seed % len(MODELS)]
+        self.firmware = FIRMWARE[self.model]
+        fraction = (seed >> 16) % 10000 / 10000
+        self.dead = fraction < config.dead_share
+        self.registered = (seed >> 32) % 10000 / 10000 >= config.unregistered_share
+        self.booted_at = time.monotonic()
+        self.configs_applied = 0
+
+    def status(self) -> str:
+        line_state = "registered" if self.registered else "failed"
+        return "\n".join((
+            f"mac={self.mac_address}",
+            f"model=Yealink SIP-{self.model}",
+            f"fw={self.firmware}",
+            f"accounts=1:{line_state}",
+            "dnd=0",
+            f"uptime={int(time.monotonic() - self.booted_at)}",
+        ))
+
+    def reboot(self):
+        self.booted_at = time.monotonic()
+
+
+class Simulator:
+    def __init__(self, config: SimulatorConfig = None):
+        self.config = config or SimulatorConfig.from_env()
+        self.phones = {}
+        self.requests = 0
+        self.errors = 0
+        expected = f"{self.config.username}:{self.config.password}".encode()
+        self._auth = "Basic " + base64.b64encode(expected).decode()
+
+    def phone(self, address: str) -> VirtualPhone:
+        phone = self.phones.get(address)
+        if phone is None:
+            phone = self.phones[address] = VirtualPhone(address, self.config)
+        return phone
+
+    async def _delay(self):
+        if self.config.latency > 0:
+            spread = self.config.latency * self.config.jitter
+            await asyncio.sleep(max(random.uniform(self.config.latency - spread, self.config.latency + spread), 0))
+
+    async def servlet(self, request: Request) -> Response:
+        self.requests += 1
+        phone = self.phone(request.scope["server"][0])
+        if phone.dead:
+            # Зависший телефон: соединение принято, ответа нет до таймаута клиента
+            await asyncio.sleep(3600)
+        if request.headers.get("authorization") != self._auth:
+            return PlainTextResponse("Unauthorized", status_code=401, headers={"WWW-Authenticate": 'Basic realm="Yealink"'})
+        await self._delay()
+        if self.config.error_rate and random.random() < self.config.error_rate:
+            self.errors += 1
+            return PlainTextResponse("Internal Server Error", status_code=500)
+
+        if request.method == "POST":
+            await request.body()
+            phone.configs_applied += 1
+            return PlainTextResponse("OK")
+        if request.query_params.get("phonecfg") == "get":
+            return PlainTextResponse(phone.status())
+        if request.query_params.get("key", "").lower() == "reboot":
+            phone.reboot()
+            return PlainTextResponse("OK")
+        return PlainTextResponse("Unknown command", status_code=400)
+
+    async def stats(self, request: Request) -> Response:
+        return JSONResponse({
+            "pid": os.getpid(),
+            "phones": len(self.phones),
+            "requests": self.requests,
+            "errors": self.errors,
+            "configs_applied": sum(phone.configs_applied for phone in self.phones.values()),
+        })
+
+
+simulator = Simulator()
+app = Starlette(routes=[
+    Route("/servlet", simulator.servlet, methods=["GET", "POST"]),
+    Route("/__stats", simulator.stats),
+])
+
+
+def self_signed_certificate(directory: str):
+    """Самоподписанный сертификат через openssl (у настоящих телефонов такой же)"""
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=yealink-simulator", "-keyout", keyfile, "-out", certfile],
+        check=True, capture_output=True,
+    )
+    return certfile, keyfile
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Симулятор телефонов Yealink")
+    parser.add_argument("--host", default="0.0.0.0", help="0.0.0.0 принимает запросы на все адреса 127.x.y.z")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--certfile")
+    parser.add_argument("--keyfile")
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin")
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--dead-share", type=float, default=0.0)
+    parser.add_argument("--unregistered-share", type=float, default=0.05)
+    args = parser.parse_args()
+
+    config = SimulatorConfig(
+        username=args.username, password=args.password, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, dead_share=args.dead_share, unregistered_share=args.unregistered_share,
+    )
+    os.environ.update(config.to_env())
+
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = args.certfile, args.keyfile
+        if not certfile:
+            certfile, keyfile = self_signed_certificate(directory)
+        uvicorn.run(
+            "bench.simulator:app",
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            ssl_certfile=certfile,
+            ssl_keyfile=keyfile,
+            log_level="warning",
+            access_log=False,
+        )
+
+
+if __name__ == "__main__":
+    main()